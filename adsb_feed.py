@@ -0,0 +1,367 @@
+# flighttracker/adsb_feed.py
+
+"""
+Streaming input from a local receiver (dump1090/readsb). Reads the SBS-1
+BaseStation feed (port 30003) or Beast binary (port 30005), drops anything we're
+not tracking before parsing it, and builds up ADSB Exchange shaped responses for
+the aircraft we are, so the rest of the bot can't tell where they came from
+"""
+
+import asyncio
+import logging as log
+import math
+import os
+import time
+
+fdLog = log.getLogger("adsb_feed")
+
+# Enable logging
+fdLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+fdLog.propagate = False
+
+# Add the console handler to the logger
+fdLog.addHandler(handler)
+
+# Off unless a host is set
+HOST = os.environ.get("FT_FEED_HOST", "")
+FORMAT = os.environ.get("FT_FEED_FORMAT", "sbs")
+PORT = int(os.environ.get("FT_FEED_PORT", 30005 if FORMAT == "beast" else 30003))
+# Seconds between handing updates to the bot
+FLUSH_INTERVAL = float(os.environ.get("FT_FEED_FLUSH", 1))
+# Longest wait between reconnect attempts
+RECONNECT_MAX = float(os.environ.get("FT_FEED_RECONNECT_MAX", 60))
+
+# Beast frame types and their Mode S/AC payload lengths
+BEAST_ESCAPE = 0x1A
+BEAST_LENGTHS = {0x31: 2, 0x32: 7, 0x33: 14}
+# 6 byte timestamp and 1 byte signal level ahead of every payload
+BEAST_HEADER = 7
+CALLSIGN_CHARS = "#ABCDEFGHIJKLMNOPQRSTUVWXYZ##### ###############0123456789######"
+# Even and odd CPR halves further apart than this (s) can't be combined
+CPR_MAX_AGE = 10
+
+
+def enabled() -> bool:
+    return bool(HOST)
+
+
+class AircraftState:
+    """Latest value of every field we've heard for one aircraft, messages only carry a few each"""
+
+    __slots__ = ("hex_id", "callsign", "alt", "ground", "gs", "track", "vert_rate", "lat", "lon",
+                 "updated", "cpr")
+
+    def __init__(self, hex_id: str):
+        self.hex_id = hex_id
+        self.callsign = None
+        self.alt = None
+        self.ground = None
+        self.gs = None
+        self.track = None
+        self.vert_rate = None
+        self.lat = None
+        self.lon = None
+        self.updated = 0.0
+        # Beast only, [even, odd] as (lat_cpr, lon_cpr, time)
+        self.cpr = [None, None]
+
+    def ac(self, now: float) -> dict:
+        """ADSB Exchange style ac entry"""
+        ac = {"hex": self.hex_id, "seen": round(max(0.0, now - self.updated), 1)}
+        if self.callsign:
+            ac["flight"] = self.callsign
+        if self.ground:
+            ac["alt_baro"] = "ground"
+        elif self.alt is not None:
+            ac["alt_baro"] = self.alt
+        for key, value in (("gs", self.gs), ("track", self.track), ("baro_rate", self.vert_rate),
+                           ("lat", self.lat), ("lon", self.lon)):
+            if value is not None:
+                ac[key] = value
+        return ac
+
+    def response(self, now: float) -> dict:
+        """Looks like a per-ID lookup, now is in ms like the real thing"""
+        return {"ac": [self.ac(now)], "msg": "No error", "now": int(now * 1000), "total": 1}
+
+
+def _number(value: bytes, cast=float):
+    try:
+        return cast(value) if value else None
+    except ValueError:
+        return None
+
+
+def parse_sbs(fields: list, state: AircraftState) -> bool:
+    """
+    Apply one split BaseStation MSG line to state, returns whether anything changed.
+    Fields: 10 callsign, 11 altitude, 12 ground speed, 13 track, 14 lat, 15 lon,
+    16 vertical rate, 21 on ground
+    """
+    changed = False
+    if len(fields) > 10 and fields[10].strip():
+        state.callsign = fields[10].strip().decode("ascii", "replace")
+        changed = True
+    for index, attr, cast in ((11, "alt", int), (12, "gs", float), (13, "track", float),
+                              (14, "lat", float), (15, "lon", float), (16, "vert_rate", int)):
+        if len(fields) > index:
+            value = _number(fields[index], cast)
+            if value is not None:
+                setattr(state, attr, value)
+                changed = True
+    if len(fields) > 21 and fields[21].strip():
+        # -1 is how BaseStation spells true
+        state.ground = fields[21].strip() not in (b"0", b"")
+        changed = True
+    return changed
+
+
+def cpr_nl(lat: float) -> int:
+    """Number of longitude zones at a latitude"""
+    if abs(lat) >= 87:
+        return 1 if abs(lat) > 87 else 2
+    if lat == 0:
+        return 59
+    return int(math.floor(2 * math.pi / math.acos(
+        1 - (1 - math.cos(math.pi / 30)) / math.cos(math.pi / 180 * lat) ** 2
+    )))
+
+
+def cpr_global(even: tuple, odd: tuple) -> tuple | None:
+    """Airborne position from an even and odd CPR pair, (lat, lon) or None if they straddle a zone"""
+    lat_e, lon_e = even[0] / 131072, even[1] / 131072
+    lat_o, lon_o = odd[0] / 131072, odd[1] / 131072
+    j = math.floor(59 * lat_e - 60 * lat_o + 0.5)
+    rlat_e = 6.0 * (j % 60 + lat_e)
+    rlat_o = 360 / 59 * (j % 59 + lat_o)
+    rlat_e -= 360 if rlat_e >= 270 else 0
+    rlat_o -= 360 if rlat_o >= 270 else 0
+    if cpr_nl(rlat_e) != cpr_nl(rlat_o):
+        return None
+    # The newer half decides
+    if even[2] >= odd[2]:
+        lat, lon_cpr, zones = rlat_e, lon_e, max(cpr_nl(rlat_e), 1)
+    else:
+        lat, lon_cpr, zones = rlat_o, lon_o, max(cpr_nl(rlat_o) - 1, 1)
+    nl = cpr_nl(lat)
+    m = math.floor(lon_e * (nl - 1) - lon_o * nl + 0.5)
+    lon = 360 / zones * (m % zones + lon_cpr)
+    lon -= 360 if lon >= 180 else 0
+    return round(lat, 5), round(lon, 5)
+
+
+def decode_extended_squitter(msg: bytes, state: AircraftState, now: float) -> bool:
+    """Apply a DF17/18 message to state, returns whether anything changed"""
+    me = int.from_bytes(msg[4:11], "big")
+    tc = me >> 51
+    if 1 <= tc <= 4:
+        chars = (CALLSIGN_CHARS[(me >> (42 - 6 * i)) & 0x3F] for i in range(8))
+        state.callsign = "".join(chars).replace("#", "").strip()
+        return True
+    if 5 <= tc <= 8:
+        state.ground = True
+        return True
+    if 9 <= tc <= 18:
+        alt_code = (me >> 36) & 0xFFF
+        # Only the 25ft encoding (Q bit set) is worth the trouble
+        if alt_code & 0x10:
+            state.alt = (((alt_code & 0xFE0) >> 1) | (alt_code & 0xF)) * 25 - 1000
+            state.ground = False
+        odd = (me >> 34) & 1
+        state.cpr[odd] = ((me >> 17) & 0x1FFFF, me & 0x1FFFF, now)
+        even_half, odd_half = state.cpr
+        if even_half and odd_half and abs(even_half[2] - odd_half[2]) <= CPR_MAX_AGE:
+            position = cpr_global(even_half, odd_half)
+            if position:
+                state.lat, state.lon = position
+        return True
+    if tc == 19:
+        subtype = (me >> 48) & 7
+        if subtype not in (1, 2):
+            return False
+        v_ew = ((me >> 32) & 0x3FF) - 1
+        v_ns = ((me >> 21) & 0x3FF) - 1
+        if v_ew >= 0 and v_ns >= 0:
+            # Supersonic encoding counts in 4kt steps
+            scale = 4 if subtype == 2 else 1
+            v_x = -v_ew * scale if (me >> 42) & 1 else v_ew * scale
+            v_y = -v_ns * scale if (me >> 31) & 1 else v_ns * scale
+            state.gs = round(math.hypot(v_x, v_y), 1)
+            state.track = round(math.degrees(math.atan2(v_x, v_y)) % 360, 1)
+        v_rate = (me >> 10) & 0x1FF
+        if v_rate:
+            state.vert_rate = -(v_rate - 1) * 64 if (me >> 19) & 1 else (v_rate - 1) * 64
+        return True
+    return False
+
+
+class FeedIngest:
+    """
+    Keeps AircraftState for every watched hex ID and remembers which ones changed
+    since the last flush. Lines and chunks are fed in as they arrive
+    """
+
+    def __init__(self):
+        # Uppercase ASCII hex for SBS, raw 3 byte ICAO address for Beast
+        self.watched_sbs = frozenset()
+        self.watched_raw = frozenset()
+        self.states = {}
+        self.dirty = set()
+        self.beast_buffer = bytearray()
+        self.frames = 0
+        self.matched = 0
+        self.errors = 0
+        self.connected = False
+
+    def watch(self, hex_ids) -> None:
+        """Replace the set of hex IDs we care about"""
+        hex_ids = {hex_id.lower() for hex_id in hex_ids if hex_id}
+        valid = set()
+        for hex_id in hex_ids:
+            try:
+                valid.add(bytes.fromhex(hex_id))
+            except ValueError:
+                continue
+        self.watched_raw = frozenset(valid)
+        self.watched_sbs = frozenset(raw.hex().upper().encode() for raw in valid)
+        for hex_id in list(self.states):
+            if hex_id not in hex_ids:
+                del self.states[hex_id]
+                self.dirty.discard(hex_id)
+
+    def _state(self, hex_id: str) -> AircraftState:
+        state = self.states.get(hex_id)
+        if state is None:
+            state = self.states[hex_id] = AircraftState(hex_id)
+        return state
+
+    def feed_sbs(self, line: bytes, now: float | None = None) -> None:
+        """One BaseStation line"""
+        self.frames += 1
+        # The hex ID is always the 5th field, don't split the rest unless it's ours
+        head = line.split(b",", 5)
+        if len(head) < 6 or head[0] != b"MSG" or head[4].upper() not in self.watched_sbs:
+            return
+        self.matched += 1
+        now = time.time() if now is None else now
+        state = self._state(head[4].decode().lower())
+        try:
+            changed = parse_sbs(line.rstrip(b"\r\n").split(b","), state)
+        except (UnicodeDecodeError, ValueError):
+            self.errors += 1
+            return
+        if changed:
+            state.updated = now
+            self.dirty.add(state.hex_id)
+
+    def feed_beast(self, chunk: bytes, now: float | None = None) -> None:
+        """Any amount of Beast binary, a frame split across chunks is kept for the next one"""
+        now = time.time() if now is None else now
+        buf = self.beast_buffer
+        buf.extend(chunk)
+        pos = 0
+        while True:
+            start = buf.find(BEAST_ESCAPE, pos)
+            if start < 0 or start + 1 >= len(buf):
+                pos = len(buf) if start < 0 else start
+                break
+            length = BEAST_LENGTHS.get(buf[start + 1])
+            if length is None:
+                # Status frame, escaped 0x1a or garbage, resync on the next escape
+                pos = start + 1
+                continue
+            frame, end = unescape(buf, start + 2, BEAST_HEADER + length)
+            if frame is None:
+                if end < 0:
+                    # A lone escape inside the frame, the frame was cut short
+                    pos = start + 1
+                    continue
+                pos = start
+                break
+            pos = end
+            self.frames += 1
+            if length == 14:
+                self.beast_message(frame[BEAST_HEADER:], now)
+        del buf[:pos]
+
+    def beast_message(self, msg: bytes, now: float) -> None:
+        """Mode S long message, only extended squitters carry what we need"""
+        downlink_format = msg[0] >> 3
+        if downlink_format not in (17, 18) or msg[1:4] not in self.watched_raw:
+            return
+        self.matched += 1
+        state = self._state(msg[1:4].hex())
+        if decode_extended_squitter(msg, state, now):
+            state.updated = now
+            self.dirty.add(state.hex_id)
+
+    def flush(self, now: float | None = None) -> dict:
+        """{hex: response} for every aircraft that changed since the last flush"""
+        now = time.time() if now is None else now
+        updates = {hex_id: self.states[hex_id].response(now) for hex_id in self.dirty if hex_id in self.states}
+        self.dirty.clear()
+        return updates
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "frames": self.frames,
+            "matched": self.matched,
+            "errors": self.errors,
+            "aircraft": len(self.states),
+        }
+
+    async def run(self, host: str = HOST, port: int = PORT, fmt: str = FORMAT) -> None:
+        """Read the feed until cancelled, reconnecting with backoff when it drops"""
+        backoff = 1.0
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as err:
+                fdLog.warning(f"Can't reach feed at {host}:{port}: {err}, retrying in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, RECONNECT_MAX)
+                continue
+            fdLog.info(f"Reading {fmt} feed from {host}:{port}")
+            self.connected = True
+            backoff = 1.0
+            try:
+                if fmt == "beast":
+                    while chunk := await reader.read(65536):
+                        self.feed_beast(chunk)
+                else:
+                    while line := await reader.readline():
+                        self.feed_sbs(line)
+            except (ConnectionError, asyncio.IncompleteReadError) as err:
+                fdLog.warning(f"Feed dropped: {err}")
+            finally:
+                self.connected = False
+                writer.close()
+            fdLog.warning(f"Feed from {host}:{port} closed, reconnecting")
+            await asyncio.sleep(backoff)
+
+
+def unescape(buf: bytearray, pos: int, count: int) -> tuple:
+    """
+    Read count bytes of a Beast frame starting at pos, collapsing escaped 0x1a pairs.
+    Returns (bytes, position after them), (None, pos) if the frame isn't all here yet
+    or (None, -1) if it's broken
+    """
+    out = bytearray()
+    size = len(buf)
+    while len(out) < count:
+        if pos >= size:
+            return None, pos
+        byte = buf[pos]
+        if byte == BEAST_ESCAPE:
+            if pos + 1 >= size:
+                return None, pos
+            if buf[pos + 1] != BEAST_ESCAPE:
+                return None, -1
+            pos += 1
+        out.append(byte)
+        pos += 1
+    return bytes(out), pos
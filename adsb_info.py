@@ -4,20 +4,43 @@
 Responsible for retreiving, storing, and processing data from ADSB API
 """
 
+import asyncio
+import calendar
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import json
 import logging as log
 import os
-import requests
+import time
 
 
 import aero_info
+import backoff
+import http_client
+import metrics
+import quota
 
 # 7am to 10pm
 awakeTime = range(7, 22)
 # examplehex_id = 'A1013F' # Current hex code for plane reg N621MM
-URL_REG = "https://adsbexchange-com1.p.rapidapi.com/v2/registration/"
-URL_HEX = "https://adsbexchange-com1.p.rapidapi.com/v2/icao/"
+# Point this somewhere else (e.g. adsb_sim.py) to test without the paid API
+BASE_URL = os.environ.get("ADSB_BASE_URL", "https://adsbexchange-com1.p.rapidapi.com")
+URL_REG = BASE_URL + "/v2/registration/"
+URL_HEX = BASE_URL + "/v2/icao/"
+URL_AREA = BASE_URL + "/v2/lat/{lat}/lon/{lon}/dist/{dist}/"
+
+# Batch mode, off unless configured. BATCH_SIZE is the max number of comma separated
+# IDs sent in one multi-ID query, AREAS is a list of "lat,lon,dist" circles separated by ;
+BATCH_SIZE = int(os.environ.get("FT_ADSB_BATCH_SIZE", 0))
+AREAS = [
+    tuple(float(part) for part in area.split(","))
+    for area in os.environ.get("FT_ADSB_AREAS", "").split(";")
+    if area.strip()
+]
+
+# Response cache, lookups of the same airframe within CACHE_TTL seconds share a response
+CACHE_TTL = float(os.environ.get("FT_ADSB_CACHE_TTL", 60))
+CACHE_SIZE = int(os.environ.get("FT_ADSB_CACHE_SIZE", 4096))
 
 headers = {
     "X-RapidAPI-Key": os.environ.get('ADSB_API_KEY'),
@@ -36,47 +59,251 @@ adLog.propagate = False
 # Add the console handler to the logger
 adLog.addHandler(handler)
 
-class FlightData:
-    """Handles ADBS Data"""
 
-    # Identifier
-    hex_id = ""
-    registration = ""
-    flight_num = ""
+def set_base_url(base_url: str) -> None:
+    """Send every ADSB request to base_url instead"""
+    global BASE_URL, URL_REG, URL_HEX, URL_AREA
+    BASE_URL = base_url.rstrip("/")
+    URL_REG = BASE_URL + "/v2/registration/"
+    URL_HEX = BASE_URL + "/v2/icao/"
+    URL_AREA = BASE_URL + "/v2/lat/{lat}/lon/{lon}/dist/{dist}/"
+
+
+def is_awake() -> bool:
+    """Only check during awake time"""
+    return datetime.now().hour in awakeTime
+
+
+def request_error(err: Exception) -> dict:
+    """
+    Wraps a failed request in the same shape ADSB uses for errors, so callers only
+    have to look for the message field. Transient marks it as the provider's
+    fault rather than the ID's
+    """
+    return {"message": f"Request failed: {err}", "transient": True}
+
+
+class ResponseCache:
+    """
+    Bounded TTL cache of ADSB responses with LRU eviction. Entries are keyed on the
+    hex ID, registrations are mapped onto their hex as soon as a response shows both
+    so hex and registration lookups of the same airframe end up in one entry
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL, max_size: int = CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (time stored, response), oldest first
+        self.entries = OrderedDict()
+        # registration -> hex, least recently used first and bounded like the entries
+        self.aliases = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, hex_id: str, registration: str) -> str:
+        """Canonical key for an airframe, falls back to the registration until it's resolved"""
+        if hex_id:
+            return hex_id.lower()
+        reg = registration.upper()
+        hex_id = self.aliases.get(reg)
+        if hex_id is None:
+            return "reg:" + reg
+        self.aliases.move_to_end(reg)
+        return hex_id
+
+    def get(self, key: str) -> json:
+        """Cached response for key, or None if it's missing or expired"""
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, j_resp: json) -> None:
+        """Store a response, errors are never cached"""
+        if not isinstance(j_resp, dict) or "message" in j_resp:
+            return
+        # Learn hex <-> registration from the response, then store under the hex
+        for ac in j_resp.get("ac") or []:
+            if ac.get("hex") and ac.get("r"):
+                reg = str(ac["r"]).upper()
+                self.aliases[reg] = str(ac["hex"]).lower()
+                self.aliases.move_to_end(reg)
+        # Area queries teach us about far more airframes than we track, don't keep them forever
+        while len(self.aliases) > self.max_size:
+            self.aliases.popitem(last=False)
+        if key.startswith("reg:"):
+            key = self.aliases.get(key[4:], key)
+        self.entries[key] = (time.monotonic(), j_resp)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.aliases.clear()
+
+    def stats(self) -> dict:
+        """Hit and miss counts, useful for tuning the TTL"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.entries),
+            "aliases": len(self.aliases),
+        }
+
+
+response_cache = ResponseCache()
+# Concurrent lookups of the same airframe share one request
+in_flight = http_client.SingleFlight()
+
+
+def endpoint_name(url: str) -> str:
+    """Metrics label for an ADSB URL"""
+    if url.startswith(URL_HEX):
+        return "adsb_icao"
+    if url.startswith(URL_REG):
+        return "adsb_registration"
+    return "adsb_area"
+
+
+def count_errors(endpoint: str, j_resp: json) -> json:
+    if not isinstance(j_resp, dict) or "message" in j_resp:
+        metrics.adsb_error_responses.inc(endpoint=endpoint)
+    return j_resp
+
+
+def response_json(response) -> json:
+    """Body of an ADSB response, errors from a struggling upstream are marked transient"""
+    j_resp = response.json()
+    if (response.status_code == 429 or response.status_code >= 500) and isinstance(j_resp, dict):
+        j_resp.setdefault("message", f"HTTP {response.status_code}")
+        j_resp["transient"] = True
+    return j_resp
 
-    # AeroInfo data
-    flight_origin = ""
-    flight_destination = ""
-    landing_time = datetime.now()
-    # Save the data so we don't have to get it more than once per-flight
-    raw_aero_data = ""
 
-    plane_in_air = False
+def get_json(url: str) -> json:
+    """Blocking ADSB request, errors come back as a message field"""
+    breaker = backoff.breaker("adsb")
+    if not breaker.allow():
+        return backoff.circuit_open("adsb")
+    if not quota.manager().acquire_sync("adsb"):
+        return quota.budget_exhausted("adsb")
+    endpoint = endpoint_name(url)
+    try:
+        response = http_client.get_sync(url, headers=headers, endpoint=endpoint)
+        breaker.record(response.status_code)
+        return count_errors(endpoint, response_json(response))
+    except (http_client.HTTPError, ValueError) as err:
+        breaker.failure()
+        return count_errors(endpoint, request_error(err))
+
+
+async def get_json_async(url: str) -> json:
+    """Non-blocking ADSB request, errors come back as a message field"""
+    breaker = backoff.breaker("adsb")
+    # Turned away before taking a token, an outage shouldn't cost budget
+    if not breaker.allow():
+        return backoff.circuit_open("adsb")
+    if not await quota.manager().acquire("adsb"):
+        return quota.budget_exhausted("adsb")
+    endpoint = endpoint_name(url)
+    try:
+        response = await http_client.get(url, headers=headers, endpoint=endpoint)
+        breaker.record(response.status_code)
+        return count_errors(endpoint, response_json(response))
+    except (http_client.HTTPError, ValueError) as err:
+        breaker.failure()
+        return count_errors(endpoint, request_error(err))
+
+
+AERO_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class FlightData:
+    """Handles ADBS Data"""
+
+    # Slots instead of a __dict__, we can be holding a lot of these
+    __slots__ = (
+        "hex_id",
+        "registration",
+        "flight_num",
+        "flight_origin",
+        "flight_destination",
+        "landing_time",
+        "landing_source",
+        "raw_aero_data",
+        "plane_in_air",
+        "on_ground_at",
+    )
 
     def __init__(self, fl_id: str, is_reg: bool = False):
         """Class Initializer"""
-        if is_reg:
-            self.registration = fl_id
-        else:
-            self.hex_id = fl_id
+        # Identifier
+        self.hex_id = "" if is_reg else fl_id
+        self.registration = fl_id if is_reg else ""
+        self.flight_num = ""
 
-    def get_raw_adsb_data(self) -> json:
-        """Pulls Adsb Data from API"""
-        response = ""
-        if self.registration:
-            reg = self.registration
-            adLog.info(f"Checking flight info for registration ID: {reg}")
-            local_url_reg = URL_REG + reg + "/"
-            response = requests.get(
-                local_url_reg, headers=headers, timeout=10
-            )
-        else:
+        # AeroInfo data
+        self.flight_origin = ""
+        self.flight_destination = ""
+        # Estimated landing as a naive UTC time, None until FlightAware or eta gives us one
+        self.landing_time = None
+        # Where landing_time came from, "aero" (FlightAware), "local" (eta) or "" for nowhere
+        self.landing_source = ""
+        # Only held between has_aero_data and process_aero_data, the useful fields
+        # are pulled out and the payload is dropped
+        self.raw_aero_data = ""
+
+        self.plane_in_air = False
+        # Epoch seconds we last saw it on the ground, None if we haven't since it was added
+        self.on_ground_at = None
+
+    def adsb_url(self) -> str:
+        """
+        Picks the endpoint to query, hex takes priority over registration. The hex
+        endpoint is the faster one, and the registry can give us the hex up front
+        """
+        if self.hex_id:
             adLog.info(f"Checking flight info for hex ID: {self.hex_id}")
-            local_url_hex = URL_HEX + self.hex_id + "/"
-            response = requests.get(
-                local_url_hex, headers=headers, timeout=10
-            )
-        return response.json()
+            return URL_HEX + self.hex_id + "/"
+        adLog.info(f"Checking flight info for registration ID: {self.registration}")
+        return URL_REG + self.registration + "/"
+
+    def cache_key(self) -> str:
+        return response_cache.key(self.hex_id, self.registration)
+
+    def get_raw_adsb_data(self) -> json:
+        """Pulls Adsb Data from API, blocking wrapper around the shared client"""
+        key = self.cache_key()
+        j_resp = response_cache.get(key)
+        if j_resp is None:
+            j_resp = get_json(self.adsb_url())
+            response_cache.put(key, j_resp)
+        return j_resp
+
+    async def get_raw_adsb_data_async(self) -> json:
+        """
+        Pulls Adsb Data from API without blocking the event loop, if the same
+        airframe is already being fetched we wait for that response instead
+        """
+        key = self.cache_key()
+        j_resp = response_cache.get(key)
+        if j_resp is None:
+            j_resp = await in_flight.run(key, lambda: self.fetch_adsb_async(key))
+        return j_resp
+
+    async def fetch_adsb_async(self, key: str) -> json:
+        """Uncached request, stores the response under key"""
+        j_resp = await get_json_async(self.adsb_url())
+        response_cache.put(key, j_resp)
+        return j_resp
 
     def process_adsb(self, flight_data: json) -> bool:
         """Processes json received from Adsb"""
@@ -109,47 +336,57 @@ class FlightData:
         Checks if a flight is in the air through ADSB, we
         just want to know if it's flying or not
         """
-        # Only check during awake time
-        if datetime.now().hour not in awakeTime:
+        if not is_awake():
+            log.debug("Outside of monitoring hours")
+            return False
+        return self.process_in_the_air(self.get_raw_adsb_data())
+
+    async def in_the_air_async(self) -> bool:
+        """Same as in_the_air, without blocking the event loop"""
+        if not is_awake():
             log.debug("Outside of monitoring hours")
             return False
-        j_resp = self.get_raw_adsb_data()
+        return self.process_in_the_air(await self.get_raw_adsb_data_async())
+
+    def process_in_the_air(self, j_resp: json, state: int | None = None) -> bool:
+        """
+        Decides from an ADSB response whether the plane is flying, state is the
+        classifier's verdict if the whole sweep has already been classified
+        """
+        # Imported here, numpy is most of the startup time of anything that imports this module
+        import classifier
+
         # Try hex_id first
         plane_id = self.registration if self.registration != "" else self.hex_id
         # The message field only pops up when there's an error
         if "message" in j_resp:
-            adLog.info(f"There's an issue with ID {plane_id}: \n {j_resp["message"]}")
+            adLog.info(f"There's an issue with ID {plane_id}: \n {j_resp['message']}")
             return False
-        try:
-            if j_resp["msg"] == "No error" and j_resp["ac"]:
-                altitude = j_resp["ac"][0]["alt_baro"]
-                if (altitude == "ground") or (altitude < 20):
-                    adLog.warn(
-                        f"Plane information is populating but the flight is at altitude: \
-                        {altitude}"
-                    )
-                    return False
-                # If the flight is in the air then we should definit
-                if self.registration == "":
-                    try:
-                        self.registration = j_resp["ac"][0]['r']
-                    except(KeyError):
-                        adLog.error("No registration included...")
-                adLog.info(f"Flight {plane_id} is in the air")
-                return True
-        except(KeyError):
-            # Dump it all if this happens
-            adLog.error(f"There was an error with the logs: \n {j_resp}")
-        adLog.info(
-            f"Nothing reported from {plane_id}, last check at {
-            datetime.fromtimestamp(datetime.now().timestamp())}"
-        )
+        if state is None:
+            state = classifier.classify_one(False, j_resp)
+        if j_resp.get("ac"):
+            if state not in classifier.IN_AIR_STATES:
+                self.on_ground_at = time.time()
+                adLog.warn(
+                    f"Plane information is populating but the flight is at altitude: \
+                    {j_resp['ac'][0].get('alt_baro')}"
+                )
+                return False
+            # If the flight is in the air then we should definit
+            if self.registration == "":
+                try:
+                    self.registration = j_resp["ac"][0]['r']
+                except(KeyError):
+                    adLog.error("No registration included...")
+            adLog.info(f"Flight {plane_id} is in the air")
+            return True
+        adLog.info(f"Nothing reported from {plane_id}, last check at {datetime.now()}")
         return False
 
     def has_aero_data(self) -> bool:
         """Get aeroData from API if it exists"""
         self.raw_aero_data = aero_info.get_aero_data(
-            self.registration, fake_check=False
+            self.registration, fake_check=False, on_ground_at=self.on_ground_at
         )
         # Probably better to just go off registration for getting AeroData
         if self.raw_aero_data == "":
@@ -157,6 +394,28 @@ class FlightData:
             return False
         return True
 
+    async def has_aero_data_async(self) -> bool:
+        """Same as has_aero_data, without blocking the event loop"""
+        self.raw_aero_data = await aero_info.get_aero_data_async(
+            self.registration, fake_check=False, on_ground_at=self.on_ground_at
+        )
+        if self.raw_aero_data == "":
+            adLog.warn("No JSON found")
+            return False
+        return True
+
+    def eta(self) -> float | None:
+        """Estimated landing time in epoch seconds, None if FlightAware didn't give us one"""
+        if self.landing_time is None:
+            return None
+        return calendar.timegm(self.landing_time.timetuple())
+
+    def estimated_on(self) -> str | None:
+        """Estimated landing time in the format FlightAware uses"""
+        if self.landing_time is None:
+            return None
+        return self.landing_time.strftime(AERO_DATE_FORMAT)
+
     def process_aero_data(self) -> bool:
         """
         Pull useful data from AeroData, return false if we can't find the fields for
@@ -168,38 +427,59 @@ class FlightData:
             self.flight_destination = curr_flight["destination"]["name"]
             # Landing time will be defined as the estimated runway arrival time as this
             # should be closer to the correct time than scheduled
-            date_format = "%Y-%m-%dT%H:%M:%SZ"
             self.landing_time = (
-                datetime.strptime(curr_flight["estimated_on"], date_format)
-                if "estimated_on" in curr_flight
-                else datetime.now()
+                datetime.strptime(curr_flight["estimated_on"], AERO_DATE_FORMAT)
+                if curr_flight.get("estimated_on")
+                else None
             )
+            self.landing_source = "aero" if self.landing_time else ""
             return True
-        except (IndexError, ValueError):
+        except (IndexError, KeyError, TypeError, ValueError):
             adLog.error(f"Couldn't process data for ID {self.hex_id}")
             return False
+        finally:
+            # Everything we need has been pulled out
+            self.raw_aero_data = ""
+
+    def clear_leg(self) -> None:
+        """Forget the last leg's origin, destination and landing time, call on takeoff"""
+        self.flight_origin = ""
+        self.flight_destination = ""
+        self.landing_time = None
+        self.landing_source = ""
 
     def is_plane_on_ground(self) -> bool:
         """Checks if flight is registered to have landed or not"""
-        j_resp = self.get_raw_adsb_data()
+        return self.process_on_ground(self.get_raw_adsb_data())
+
+    async def is_plane_on_ground_async(self) -> bool:
+        """Same as is_plane_on_ground, without blocking the event loop"""
+        return self.process_on_ground(await self.get_raw_adsb_data_async())
+
+    def process_on_ground(self, j_resp: json, state: int | None = None) -> bool:
+        """
+        Decides from an ADSB response whether the plane has landed, state is the
+        classifier's verdict if the whole sweep has already been classified
+        """
+        import classifier
+
         plane_id = self.registration
         if "message" in j_resp:
-            adLog.error(f"There's an issue with ID {plane_id} ... {j_resp["message"]}")
+            adLog.error(f"There's an issue with ID {plane_id} ... {j_resp['message']}")
             return False
-        if j_resp["msg"] == "No error":
-            if j_resp["ac"]:
-                # alt_baro will read "Ground" if it's on the ground, will publish altitute otherwise
-                altitude = j_resp["ac"][0]["alt_baro"]
-                if (altitude == "ground") or (altitude < 20):
-                    adLog.info(f"Plane {self.registration} has landed, altitude: {altitude}")
-                    return True
-            # At this point in the logic, we assume that we've gotten usable information in the past 
-            # TODO, Find a better way to check this.
-            elif j_resp["ac"] == None or j_resp["ac"] == "":
-                # Flight has most likely landed and we just missed it landing
-                adLog.warn(f"Plane {self.registration} has stopped publishing information to ADSB")
-                return True
-        return False
+        if state is None:
+            state = classifier.classify_one(True, j_resp, landing_eta=self.eta())
+        if state == classifier.SIGNAL_LOST:
+            adLog.warn(f"Plane {plane_id} has stopped publishing, waiting before calling it landed")
+        if state != classifier.LANDED:
+            return False
+        self.on_ground_at = time.time()
+        if j_resp.get("ac"):
+            adLog.info(f"Plane {plane_id} has landed, altitude: {j_resp['ac'][0].get('alt_baro')}")
+        else:
+            # Flight has most likely landed and we just missed it landing
+            adLog.warn(f"Plane {plane_id} has stopped publishing information to ADSB")
+        return True
 
     def set_hex(self, hex_id: str):
         """Set hex ID"""
@@ -208,3 +488,119 @@ class FlightData:
     def set_registration(self, reg: str):
         """Set registration"""
         self.registration = reg
+
+
+def batch_enabled() -> bool:
+    """Whether sweeps should go through get_batch_adsb_data_async"""
+    return BATCH_SIZE > 1 or bool(AREAS)
+
+
+def single_response(ac: dict | None) -> dict:
+    """Shapes one aircraft pulled out of a batch like a per-ID response"""
+    return {"msg": "No error", "ac": [ac] if ac else []}
+
+
+def match_aircraft(ac_list: list, flights: dict) -> dict:
+    """
+    Splits an ac array back out to {id: ac} for the given {id: FlightData},
+    matching on hex first and registration second
+    """
+    by_hex = {flight.hex_id.lower(): fid for fid, flight in flights.items() if flight.hex_id}
+    by_reg = {
+        flight.registration.upper(): fid for fid, flight in flights.items() if flight.registration
+    }
+    matched = {}
+    for ac in ac_list or []:
+        fid = by_hex.get(str(ac.get("hex", "")).lower())
+        if fid is None:
+            fid = by_reg.get(str(ac.get("r", "")).upper())
+        if fid is not None and fid not in matched:
+            matched[fid] = ac
+    return matched
+
+
+def chunked(items: list, size: int) -> list:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def get_batch_adsb_data_async(flights: dict, concurrency: int = 10) -> dict:
+    """
+    Fetches many aircraft with as few requests as possible, returns {id: response}
+    where each response looks like a per-ID lookup. Area queries go first, anything
+    they didn't see goes into multi-ID queries (hex when known, registration otherwise)
+    and anything a batch call couldn't cover falls back to a per-ID fetch
+    """
+    results = {}
+    pending = {}
+    # Aliases of an airframe we're already fetching, id -> id being fetched
+    duplicates = {}
+    first_by_key = {}
+    for fid, flight in flights.items():
+        key = flight.cache_key()
+        if key in first_by_key:
+            duplicates[fid] = first_by_key[key]
+            continue
+        j_resp = response_cache.get(key)
+        if j_resp is None:
+            first_by_key[key] = fid
+            pending[fid] = flight
+        else:
+            results[fid] = j_resp
+    fetched = set(pending)
+    limit = asyncio.Semaphore(concurrency)
+
+    async def limited(url: str) -> json:
+        async with limit:
+            return await get_json_async(url)
+
+    async def limited_flight(flight: FlightData) -> json:
+        key = flight.cache_key()
+        async with limit:
+            return await in_flight.run(key, lambda: flight.fetch_adsb_async(key))
+
+    # Area queries, one call covers everything near a base
+    area_urls = [URL_AREA.format(lat=lat, lon=lon, dist=int(dist)) for lat, lon, dist in AREAS]
+    for url, j_resp in zip(area_urls, await asyncio.gather(*(limited(url) for url in area_urls))):
+        if "message" in j_resp:
+            adLog.warning(f"Area query failed: {j_resp['message']}")
+            continue
+        for fid, ac in match_aircraft(j_resp.get("ac"), pending).items():
+            results[fid] = single_response(ac)
+            del pending[fid]
+
+    # Multi-ID queries
+    if BATCH_SIZE > 1 and pending:
+        hex_ids = [fid for fid, flight in pending.items() if flight.hex_id]
+        reg_ids = [fid for fid, flight in pending.items() if not flight.hex_id and flight.registration]
+        batches = [
+            (URL_HEX + ",".join(pending[fid].hex_id for fid in chunk) + "/", chunk)
+            for chunk in chunked(hex_ids, BATCH_SIZE)
+        ] + [
+            (URL_REG + ",".join(pending[fid].registration for fid in chunk) + "/", chunk)
+            for chunk in chunked(reg_ids, BATCH_SIZE)
+        ]
+        adLog.info(f"Checking {len(hex_ids) + len(reg_ids)} aircraft in {len(batches)} requests")
+        responses = await asyncio.gather(*(limited(url) for url, _ in batches))
+        for (_, chunk), j_resp in zip(batches, responses):
+            if "message" in j_resp or j_resp.get("msg") != "No error":
+                # Leave them pending so they get fetched one at a time
+                adLog.warning(f"Multi-ID query failed: {j_resp.get('message', j_resp.get('msg'))}")
+                continue
+            matched = match_aircraft(j_resp.get("ac"), {fid: pending[fid] for fid in chunk})
+            for fid in chunk:
+                # Not in the response means it isn't publishing, same as a per-ID lookup
+                results[fid] = single_response(matched.get(fid))
+                del pending[fid]
+
+    # Per-ID fallback
+    if pending:
+        fallback_ids = list(pending)
+        responses = await asyncio.gather(
+            *(limited_flight(pending[fid]) for fid in fallback_ids)
+        )
+        results.update(zip(fallback_ids, responses))
+    for fid in fetched:
+        response_cache.put(flights[fid].cache_key(), results[fid])
+    for fid, primary in duplicates.items():
+        results[fid] = results[primary]
+    return results
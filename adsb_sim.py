@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# flighttracker/adsb_sim.py
+
+"""
+Local stand-in for the ADSB Exchange and FlightAware APIs, serves thousands of
+synthetic aircraft flying scripted takeoff/landing timelines so the bot can be
+load tested without paying for requests.
+
+Usage: ./adsb_sim.py --aircraft 2000 --port 8990 --latency 0.05 --error-rate 0.01
+
+Point the bot at it with ADSB_BASE_URL/FLIGHT_AWARE_BASE_URL=http://127.0.0.1:8990
+Besides the API paths it serves /_stats (requests per endpoint) and /_timeline
+(wall clock takeoff/landing time per aircraft)
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import logging as log
+import math
+import random
+import time
+from urllib.parse import unquote
+
+smLog = log.getLogger("adsb_sim")
+
+# Enable logging
+smLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+smLog.propagate = False
+
+# Add the console handler to the logger
+smLog.addHandler(handler)
+
+# (name, lat, lon), enough to give the synthetic flights somewhere to go
+AIRPORTS = [
+    ("Boston Logan Intl", 42.3656, -71.0096),
+    ("Teterboro", 40.8501, -74.0608),
+    ("Washington Dulles Intl", 38.9531, -77.4565),
+    ("Chicago Midway Intl", 41.7868, -87.7522),
+    ("Palm Beach Intl", 26.6832, -80.0956),
+    ("Dallas Love Field", 32.8471, -96.8518),
+    ("Denver Centennial", 39.5701, -104.8493),
+    ("Van Nuys", 34.2098, -118.4898),
+    ("Scottsdale", 33.6229, -111.9105),
+    ("Nashville Intl", 36.1263, -86.6774),
+]
+
+CRUISE_ALT = 41000
+CRUISE_GS = 430
+# Share of the flight spent climbing and descending
+CLIMB_SHARE = 0.15
+DESCENT_SHARE = 0.2
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+@dataclass
+class SimAircraft:
+    """One synthetic aircraft and its timeline, times are wall clock epoch seconds"""
+
+    hex_id: str
+    registration: str
+    origin: tuple
+    destination: tuple
+    takeoff: float
+    landing: float
+    # How long it sits on the ground publishing before takeoff and after landing
+    taxi: float
+
+    def ac(self, now: float) -> dict | None:
+        """ADSB ac entry at time now, None while it isn't publishing"""
+        base = {"hex": self.hex_id, "r": self.registration, "flight": self.registration + " ", "t": "C56X"}
+        if self.takeoff - self.taxi <= now < self.takeoff:
+            return {**base, "alt_baro": "ground", "gs": 8.0, "lat": self.origin[1], "lon": self.origin[2], "seen": 0.1}
+        if self.landing <= now < self.landing + self.taxi:
+            return {
+                **base, "alt_baro": "ground", "gs": 12.0,
+                "lat": self.destination[1], "lon": self.destination[2], "seen": 0.1,
+            }
+        if not self.takeoff <= now < self.landing:
+            return None
+        frac = (now - self.takeoff) / (self.landing - self.takeoff)
+        duration = self.landing - self.takeoff
+        if frac < CLIMB_SHARE:
+            alt = CRUISE_ALT * frac / CLIMB_SHARE
+            rate = CRUISE_ALT / (duration * CLIMB_SHARE) * 60
+        elif frac > 1 - DESCENT_SHARE:
+            alt = CRUISE_ALT * (1 - frac) / DESCENT_SHARE
+            rate = -CRUISE_ALT / (duration * DESCENT_SHARE) * 60
+        else:
+            alt, rate = CRUISE_ALT, 0.0
+        lat = self.origin[1] + (self.destination[1] - self.origin[1]) * frac
+        lon = self.origin[2] + (self.destination[2] - self.origin[2]) * frac
+        track = math.degrees(math.atan2(self.destination[2] - self.origin[2], self.destination[1] - self.origin[1])) % 360
+        return {
+            **base, "alt_baro": int(alt), "gs": CRUISE_GS * min(1.0, 0.4 + frac * 4), "baro_rate": int(rate),
+            "lat": lat, "lon": lon, "track": track, "seen": 0.5,
+        }
+
+    def aero_flight(self, now: float) -> dict:
+        """FlightAware flight entry for the current leg"""
+        if now < self.takeoff:
+            status = "Scheduled"
+        elif now < self.landing:
+            status = "En Route / On Time"
+        else:
+            status = "Arrived / Gate Arrival"
+        return {
+            "ident": self.registration,
+            "fa_flight_id": f"{self.registration}-{int(self.takeoff)}-adhoc-0",
+            "registration": self.registration,
+            "status": status,
+            "origin": {"name": self.origin[0]},
+            "destination": {"name": self.destination[0]},
+            "actual_off": time.strftime(DATE_FORMAT, time.gmtime(self.takeoff)),
+            "estimated_on": time.strftime(DATE_FORMAT, time.gmtime(self.landing)),
+        }
+
+
+def build_fleet(count: int, start: float, speed: float, seed: int = 1) -> list:
+    """
+    Synthetic fleet, takeoffs spread over the first half hour and flights lasting 20 to
+    60 minutes, all in simulated time. speed compresses it, 60 means a sim minute per second
+    """
+    rng = random.Random(seed)
+    fleet = []
+    for i in range(count):
+        origin, destination = rng.sample(AIRPORTS, 2)
+        takeoff = start + rng.uniform(60, 30 * 60) / speed
+        landing = takeoff + rng.uniform(20 * 60, 60 * 60) / speed
+        fleet.append(SimAircraft(
+            hex_id=f"{0xa00000 + i:06x}",
+            registration=f"N{i}SM",
+            origin=origin,
+            destination=destination,
+            takeoff=takeoff,
+            landing=landing,
+            taxi=10 * 60 / speed,
+        ))
+    return fleet
+
+
+def load_script(path: str, start: float) -> list:
+    """
+    Fleet from a JSON list of {hex, reg, takeoff, landing} where the times are seconds
+    after start, origin/destination are optional airport names from AIRPORTS
+    """
+    by_name = {airport[0]: airport for airport in AIRPORTS}
+    with open(path, encoding="utf-8") as script:
+        entries = json.load(script)
+    return [
+        SimAircraft(
+            hex_id=entry["hex"].lower(),
+            registration=entry["reg"],
+            origin=by_name.get(entry.get("origin"), AIRPORTS[0]),
+            destination=by_name.get(entry.get("destination"), AIRPORTS[1]),
+            takeoff=start + entry["takeoff"],
+            landing=start + entry["landing"],
+            taxi=entry.get("taxi", 60),
+        )
+        for entry in entries
+    ]
+
+
+def distance_nm(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great circle distance in nautical miles"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi, dlmb = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * 3440.065 * math.asin(math.sqrt(a))
+
+
+class Simulator:
+    """Serves the fleet over a bare bones keep-alive HTTP/1.1 server"""
+
+    def __init__(self, fleet: list, latency: float = 0.0, error_rate: float = 0.0, seed: int = 1):
+        self.fleet = fleet
+        self.by_hex = {plane.hex_id: plane for plane in fleet}
+        self.by_reg = {plane.registration.upper(): plane for plane in fleet}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = {}
+        self.errors = 0
+
+    def count(self, endpoint: str) -> None:
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def adsb(self, planes: list, now: float) -> dict:
+        ac = [entry for entry in (plane.ac(now) for plane in planes) if entry]
+        return {"ac": ac, "msg": "No error", "now": int(now * 1000), "total": len(ac), "ctime": int(now * 1000)}
+
+    def route(self, path: str) -> tuple:
+        """(status, body) for a GET path"""
+        now = time.time()
+        parts = [unquote(part) for part in path.split("?")[0].split("/") if part]
+        if parts == ["_stats"]:
+            return 200, {"requests": self.requests, "errors": self.errors}
+        if parts == ["_timeline"]:
+            return 200, {
+                plane.hex_id: {"reg": plane.registration, "takeoff": plane.takeoff, "landing": plane.landing}
+                for plane in self.fleet
+            }
+        if len(parts) >= 3 and parts[0] == "v2" and parts[1] in ("icao", "registration"):
+            self.count("adsb_" + parts[1])
+            if self.rng.random() < self.error_rate:
+                self.errors += 1
+                return 500, {"message": "Simulated upstream error"}
+            ids = parts[2].split(",")
+            if parts[1] == "icao":
+                planes = [self.by_hex[i.lower()] for i in ids if i.lower() in self.by_hex]
+            else:
+                planes = [self.by_reg[i.upper()] for i in ids if i.upper() in self.by_reg]
+            return 200, self.adsb(planes, now)
+        if len(parts) == 7 and parts[:2] == ["v2", "lat"]:
+            self.count("adsb_area")
+            lat, lon, dist = float(parts[2]), float(parts[4]), float(parts[6])
+            planes = []
+            for plane in self.fleet:
+                ac = plane.ac(now)
+                if ac and distance_nm(lat, lon, ac["lat"], ac["lon"]) <= dist:
+                    planes.append(plane)
+            return 200, self.adsb(planes, now)
+        if len(parts) == 3 and parts[:2] == ["aeroapi", "flights"]:
+            self.count("aero")
+            if self.rng.random() < self.error_rate:
+                self.errors += 1
+                return 500, {"title": "Simulated upstream error"}
+            plane = self.by_reg.get(parts[2].upper())
+            flights = [plane.aero_flight(now)] if plane else []
+            return 200, {"flights": flights}
+        return 404, {"message": f"Unknown path {path}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = True
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    if header.lower().startswith(b"connection:") and b"close" in header.lower():
+                        keep_alive = False
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+                if self.latency and not path.startswith("/_"):
+                    # Jittered around the configured latency
+                    await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+                status, body = self.route(path)
+                payload = json.dumps(body).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> asyncio.Server:
+        server = await asyncio.start_server(self.handle, host, port)
+        smLog.info(f"Simulating {len(self.fleet)} aircraft on http://{host}:{port}")
+        return server
+
+
+async def run(args: argparse.Namespace) -> None:
+    start = time.time()
+    fleet = load_script(args.script, start) if args.script else build_fleet(args.aircraft, start, args.speed, args.seed)
+    sim = Simulator(fleet, args.latency, args.error_rate, args.seed)
+    server = await sim.serve(args.host, args.port)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8990)
+    parser.add_argument("--aircraft", type=int, default=1000, help="size of the synthetic fleet")
+    parser.add_argument("--speed", type=float, default=60, help="sim seconds per wall clock second")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean response delay in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail")
+    parser.add_argument("--script", help="JSON timeline to use instead of a generated fleet")
+    parser.add_argument("--seed", type=int, default=1)
+    try:
+        asyncio.run(run(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
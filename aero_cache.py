@@ -0,0 +1,137 @@
+# flighttracker/aero_cache.py
+
+"""
+Disk backed cache of FlightAware leg data, so a restart in the middle of a flight
+or re-adding an aircraft doesn't pay for the same leg twice
+"""
+
+import calendar
+import logging as log
+import os
+import sqlite3
+import time
+
+acLog = log.getLogger("aero_cache")
+
+# Enable logging
+acLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+acLog.propagate = False
+
+# Add the console handler to the logger
+acLog.addHandler(handler)
+
+DB_PATH = os.environ.get("FT_AERO_CACHE_DB", "aero_legs.sqlite3")
+# How long a leg is kept after its estimated landing time
+LEG_GRACE = float(os.environ.get("FT_AERO_LEG_GRACE", 2 * 60 * 60))
+# How long a leg is kept when FlightAware didn't give a landing time
+LEG_DEFAULT_TTL = float(os.environ.get("FT_AERO_LEG_TTL", 6 * 60 * 60))
+# Slack between FlightAware's departure time and our last ground sample, their clocks aren't ours
+DEPARTURE_SLACK = 120
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# How long a write waits on another process holding the lock
+BUSY_TIMEOUT_MS = 5000
+
+
+def parse_utc(value: str) -> float | None:
+    """FlightAware timestamp to epoch seconds"""
+    try:
+        return calendar.timegm(time.strptime(value, DATE_FORMAT))
+    except (TypeError, ValueError):
+        return None
+
+
+class LegCache:
+    """Legs keyed by registration and departure, each one expires after it should have landed"""
+
+    def __init__(self, path: str | None = None):
+        self.path = path or DB_PATH
+        # Autocommit with WAL like StateStore, every shard worker writes to the same file, so
+        # a write waits for another process's instead of failing with "database is locked"
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS legs (
+                registration TEXT NOT NULL,
+                departure TEXT NOT NULL,
+                origin TEXT,
+                destination TEXT,
+                estimated_on TEXT,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (registration, departure)
+            )"""
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, registration: str, on_ground_at: float | None = None) -> dict | None:
+        """
+        Latest leg for registration that hasn't expired, shaped like the FlightAware
+        flight it came from so process_aero_data can read it. on_ground_at is when the
+        plane was last seen on the ground, a leg that departed before that is the
+        previous flight (we missed its landing) and isn't used
+        """
+        row = self.conn.execute(
+            """SELECT departure, origin, destination, estimated_on FROM legs
+               WHERE registration = ? AND expires_at > ?
+               ORDER BY departure DESC LIMIT 1""",
+            (registration.upper(), time.time()),
+        ).fetchone()
+        if row is not None and on_ground_at is not None:
+            departed = parse_utc(row[0])
+            if departed is None or departed < on_ground_at - DEPARTURE_SLACK:
+                acLog.info(f"Cached leg for {registration} left before it was last on the ground, not using it")
+                row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        _, origin, destination, estimated_on = row
+        leg = {"origin": {"name": origin}, "destination": {"name": destination}}
+        if estimated_on:
+            leg["estimated_on"] = estimated_on
+        return leg
+
+    def put(self, registration: str, flight: dict) -> None:
+        """Store the useful parts of a FlightAware flight"""
+        departure = (
+            flight.get("actual_off")
+            or flight.get("estimated_off")
+            or flight.get("scheduled_off")
+            or flight.get("fa_flight_id")
+            or ""
+        )
+        estimated_on = flight.get("estimated_on")
+        landing = parse_utc(estimated_on)
+        expires_at = landing + LEG_GRACE if landing else time.time() + LEG_DEFAULT_TTL
+        self.conn.execute(
+            "INSERT OR REPLACE INTO legs VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                registration.upper(),
+                departure,
+                (flight.get("origin") or {}).get("name"),
+                (flight.get("destination") or {}).get("name"),
+                estimated_on,
+                expires_at,
+            ),
+        )
+
+    def expire(self, registration: str) -> None:
+        """The plane landed, its current leg shouldn't be reused for the next one"""
+        self.conn.execute(
+            "UPDATE legs SET expires_at = ? WHERE registration = ? AND expires_at > ?",
+            (time.time(), registration.upper(), time.time()),
+        )
+
+    def prune(self) -> int:
+        """Drop expired legs, returns how many were removed"""
+        removed = self.conn.execute("DELETE FROM legs WHERE expires_at <= ?", (time.time(),)).rowcount
+        return removed
+
+    def close(self) -> None:
+        self.conn.close()
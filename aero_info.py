@@ -8,9 +8,15 @@ import json
 from datetime import timedelta
 import logging as log
 import os
-import requests
 
-URL = "https://aeroapi.flightaware.com/aeroapi/flights/"
+import aero_cache
+import backoff
+import http_client
+import quota
+
+# Point this somewhere else (e.g. adsb_sim.py) to test without the paid API
+BASE_URL = os.environ.get("FLIGHT_AWARE_BASE_URL", "https://aeroapi.flightaware.com")
+URL = BASE_URL + "/aeroapi/flights/"
 headers = {
     "Accept": "application/json; charset=UTF-8",
     "x-apikey": os.environ.get('FLIGHT_AWARE_API_KEY'),
@@ -28,12 +34,113 @@ aeLog.propagate = False
 # Add the console handler to the logger
 aeLog.addHandler(handler)
 
-def get_aero_data(fid: str, fake_check: bool = True) -> json:
-    """Gets data from FlightAware API"""
+def set_base_url(base_url: str) -> None:
+    """Send every FlightAware request to base_url instead"""
+    global BASE_URL, URL
+    BASE_URL = base_url.rstrip("/")
+    URL = BASE_URL + "/aeroapi/flights/"
+
+
+# Concurrent lookups of the same ID share one request
+in_flight = http_client.SingleFlight()
+# Opened on first use so importing this module doesn't touch the disk
+_leg_cache: aero_cache.LegCache | None = None
+
+
+def leg_cache() -> aero_cache.LegCache:
+    """Persistent per-leg cache, expired legs are dropped when it's opened"""
+    global _leg_cache
+    if _leg_cache is None:
+        _leg_cache = aero_cache.LegCache()
+        aeLog.info(f"Dropped {_leg_cache.prune()} expired legs from {_leg_cache.path}")
+    return _leg_cache
+
+
+def cached_leg(fid: str, on_ground_at: float | None = None) -> json:
+    """Leg we already paid for, or None"""
+    leg = leg_cache().get(fid, on_ground_at) if fid else None
+    if leg is not None:
+        aeLog.info(f"Using cached leg for ID -{fid}-")
+    return leg
+
+
+def store_leg(fid: str, result: json) -> None:
+    if fid and result:
+        leg_cache().put(fid, result)
+
+
+def finish_leg(fid: str) -> None:
+    """Call once the plane has landed so the next takeoff gets fresh data"""
+    if fid:
+        leg_cache().expire(fid)
+
+def get_aero_data(fid: str, fake_check: bool = True, on_ground_at: float | None = None) -> json:
+    """
+    Gets data from FlightAware API, blocking wrapper around the shared client.
+    on_ground_at is when the plane was last seen on the ground, see LegCache.get
+    """
     if fake_check:
         return ""
-    response = requests.get(URL + fid, headers=headers, timeout=10)
+    leg = cached_leg(fid, on_ground_at)
+    if leg is not None:
+        return leg
+    breaker = backoff.breaker("aero")
+    if not breaker.allow():
+        aeLog.warning(f"Skipping FlightAware lookup for {fid}, it's been failing")
+        return ""
+    if not quota.manager().acquire_sync("aero"):
+        aeLog.warning(f"Skipping FlightAware lookup for {fid}, budget is running out")
+        return ""
     aeLog.info(f"Checking Flight ID -{fid}-")
+    try:
+        response = http_client.get_sync(URL + fid, headers=headers, endpoint="aero")
+    except http_client.HTTPError as err:
+        breaker.failure()
+        aeLog.error(f"Request for {fid} failed: {err}")
+        return ""
+    breaker.record(response.status_code)
+    result = process_response(fid, response)
+    store_leg(fid, result)
+    return result
+
+
+async def get_aero_data_async(fid: str, fake_check: bool = True, on_ground_at: float | None = None) -> json:
+    """
+    Gets data from FlightAware API without blocking the event loop, if the same
+    ID is already being fetched we wait for that response instead
+    """
+    if fake_check:
+        return ""
+    leg = cached_leg(fid, on_ground_at)
+    if leg is not None:
+        return leg
+    return await in_flight.run(fid, lambda: fetch_aero_data_async(fid))
+
+
+async def fetch_aero_data_async(fid: str) -> json:
+    """Uncached FlightAware request"""
+    breaker = backoff.breaker("aero")
+    if not breaker.allow():
+        aeLog.warning(f"Skipping FlightAware lookup for {fid}, it's been failing")
+        return ""
+    if not await quota.manager().acquire("aero"):
+        aeLog.warning(f"Skipping FlightAware lookup for {fid}, budget is running out")
+        return ""
+    aeLog.info(f"Checking Flight ID -{fid}-")
+    try:
+        response = await http_client.get(URL + fid, headers=headers, endpoint="aero")
+    except http_client.HTTPError as err:
+        breaker.failure()
+        aeLog.error(f"Request for {fid} failed: {err}")
+        return ""
+    breaker.record(response.status_code)
+    result = process_response(fid, response)
+    store_leg(fid, result)
+    return result
+
+
+def process_response(fid: str, response) -> json:
+    """Finds the flight that is currently en route in a FlightAware response"""
     # # Check if the request was successful (status code 200)
     if response.status_code == 200:
         # Parse and work with the JSON response
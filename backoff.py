@@ -0,0 +1,224 @@
+# flighttracker/backoff.py
+
+"""
+Stops us spending sweep time and quota on things that keep failing. IDs that never
+show up on ADSB are polled less and less often, and each provider has a circuit
+breaker that stops sending requests after a run of failures, then lets a single
+probe through now and then to see if it's back
+"""
+
+import logging as log
+import os
+import time
+
+import metrics
+
+boLog = log.getLogger("backoff")
+
+# Enable logging
+boLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+boLog.propagate = False
+
+# Add the console handler to the logger
+boLog.addHandler(handler)
+
+# Wait after an ID's first miss, doubling with every miss in a row up to MISS_MAX
+MISS_BASE = float(os.environ.get("FT_MISS_BACKOFF", 600))
+MISS_MAX = float(os.environ.get("FT_MISS_BACKOFF_MAX", 6 * 60 * 60))
+# Failures in a row that open a provider's breaker, and how long it stays open before
+# a probe, doubling every time the probe fails too
+BREAKER_FAILURES = int(os.environ.get("FT_BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(os.environ.get("FT_BREAKER_COOLDOWN", 30))
+BREAKER_COOLDOWN_MAX = float(os.environ.get("FT_BREAKER_COOLDOWN_MAX", 600))
+
+CLOSED, OPEN, HALF_OPEN = range(3)
+BREAKER_STATES = ("closed", "open", "half-open")
+
+
+class NegativeCache:
+    """
+    IDs that keep coming back with an error or nothing at all, with when they're
+    worth asking about again. A single response with the aircraft in it clears the entry
+    """
+
+    def __init__(self, base: float = MISS_BASE, max_wait: float = MISS_MAX):
+        self.base = base
+        self.max_wait = max_wait
+        # id -> misses in a row
+        self.misses = {}
+        # id -> epoch seconds it can be polled again
+        self.retry_at = {}
+
+    def miss(self, fl_id: str, now: float | None = None, max_wait: float | None = None) -> float:
+        """Count a miss, returns how long to leave the ID alone for, at most max_wait if given"""
+        now = time.time() if now is None else now
+        misses = self.misses.get(fl_id, 0) + 1
+        self.misses[fl_id] = misses
+        cap = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        wait = min(self.base * 2 ** (misses - 1), cap)
+        self.retry_at[fl_id] = now + wait
+        if misses == 1 or wait == cap:
+            boLog.info(f"No data for {fl_id} {misses} times in a row, next try in {wait:.0f}s")
+        return wait
+
+    def hit(self, fl_id: str) -> None:
+        if self.misses.pop(fl_id, None) is not None:
+            boLog.info(f"{fl_id} is publishing again")
+        self.retry_at.pop(fl_id, None)
+
+    def delay(self, fl_id: str, now: float | None = None) -> float:
+        """Seconds until the ID is worth polling again, 0 if it isn't backed off"""
+        retry_at = self.retry_at.get(fl_id)
+        if retry_at is None:
+            return 0.0
+        now = time.time() if now is None else now
+        return max(0.0, retry_at - now)
+
+    def restore(
+        self,
+        fl_id: str,
+        misses: int,
+        delay: float | None = None,
+        now: float | None = None,
+        max_wait: float | None = None,
+    ) -> None:
+        """
+        Pick up a miss count from elsewhere, e.g. a shard snapshot. delay is how long
+        it still had to wait there, worked out from the count (at most max_wait) if not given
+        """
+        self.remove(fl_id)
+        if not misses:
+            return
+        self.misses[fl_id] = misses - 1
+        self.miss(fl_id, now, max_wait)
+        if delay is not None:
+            now = time.time() if now is None else now
+            self.retry_at[fl_id] = now + delay
+
+    def remove(self, fl_id: str) -> None:
+        self.misses.pop(fl_id, None)
+        self.retry_at.pop(fl_id, None)
+
+    def __len__(self) -> int:
+        return len(self.misses)
+
+    def __contains__(self, fl_id: str) -> bool:
+        return fl_id in self.misses
+
+
+def is_miss(j_resp, flight) -> bool:
+    """
+    Whether a response counts against the ID. Errors count unless they were on our
+    side or the provider's (transient), an empty answer only counts while we've never
+    had the airframe's hex and registration, a parked plane we know is left to the usual
+    ground backoff. See is_bad_id for how long each kind is backed off
+    """
+    if not isinstance(j_resp, dict):
+        return False
+    if "message" in j_resp:
+        return not j_resp.get("transient")
+    if j_resp.get("ac"):
+        return False
+    return not (flight.hex_id and flight.registration)
+
+
+def is_bad_id(j_resp) -> bool:
+    """
+    Whether a miss is the ID itself being wrong. Only those get the long backoff, an empty
+    answer for a valid ID may just be a parked plane with its transponder off
+    """
+    return isinstance(j_resp, dict) and "message" in j_resp
+
+
+def is_hit(j_resp) -> bool:
+    return isinstance(j_resp, dict) and "message" not in j_resp and bool(j_resp.get("ac"))
+
+
+class CircuitBreaker:
+    """
+    Closed lets everything through. After BREAKER_FAILURES failures in a row it
+    opens and turns requests away straight away instead of letting every aircraft
+    sit through a timeout. Once the cooldown is up one request is let through as
+    a probe (half-open), its result closes the breaker or opens it for longer
+    """
+
+    def __init__(self, provider: str, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.provider = provider
+        self.max_failures = failures
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        # When the breaker opened, or when the probe went out while half-open
+        self.since = 0.0
+
+    def allow(self, now: float | None = None) -> bool:
+        """Whether a request can go out now, may make it the probe"""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic() if now is None else now
+        # A probe that never reported back (cancelled, say) shouldn't hold it shut forever
+        if now - self.since < self.cooldown:
+            metrics.breaker_rejected.inc(provider=self.provider)
+            return False
+        if self.state == OPEN:
+            boLog.info(f"Probing {self.provider} after {self.cooldown:.0f}s")
+        self.state = HALF_OPEN
+        self.since = now
+        return True
+
+    def success(self) -> None:
+        if self.state != CLOSED:
+            boLog.info(f"{self.provider} is back, closing the breaker")
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def failure(self, now: float | None = None) -> None:
+        now = time.monotonic() if now is None else now
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, BREAKER_COOLDOWN_MAX)
+        elif self.state == CLOSED and self.failures < self.max_failures:
+            return
+        elif self.state == OPEN:
+            # Requests that were already out when it opened
+            return
+        boLog.warning(
+            f"{self.provider} failed {self.failures} times in a row, "
+            f"not sending requests for {self.cooldown:.0f}s"
+        )
+        metrics.breaker_trips.inc(provider=self.provider)
+        self.state = OPEN
+        self.since = now
+
+    def record(self, status: int) -> None:
+        """Count an HTTP response, rate limiting and server errors are failures"""
+        if status == 429 or status >= 500:
+            self.failure()
+        else:
+            self.success()
+
+
+breakers = {provider: CircuitBreaker(provider) for provider in ("adsb", "aero")}
+
+
+def breaker(provider: str) -> CircuitBreaker:
+    return breakers[provider]
+
+
+def circuit_open(provider: str) -> dict:
+    """Same shape as a failed ADSB request, so callers treat it as a failed poll"""
+    return {"message": f"Skipped, {provider} is failing and its circuit breaker is open", "transient": True}
+
+
+def summary() -> str:
+    """One line per provider whose breaker isn't closed, empty when all's well"""
+    return "\n".join(
+        f"{provider} circuit breaker {BREAKER_STATES[cb.state]} after {cb.failures} failures"
+        for provider, cb in breakers.items()
+        if cb.state != CLOSED
+    )
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# flighttracker/batch_check.py
+
+"""
+Checks a list of aircraft once without Telegram, for cron jobs and capacity testing.
+IDs are read one per line from a file or stdin, optionally followed by reg or hex
+(6 hex digits are taken as a hex ID otherwise). Every aircraft is fetched and
+classified with the same code the bot uses, and one JSON line per aircraft is
+written to stdout as soon as it's ready. --stats prints how fast it went and how
+much of the API budget it used to stderr, which makes it a throughput probe.
+
+Usage: ./batch_check.py ids.txt [--concurrency 50] [--batch-size 50] [--stats]
+       cat ids.txt | ./batch_check.py --base-url http://127.0.0.1:8990 > results.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import logging as log
+import re
+import sys
+import time
+
+import adsb_info
+from adsb_info import FlightData
+import http_client
+import metrics
+import poller
+import quota
+
+bcLog = log.getLogger("batch_check")
+
+# Enable logging
+bcLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+bcLog.propagate = False
+
+# Add the console handler to the logger
+bcLog.addHandler(handler)
+
+HEX_ID = re.compile(r"[0-9a-fA-F]{6}")
+
+
+def parse_ids(lines) -> list:
+    """(id, is_reg) for every line, blank lines and # comments are skipped"""
+    ids = []
+    seen = set()
+    for line in lines:
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        fl_id = fields[0]
+        id_type = fields[1].lower() if len(fields) > 1 else ""
+        if id_type not in ("", "reg", "hex"):
+            bcLog.warning(f"Unknown ID type {fields[1]} for {fl_id}, guessing")
+            id_type = ""
+        is_reg = id_type == "reg" or (not id_type and not HEX_ID.fullmatch(fl_id))
+        if not is_reg:
+            fl_id = fl_id.lower()
+        if fl_id in seen:
+            continue
+        seen.add(fl_id)
+        ids.append((fl_id, is_reg))
+    return ids
+
+
+def read_ids(path: str) -> list:
+    if path == "-":
+        return parse_ids(sys.stdin)
+    with open(path, encoding="utf-8") as id_file:
+        return parse_ids(id_file)
+
+
+def classify_chunk(responses: list) -> list:
+    """
+    State of each response without any history. A plane that would count as
+    taking off from the ground is in the air, checked again to tell cruising from descending
+    """
+    # Loaded with the first results rather than at startup, numpy takes a while to import
+    import classifier
+
+    count = len(responses)
+    states = classifier.classify_responses([None] * count, [False] * count, responses)
+    flying = [i for i, state in enumerate(states) if state == classifier.TAKING_OFF]
+    if flying:
+        in_air = classifier.classify_responses(
+            [None] * len(flying), [True] * len(flying), [responses[i] for i in flying]
+        )
+        for i, state in zip(flying, in_air):
+            states[i] = state
+    return states
+
+
+def check_result(fl_id: str, flight: FlightData, j_resp: json, state: int, seconds: float) -> dict:
+    """What gets written for one aircraft"""
+    import classifier
+
+    result = {"id": fl_id, "hex": flight.hex_id, "reg": flight.registration}
+    if j_resp is None or poller.is_failed_response(j_resp):
+        result["state"] = "error"
+        result["error"] = j_resp.get("message", "no response") if isinstance(j_resp, dict) else "no response"
+    elif not j_resp.get("ac"):
+        # Not publishing, either parked with the transponder off or blocked
+        result["state"] = "not found"
+    else:
+        ac = j_resp["ac"][0]
+        result["hex"] = str(ac.get("hex", flight.hex_id)).lower()
+        result["reg"] = ac.get("r", flight.registration)
+        result["flight"] = str(ac.get("flight", "")).strip()
+        result["state"] = classifier.STATE_NAMES[state]
+        result["in_air"] = state in classifier.IN_AIR_STATES
+        for field in ("alt_baro", "gs", "track", "baro_rate", "lat", "lon", "seen"):
+            if field in ac:
+                result[field] = ac[field]
+    result["seconds"] = round(seconds, 3)
+    return result
+
+
+async def check_all(ids: list, concurrency: int, batch_size: int, out) -> dict:
+    """
+    Fetch and classify every (id, is_reg), writing results as they come in. Up to
+    concurrency chunks are in flight at once, a chunk is one ID unless batch_size
+    is over 1. Returns counts by state
+    """
+    counts = {}
+    chunks = adsb_info.chunked(ids, max(batch_size, 1))
+    queue = asyncio.Queue()
+    for chunk in chunks:
+        queue.put_nowait(chunk)
+
+    async def fetch(flights: dict) -> dict:
+        if batch_size > 1:
+            return await adsb_info.get_batch_adsb_data_async(flights, 1)
+        fl_id, flight = next(iter(flights.items()))
+        return {fl_id: await flight.get_raw_adsb_data_async()}
+
+    async def worker():
+        while not queue.empty():
+            chunk = queue.get_nowait()
+            flights = {fl_id: FlightData(fl_id, is_reg) for fl_id, is_reg in chunk}
+            started = time.perf_counter()
+            try:
+                responses = await fetch(flights)
+            except Exception as err:  # pylint: disable=broad-except
+                bcLog.error(f"Fetching {len(flights)} aircraft failed: {err}")
+                responses = {}
+            seconds = time.perf_counter() - started
+            ordered = [responses.get(fl_id) for fl_id in flights]
+            states = classify_chunk(ordered)
+            for (fl_id, flight), j_resp, state in zip(flights.items(), ordered, states):
+                result = check_result(fl_id, flight, j_resp, state, seconds)
+                out.write(json.dumps(result) + "\n")
+                counts[result["state"]] = counts.get(result["state"], 0) + 1
+            # A pipe into another program shouldn't see results in big lumps
+            out.flush()
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(chunks)))))
+    return counts
+
+
+def report(checked: int, counts: dict, elapsed: float) -> str:
+    """Throughput and budget summary for --stats"""
+    requests = metrics.upstream_requests.total()
+    lines = [
+        f"Checked {checked} aircraft in {elapsed:.2f}s, {checked / max(elapsed, 1e-9):.1f} aircraft/s, "
+        f"{requests:.0f} upstream requests ({requests / max(elapsed, 1e-9):.1f}/s)",
+        ", ".join(f"{name}: {count}" for name, count in sorted(counts.items())),
+    ]
+    for endpoint in sorted({key[0] for key in metrics.upstream_seconds.series}):
+        lines.append(
+            f"{endpoint}: p50 {metrics.upstream_seconds.quantile(0.5, endpoint=endpoint) * 1000:.0f}ms "
+            f"p95 {metrics.upstream_seconds.quantile(0.95, endpoint=endpoint) * 1000:.0f}ms"
+        )
+    waited = metrics.quota_wait_seconds.count(provider="adsb")
+    if waited:
+        lines.append(
+            f"Rate limit wait p50 {metrics.quota_wait_seconds.quantile(0.5, provider='adsb'):.2f}s "
+            f"p95 {metrics.quota_wait_seconds.quantile(0.95, provider='adsb'):.2f}s"
+        )
+    rejected = metrics.quota_rejected.total()
+    if rejected:
+        lines.append(f"{rejected:.0f} requests skipped, the monthly budget is down to its reserve")
+    lines.append(quota.manager().summary())
+    return "\n".join(lines)
+
+
+async def run(args: argparse.Namespace) -> None:
+    ids = read_ids(args.file)
+    if args.base_url:
+        adsb_info.set_base_url(args.base_url)
+    # Every aircraft gets fetched, areas would only add requests on top
+    adsb_info.AREAS = []
+    adsb_info.BATCH_SIZE = args.batch_size
+    http_client.configure(max_per_host=args.concurrency, max_connections=args.concurrency * 2)
+    if args.no_limits:
+        for limits in quota.LIMITS.values():
+            limits.rate = 0
+    # Routine checks by default, so a big run can't eat into the landing check reserve
+    quota.priority.set(quota.PRIORITY_NAMES.index(args.priority))
+    bcLog.info(f"Checking {len(ids)} aircraft")
+    started = time.perf_counter()
+    try:
+        counts = await check_all(ids, args.concurrency, args.batch_size, sys.stdout)
+    finally:
+        await http_client.aclose()
+    if args.stats:
+        print(report(len(ids), counts, time.perf_counter() - started), file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("file", nargs="?", default="-", help="file with one ID per line, - or nothing for stdin")
+    parser.add_argument("--concurrency", type=int, default=poller.SWEEP_CONCURRENCY)
+    parser.add_argument(
+        "--batch-size", type=int, default=adsb_info.BATCH_SIZE, help="IDs per multi-ID query, 0 for per ID"
+    )
+    parser.add_argument("--base-url", help="send ADSB requests here instead, e.g. adsb_sim.py")
+    parser.add_argument("--priority", choices=quota.PRIORITY_NAMES, default="ground")
+    parser.add_argument("--no-limits", action="store_true", help="ignore the per second rate limits")
+    parser.add_argument("--stats", action="store_true", help="print throughput and budget used to stderr")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the per aircraft INFO logs")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # Thousands of "Checking flight info" lines would bury the summary
+        for name in ("adsb_info", "aero_info", "http_client", "quota", "poller", "httpx"):
+            log.getLogger(name).setLevel(log.WARNING)
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # Piped into head or similar, nothing left to write to
+        pass
+
+
+if __name__ == "__main__":
+    main()
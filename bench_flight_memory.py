@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# flighttracker/bench_flight_memory.py
+
+"""
+Measures memory per tracked aircraft, FlightData plus its flight_dict aliases,
+next to the old layout that kept a __dict__ and the raw FlightAware payload.
+
+Usage: ./bench_flight_memory.py [count ...]   (defaults to 10000 100000)
+"""
+
+from datetime import datetime
+import gc
+import sys
+import tracemalloc
+
+from adsb_info import FlightData
+import multi_key_dict
+
+
+def sample_aero_flight(i: int) -> dict:
+    """Roughly the size of one entry in an AeroAPI flights response"""
+    airport = {
+        "code": "KBOS", "code_icao": "KBOS", "code_iata": "BOS", "code_lid": "BOS",
+        "timezone": "America/New_York", "name": "Logan Intl", "city": "Boston",
+        "airport_info_url": "/airports/KBOS",
+    }
+    return {
+        "ident": f"N{i}", "ident_icao": None, "ident_iata": None, "fa_flight_id": f"N{i}-1700000000-adhoc-0",
+        "operator": None, "operator_icao": None, "operator_iata": None, "flight_number": None,
+        "registration": f"N{i}", "atc_ident": None, "inbound_fa_flight_id": None, "codeshares": [],
+        "codeshares_iata": [], "blocked": False, "diverted": False, "cancelled": False,
+        "position_only": False, "origin": dict(airport), "destination": dict(airport),
+        "departure_delay": 0, "arrival_delay": 0, "filed_ete": 3600, "progress_percent": 40,
+        "status": "En Route / On Time", "aircraft_type": "C56X", "route_distance": 400,
+        "filed_airspeed": 430, "filed_altitude": 410, "route": None, "baggage_claim": None,
+        "seats_cabin_business": None, "seats_cabin_coach": None, "seats_cabin_first": None,
+        "gate_origin": None, "gate_destination": None, "terminal_origin": None,
+        "terminal_destination": None, "type": "General_Aviation",
+        "scheduled_out": "2026-10-17T12:00:00Z", "estimated_out": "2026-10-17T12:00:00Z",
+        "actual_out": "2026-10-17T12:02:00Z", "scheduled_off": "2026-10-17T12:10:00Z",
+        "estimated_off": "2026-10-17T12:10:00Z", "actual_off": "2026-10-17T12:12:00Z",
+        "scheduled_on": "2026-10-17T13:10:00Z", "estimated_on": "2026-10-17T13:12:00Z",
+        "actual_on": None, "scheduled_in": "2026-10-17T13:20:00Z",
+        "estimated_in": "2026-10-17T13:22:00Z", "actual_in": None, "foresight_predictions_available": False,
+    }
+
+
+class LegacyFlightData:
+    """The old layout, instance __dict__ with the raw payload kept around"""
+
+    def __init__(self, fl_id: str):
+        self.hex_id = fl_id
+        self.registration = ""
+        self.flight_num = ""
+        self.flight_origin = ""
+        self.flight_destination = ""
+        self.landing_time = datetime.now()
+        self.raw_aero_data = ""
+        self.plane_in_air = False
+
+
+def populate(count: int, legacy: bool) -> multi_key_dict.MultiKeyDict:
+    flights = multi_key_dict.MultiKeyDict()
+    for i in range(count):
+        hex_id = f"{i:06x}"
+        aero = sample_aero_flight(i)
+        flight = LegacyFlightData(hex_id) if legacy else FlightData(hex_id)
+        flight.registration = f"N{i}"
+        flight.flight_num = f"N{i}"
+        flight.raw_aero_data = aero
+        if legacy:
+            flight.flight_origin = aero["origin"]["name"]
+            flight.flight_destination = aero["destination"]["name"]
+        else:
+            flight.process_aero_data()
+        flight.plane_in_air = True
+        flights.add_mapping(flight, hex_id, flight.registration)
+    return flights
+
+
+def measure(count: int, legacy: bool) -> float:
+    """Bytes per aircraft still allocated once the store is built"""
+    gc.collect()
+    tracemalloc.start()
+    flights = populate(count, legacy)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del flights
+    return current / count
+
+
+def main(counts: list) -> None:
+    print(f"{'aircraft':>10} {'FlightData B/ac':>16} {'legacy B/ac':>12} {'saved':>7}")
+    for count in counts:
+        compact = measure(count, legacy=False)
+        legacy = measure(count, legacy=True)
+        print(f"{count:>10} {compact:>16.0f} {legacy:>12.0f} {1 - compact / legacy:>7.0%}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
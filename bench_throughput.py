@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# flighttracker/bench_throughput.py
+
+"""
+End to end throughput benchmark, runs the real takeoff and landing sweeps against
+adsb_sim.py and reports sweep time, upstream requests per sweep, how long after
+the simulated takeoff/landing the notification went out, and peak memory.
+
+Usage: ./bench_throughput.py --aircraft 2000 --duration 120 [--batch-size 50]
+"""
+
+import argparse
+import asyncio
+import logging as log
+import re
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import adsb_info
+from adsb_info import FlightData
+import aero_cache
+import aero_info
+import flight_bot
+import http_client
+import metrics
+import poller
+import quota
+
+
+class RecordingBot:
+    """Stands in for telegram.Bot, keeps every message with the time it was sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id: int, text: str) -> None:
+        self.sent.append((time.time(), chat_id, text))
+
+
+class BenchContext:
+    """Just enough of ContextTypes.DEFAULT_TYPE for the sweeps"""
+
+    def __init__(self):
+        self.bot = RecordingBot()
+
+
+def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Simulator didn't come up on port {port}")
+
+
+def start_simulator(args: argparse.Namespace) -> subprocess.Popen:
+    sim = subprocess.Popen([
+        sys.executable, "adsb_sim.py",
+        "--port", str(args.port),
+        "--aircraft", str(args.aircraft),
+        "--speed", str(args.speed),
+        "--latency", str(args.latency),
+        "--error-rate", str(args.error_rate),
+        "--seed", str(args.seed),
+    ])
+    wait_for_port(args.port)
+    return sim
+
+
+async def sim_json(base_url: str, path: str) -> dict:
+    return (await http_client.get(base_url + path)).json()
+
+
+def track_fleet(timeline: dict, chats: int) -> None:
+    """Load every simulated aircraft into the bot as a recurring hex ID, followed by chats 1 to chats"""
+    flight_bot.active_flight_list.clear()
+    for hex_id, entry in timeline.items():
+        flight = FlightData(hex_id)
+        flight.registration = entry["reg"]
+        flight_bot.flight_dict.add_mapping(flight, hex_id, entry["reg"])
+        flight_bot.active_flight_list[hex_id] = ["hex", True]
+        for chat_id in range(1, chats + 1):
+            flight_bot.subscribers.subscribe(chat_id, hex_id, True)
+
+
+def notification_delays(sent: list, timeline: dict) -> tuple:
+    """Seconds between each simulated takeoff/landing and the message about it to the first chat"""
+    takeoffs, landings = [], []
+    for sent_at, chat_id, text in sent:
+        if chat_id != 1:
+            continue
+        # Events close together come as one digest
+        for match in re.finditer(r"Flight (\w+) is in air", text):
+            if match.group(1) in timeline:
+                takeoffs.append(sent_at - timeline[match.group(1)]["takeoff"])
+        for match in re.finditer(r"Plane (\w+) has landed", text):
+            if match.group(1) in timeline:
+                landings.append(sent_at - timeline[match.group(1)]["landing"])
+    return takeoffs, landings
+
+
+def describe(values: list) -> str:
+    if not values:
+        return "n/a"
+    arr = np.asarray(values)
+    return (
+        f"n={len(arr)} p50={np.percentile(arr, 50):.2f}s "
+        f"p95={np.percentile(arr, 95):.2f}s max={arr.max():.2f}s"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    base_url = f"http://127.0.0.1:{args.port}"
+    adsb_info.set_base_url(base_url)
+    aero_info.set_base_url(base_url)
+    # Watch around the clock, and don't let cached responses hide a state change
+    adsb_info.awakeTime = range(0, 24)
+    adsb_info.response_cache.ttl = args.interval / 2
+    adsb_info.BATCH_SIZE = args.batch_size
+    aero_cache.DB_PATH = ":memory:"
+    # Measuring our own throughput, not the quotas
+    quota.DB_PATH = ":memory:"
+    for limits in quota.LIMITS.values():
+        limits.rate = limits.monthly = 0
+    http_client.configure(max_per_host=args.concurrency, max_connections=args.concurrency * 2)
+    poller.SWEEP_CONCURRENCY = args.concurrency
+
+    timeline = await sim_json(base_url, "/_timeline")
+    track_fleet(timeline, args.chats)
+    context = BenchContext()
+
+    sweep_times, requests_per_sweep = [], []
+    before = sum((await sim_json(base_url, "/_stats"))["requests"].values())
+    deadline = time.time() + args.duration
+    while time.time() < deadline:
+        started = time.perf_counter()
+        await asyncio.gather(
+            flight_bot.check_in_air(context, flight_bot.tracked_flights(airborne=False)),
+            flight_bot.plane_has_landed(context, flight_bot.tracked_flights(airborne=True)),
+        )
+        elapsed = time.perf_counter() - started
+        sweep_times.append(elapsed)
+        after = sum((await sim_json(base_url, "/_stats"))["requests"].values())
+        requests_per_sweep.append(after - before)
+        before = after
+        await asyncio.sleep(max(0.0, args.interval - elapsed))
+    if flight_bot.sender is not None:
+        await flight_bot.sender.close()
+    await http_client.aclose()
+
+    takeoffs, landings = notification_delays(context.bot.sent, timeline)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"aircraft:            {args.aircraft} ({'batch ' + str(args.batch_size) if args.batch_size > 1 else 'per ID'})")
+    print(f"sweeps:              {len(sweep_times)}, {describe(sweep_times)}")
+    print(f"requests per sweep:  mean {np.mean(requests_per_sweep):.0f}, max {max(requests_per_sweep)}")
+    print(f"takeoff notified:    {describe(takeoffs)}")
+    print(f"landing notified:    {describe(landings)}")
+    print(f"messages sent:       {len(context.bot.sent)} to {args.chats} chats (events are merged into digests)")
+    print(f"peak RSS:            {peak_kb / 1024:.1f} MiB")
+    print(metrics.summary())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--aircraft", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=100, help="wall clock seconds to run")
+    parser.add_argument("--interval", type=float, default=2, help="seconds between sweeps")
+    parser.add_argument("--speed", type=float, default=60, help="simulator speed factor")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--batch-size", type=int, default=0, help="multi-ID query size, 0 for per ID")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--chats", type=int, default=1, help="chats following every aircraft")
+    parser.add_argument("--port", type=int, default=8990)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # Per flight INFO logs would drown out the results
+    for name in ("adsb_info", "aero_info", "aero_cache", "flight_bot", "poller", "httpx"):
+        log.getLogger(name).setLevel(log.WARNING)
+    sim = start_simulator(args)
+    try:
+        asyncio.run(run(args))
+    finally:
+        sim.terminate()
+        sim.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# flighttracker/classifier.py
+
+"""
+Decides whether each aircraft is on the ground, taking off, airborne, descending,
+has landed or has dropped off ADSB. A whole sweep is classified at once
+"""
+
+import json
+import logging as log
+import os
+import time
+
+import numpy as np
+
+clLog = log.getLogger("classifier")
+
+# Enable logging
+clLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+clLog.propagate = False
+
+# Add the console handler to the logger
+clLog.addHandler(handler)
+
+ON_GROUND, TAKING_OFF, AIRBORNE, DESCENDING, LANDED, SIGNAL_LOST = range(6)
+STATE_NAMES = ("on-ground", "taking off", "airborne", "descending", "landed", "signal lost")
+# States where the plane counts as flying
+IN_AIR_STATES = (TAKING_OFF, AIRBORNE, DESCENDING, SIGNAL_LOST)
+
+# Hysteresis, a plane has to climb past AIR_ALT to count as flying but only counts
+# as landed once it's reported on the ground or below GROUND_ALT (ft)
+AIR_ALT = float(os.environ.get("FT_CLASSIFY_AIR_ALT", 200))
+GROUND_ALT = float(os.environ.get("FT_CLASSIFY_GROUND_ALT", 20))
+# Below this ground speed (kt) and under AIR_ALT it's taxiing
+GROUND_SPEED = float(os.environ.get("FT_CLASSIFY_GROUND_SPEED", 40))
+# Vertical rate (ft/min) under which an airborne plane counts as descending
+DESCENT_RATE = float(os.environ.get("FT_CLASSIFY_DESCENT_RATE", -300))
+# A plane that stops publishing while low or descending is called landed once it's had
+# time to get down from where it was last seen, LOST_MIN_WAIT (s) plus its altitude over
+# its descent rate, never longer than LOST_LANDED_AFTER. That's also the wait when we know
+# nothing about it, or it was climbing out. Planes last seen high and level are only given
+# up on after LOST_GIVE_UP
+LOST_MIN_WAIT = float(os.environ.get("FT_CLASSIFY_LOST_MIN_WAIT", 120))
+LOST_LANDED_AFTER = float(os.environ.get("FT_CLASSIFY_LOST_AFTER", 900))
+LOST_LOW_ALT = float(os.environ.get("FT_CLASSIFY_LOST_LOW_ALT", 3000))
+LOST_GIVE_UP = float(os.environ.get("FT_CLASSIFY_LOST_GIVE_UP", 3 * 60 * 60))
+# Typical descent (ft/min) on an approach, for a plane last seen low without much of a vertical rate
+APPROACH_RATE = 700
+# Window (s) the track history is averaged over when the last sample had no vertical rate
+RATE_WINDOW = 120
+
+
+def classify(
+    in_air: np.ndarray,
+    failed: np.ndarray,
+    has_data: np.ndarray,
+    ground: np.ndarray,
+    alt: np.ndarray,
+    gs: np.ndarray,
+    vert_rate: np.ndarray,
+    lost_for: np.ndarray,
+    last_alt: np.ndarray,
+    last_vert_rate: np.ndarray,
+) -> np.ndarray:
+    """
+    Classify every aircraft in one pass. in_air is what we believed before this poll,
+    failed/has_data/ground/alt/gs/vert_rate come from this poll (NaN when missing) and
+    the last_* fields and lost_for (seconds since the last sample, or since it first
+    went missing if we've never had one, NaN if we can't say) come from the track history.
+    A failed request tells us nothing, so the plane keeps its previous state
+    """
+    # NaN compares False everywhere, so missing fields never trigger a transition
+    with np.errstate(invalid="ignore"):
+        enters_air = has_data & ~ground & (alt >= AIR_ALT)
+        leaves_air = has_data & (
+            ground | (alt < GROUND_ALT) | ((gs < GROUND_SPEED) & (alt < AIR_ALT))
+        )
+        descending = vert_rate <= DESCENT_RATE
+        was_descending = last_vert_rate <= DESCENT_RATE
+        was_climbing = last_vert_rate >= -DESCENT_RATE
+        unknown = np.isnan(last_alt) & np.isnan(last_vert_rate)
+        # Time to get down from the last altitude, NaN (so the full wait) when climbing or unknown
+        rate = np.where(was_descending, -last_vert_rate, APPROACH_RATE)
+        to_ground = np.where(was_climbing, np.nan, np.maximum(last_alt, 0) / rate * 60)
+        wait = np.fmin(to_ground + LOST_MIN_WAIT, LOST_LANDED_AFTER)
+        could_land = (last_alt < LOST_LOW_ALT) | was_descending | unknown
+        gave_up = lost_for >= LOST_GIVE_UP
+
+    return np.select(
+        [
+            ~in_air & enters_air,
+            ~in_air,
+            in_air & failed,
+            in_air & leaves_air,
+            in_air & has_data & descending,
+            in_air & has_data,
+            in_air & ((could_land & (lost_for >= wait)) | gave_up),
+        ],
+        [TAKING_OFF, ON_GROUND, AIRBORNE, LANDED, DESCENDING, AIRBORNE, LANDED],
+        default=SIGNAL_LOST,
+    ).astype(np.int8)
+
+
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def response_columns(responses: list) -> dict:
+    """Pull the fields classify needs out of a list of ADSB responses"""
+    count = len(responses)
+    failed = np.zeros(count, dtype=bool)
+    has_data = np.zeros(count, dtype=bool)
+    ground = np.zeros(count, dtype=bool)
+    alt = np.full(count, np.nan)
+    gs = np.full(count, np.nan)
+    vert_rate = np.full(count, np.nan)
+    for i, j_resp in enumerate(responses):
+        # The message field only pops up when there's an error
+        if not isinstance(j_resp, dict) or "message" in j_resp:
+            failed[i] = True
+            continue
+        if not j_resp.get("ac"):
+            continue
+        ac = j_resp["ac"][0]
+        has_data[i] = True
+        altitude = ac.get("alt_baro")
+        # alt_baro will read "ground" if it's on the ground
+        ground[i] = altitude == "ground"
+        alt[i] = 0.0 if ground[i] else _number(altitude)
+        gs[i] = _number(ac.get("gs"))
+        vert_rate[i] = _number(ac.get("baro_rate", ac.get("geom_rate")))
+    return {"failed": failed, "has_data": has_data, "ground": ground, "alt": alt, "gs": gs, "vert_rate": vert_rate}
+
+
+def classify_responses(
+    keys: list, in_air: list, responses: list, tracks=None, now: float | None = None
+) -> list:
+    """
+    Classify a sweep, keys/in_air/responses line up by position and tracks is the
+    TrackStore holding their history under those keys. Returns the states in order
+    """
+    now = time.time() if now is None else now
+    columns = response_columns(responses)
+    count = len(keys)
+    if tracks is not None and count:
+        latest = tracks.latest(keys)
+        # Never seen (restored after a restart, say) counts from when it first came back
+        # empty, not from forever ago. NaN until then, so it can't be called landed yet
+        since = np.where(np.isnan(latest["time"]), tracks.missing_since(keys), latest["time"])
+        lost_for = now - since
+        last_alt, last_vert_rate = latest["alt"], latest["vert_rate"]
+        # Not every feed sends a vertical rate, work it out from the altitudes instead
+        for i in np.flatnonzero(np.isnan(last_vert_rate) & ~np.isnan(latest["time"])):
+            last_vert_rate[i] = tracks.vertical_rate(keys[i], RATE_WINDOW, now=latest["time"][i])
+    else:
+        # No history at all, we can't tell how long it's been gone
+        lost_for = np.full(count, np.nan)
+        last_alt = np.full(count, np.nan)
+        last_vert_rate = np.full(count, np.nan)
+    states = classify(
+        np.asarray(in_air, dtype=bool),
+        lost_for=lost_for,
+        last_alt=last_alt,
+        last_vert_rate=last_vert_rate,
+        **columns,
+    )
+    return states.tolist()
+
+
+def classify_one(
+    in_air: bool, j_resp: json, landing_eta: float | None = None, now: float | None = None
+) -> int:
+    """
+    Single response without any history, used by the per-flight checks. Without a
+    track we can't time a dropout, so a plane that goes quiet within LOST_LANDED_AFTER
+    of its estimated landing (epoch seconds) is taken to have landed
+    """
+    now = time.time() if now is None else now
+    state = classify_responses([None], [in_air], [j_resp], now=now)[0]
+    if state == SIGNAL_LOST and landing_eta is not None and now >= landing_eta - LOST_LANDED_AFTER:
+        return LANDED
+    return state
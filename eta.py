@@ -0,0 +1,271 @@
+# flighttracker/eta.py
+
+"""
+Local landing time estimates, so we don't have to pay FlightAware for one. The
+ADSB position, ground speed and track are checked against a table of airports to
+pick where the plane is most likely heading, and the great circle distance left
+over the ground speed gives the time to landing. A plane descending towards an
+airport gives a confident answer. One climbing out or cruising along only gives a
+guess, good enough to schedule the landing checks by as long as one airport
+clearly stands out, and FlightAware only gets asked when none does
+"""
+
+import csv
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import logging as log
+import os
+import re
+import time
+
+import numpy as np
+
+import classifier
+import metrics
+
+etLog = log.getLogger("eta")
+
+# Enable logging
+etLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+etLog.propagate = False
+
+# Add the console handler to the logger
+etLog.addHandler(handler)
+
+# Airports bundled next to this file. It only has ~140 airports, the big US ones, the main
+# business jet fields and a few abroad, so a plane heading for anything smaller gets pinned to
+# whichever of those is on the way. That's why estimates never replace FlightAware's unless
+# they agree on the airport. Point this at the OurAirports airports.csv for the full list
+AIRPORTS_PATH = os.environ.get("FT_AIRPORTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "airports.csv"))
+# How far off the current track (degrees) an airport can be and still be where it's going
+CONE = float(os.environ.get("FT_ETA_CONE", 20))
+# Estimates under this confidence (0 to 1) fall back to FlightAware
+CONFIDENCE = float(os.environ.get("FT_ETA_CONFIDENCE", 0.6))
+# Longest leg we'd consider, in hours at the current ground speed
+MAX_HOURS = float(os.environ.get("FT_ETA_MAX_HOURS", 8))
+# Slower than this (kt) the track doesn't say much, it's still climbing out or taxiing
+MIN_GROUND_SPEED = 80
+# Without a descent to go on, the best a guess can do. Under CONFIDENCE on purpose
+CRUISE_CONFIDENCE = 0.5
+# Distance (in hours at the current ground speed) over which a guess's preference for nearer airports falls off
+CRUISE_HOURS = 1
+# A guess is still used to schedule the landing checks if the runner up airport scores
+# under this fraction of the pick, above it the candidates are too close to call
+AMBIGUOUS = float(os.environ.get("FT_ETA_AMBIGUOUS", 0.8))
+# Within this many nm of an airport the bearing to it is too jumpy to be worth checking
+OVERHEAD = 5
+EARTH_RADIUS_NM = 3440.065
+# Only bother saving a new estimate if it moved by more than this many seconds
+REFRESH_SECONDS = 60
+# Left out when comparing airport names, FlightAware and the table don't agree on them
+GENERIC_WORDS = {"airport", "intl", "international", "regional", "rgnl", "municipal", "muni", "field", "county"}
+
+
+@dataclass
+class Estimate:
+    """Where a plane is probably landing and when"""
+
+    ident: str
+    name: str
+    distance_nm: float
+    remaining: float
+    # Naive UTC like FlightData.landing_time
+    landing_time: datetime
+    confidence: float
+    # Score of the next best airport over the pick's, 0 if nothing else was in the running
+    runner_up: float = 0.0
+
+    @property
+    def confident(self) -> bool:
+        return self.confidence >= CONFIDENCE
+
+    @property
+    def clear(self) -> bool:
+        """Whether the pick stands out enough to schedule by, even if it's only a guess"""
+        return self.confident or self.runner_up < AMBIGUOUS
+
+
+class AirportTable:
+    """Airport coordinates as arrays, so every airport is checked in one pass"""
+
+    def __init__(self, idents: list, names: list, lat: list, lon: list):
+        self.idents = idents
+        self.names = names
+        self.lat = np.radians(np.asarray(lat, dtype=float))
+        self.lon = np.radians(np.asarray(lon, dtype=float))
+
+    def __len__(self) -> int:
+        return len(self.idents)
+
+    def distance_and_bearing(self, lat: float, lon: float) -> tuple:
+        """Great circle distance (nm) and initial bearing (degrees) from a point to every airport"""
+        phi1, lmb1 = np.radians(lat), np.radians(lon)
+        dphi, dlmb = self.lat - phi1, self.lon - lmb1
+        a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(self.lat) * np.sin(dlmb / 2) ** 2
+        distance = 2 * EARTH_RADIUS_NM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        y = np.sin(dlmb) * np.cos(self.lat)
+        x = np.cos(phi1) * np.sin(self.lat) - np.sin(phi1) * np.cos(self.lat) * np.cos(dlmb)
+        bearing = np.degrees(np.arctan2(y, x)) % 360
+        return distance, bearing
+
+
+def load_airports(path: str = AIRPORTS_PATH) -> AirportTable:
+    """
+    Reads ident, name, latitude_deg and longitude_deg columns. If there's a type
+    column (the OurAirports file) only medium and large airports are kept, small
+    strips would be candidates under nearly every track
+    """
+    idents, names, lat, lon = [], [], [], []
+    with open(path, encoding="utf-8", newline="") as table:
+        for row in csv.DictReader(table):
+            if row.get("type") and row["type"] not in ("medium_airport", "large_airport"):
+                continue
+            try:
+                lat.append(float(row["latitude_deg"]))
+                lon.append(float(row["longitude_deg"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            idents.append(row.get("ident", ""))
+            names.append(row.get("name", ""))
+    etLog.info(f"Loaded {len(idents)} airports from {path}")
+    return AirportTable(idents, names, lat, lon)
+
+
+# Loaded on first use
+_airports: AirportTable | None = None
+
+
+def airports() -> AirportTable:
+    global _airports
+    if _airports is None:
+        try:
+            _airports = load_airports()
+        except OSError as err:
+            # Everything goes to FlightAware like before
+            etLog.error(f"Couldn't load airports, no local estimates: {err}")
+            _airports = AirportTable([], [], [], [])
+    return _airports
+
+
+def _number(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate(ac: dict, now: float | None = None, table: AirportTable | None = None) -> Estimate | None:
+    """
+    Best guess at where an ADSB ac entry is landing, None if there's nothing to
+    go on (no position, too slow, or no airport ahead of it)
+    """
+    now = time.time() if now is None else now
+    lat, lon = _number(ac.get("lat")), _number(ac.get("lon"))
+    gs, track = _number(ac.get("gs")), _number(ac.get("track"))
+    if None in (lat, lon, gs, track) or gs < MIN_GROUND_SPEED:
+        return None
+    table = airports() if table is None else table
+    if not len(table):
+        return None
+    distance, bearing = table.distance_and_bearing(lat, lon)
+    off_track = np.abs((bearing - track + 180) % 360 - 180)
+    overhead = distance < OVERHEAD
+    candidates = ((off_track <= CONE) | overhead) & (distance <= gs * MAX_HOURS)
+    if not candidates.any():
+        metrics.eta_estimates.inc(outcome="none")
+        return None
+    # Dead ahead scores 1, falling away towards the edge of the cone
+    aligned = np.where(overhead, 1.0, np.exp(-((off_track / (CONE / 2)) ** 2)))
+    alt = ac.get("alt_baro")
+    alt = None if alt == "ground" else _number(alt)
+    vert_rate = _number(ac.get("baro_rate", ac.get("geom_rate")))
+    descending = alt is not None and vert_rate is not None and vert_rate <= classifier.DESCENT_RATE
+    if descending:
+        # At this rate it reaches the ground after about this far, the airport it's heading for should be near there
+        expected = gs * (alt / -vert_rate) / 60
+        # Level offs and slowing down stretch a real descent out, so it gets plenty of slack
+        fit = np.exp(-(((distance - expected) / (0.5 * expected + OVERHEAD)) ** 2))
+    else:
+        # Nothing says how far it's going, so nearer airports are favoured. That errs towards the
+        # landing checks starting early rather than late, refresh moves it on as they're passed
+        fit = np.exp(-distance / (gs * CRUISE_HOURS))
+    score = np.where(candidates, aligned * fit, 0.0)
+    best = int(np.argmax(score))
+    if score[best] <= 0:
+        metrics.eta_estimates.inc(outcome="none")
+        return None
+    # How much better the pick is than the alternatives, times how well it fits by itself
+    confidence = score[best] / score.sum() * aligned[best] * (fit[best] if descending else CRUISE_CONFIDENCE)
+    runner_up = np.partition(score, -2)[-2] / score[best] if len(score) > 1 else 0.0
+    remaining = float(distance[best]) / gs * 3600
+    result = Estimate(
+        ident=table.idents[best],
+        name=table.names[best],
+        distance_nm=float(distance[best]),
+        remaining=remaining,
+        landing_time=datetime.fromtimestamp(now + remaining, timezone.utc).replace(tzinfo=None),
+        confidence=float(confidence),
+        runner_up=float(runner_up),
+    )
+    metrics.eta_estimates.inc(outcome="confident" if result.confident else "guess" if result.clear else "unsure")
+    return result
+
+
+def estimate_response(j_resp, now: float | None = None) -> Estimate | None:
+    """estimate() for a whole ADSB response"""
+    if not isinstance(j_resp, dict) or "message" in j_resp or not j_resp.get("ac"):
+        return None
+    return estimate(j_resp["ac"][0], now)
+
+
+def airport_key(name: str) -> str:
+    """An airport name without the generic words, so Denver Intl and Denver International Airport match"""
+    words = re.findall(r"[a-z0-9]+", name.casefold())
+    return " ".join(word for word in words if word not in GENERIC_WORDS)
+
+
+def same_airport(result: Estimate, destination: str) -> bool:
+    """Whether an estimate picked the destination we already have, by ident or name"""
+    if not destination:
+        return False
+    if result.ident and result.ident.casefold() in destination.casefold().split():
+        return True
+    ours, theirs = airport_key(result.name), airport_key(destination)
+    return bool(ours and theirs) and (ours in theirs or theirs in ours)
+
+
+def apply(flight, result: Estimate) -> bool:
+    """
+    Use an estimate for a flight's landing time, and its destination if we don't
+    have one. A FlightAware time is only replaced if the estimate is for the same
+    airport, the table may just not have the one it's really going to. Returns True
+    if the landing time moved enough to be worth saving
+    """
+    if flight.landing_source == "aero" and not same_airport(result, flight.flight_destination):
+        return False
+    if not flight.flight_destination:
+        flight.flight_destination = result.name
+    if flight.landing_source != "aero":
+        flight.landing_source = "local"
+    previous = flight.landing_time
+    flight.landing_time = result.landing_time
+    return previous is None or abs((result.landing_time - previous).total_seconds()) > REFRESH_SECONDS
+
+
+def refresh(flight, j_resp, now: float | None = None) -> bool:
+    """
+    Update an airborne flight's landing time from a poll if the local estimate is
+    confident, or keep a guess we made earlier up to date while it still stands
+    out. Returns True if it changed
+    """
+    result = estimate_response(j_resp, now)
+    if result is None or not (result.confident or (flight.landing_source == "local" and result.clear)):
+        return False
+    etLog.debug(
+        f"{flight.hex_id} heading for {result.ident}, {result.distance_nm:.0f}nm "
+        f"and {result.remaining / 60:.0f} minutes out ({result.confidence:.0%} sure)"
+    )
+    return apply(flight, result)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# flighttracker/feed_replay.py
+
+"""
+Plays a recorded dump1090 feed back over TCP, so streaming mode can be tested
+without a receiver. Record one with `nc <receiver> 30003 > feed.sbs` (or 30005 for
+Beast), or use --simulate to make one up from the adsb_sim.py fleet.
+
+Usage: ./feed_replay.py --file feed.sbs [--format beast] [--speed 10] [--loop]
+       ./feed_replay.py --simulate 500 --sim-speed 60
+"""
+
+import argparse
+import asyncio
+from datetime import datetime
+import logging as log
+import time
+
+import adsb_feed
+import adsb_sim
+
+rpLog = log.getLogger("feed_replay")
+
+# Enable logging
+rpLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+rpLog.propagate = False
+
+# Add the console handler to the logger
+rpLog.addHandler(handler)
+
+# Beast timestamps are a 12MHz counter
+BEAST_CLOCK = 12_000_000
+
+
+def sbs_time(line: bytes) -> float | None:
+    """When a BaseStation line was generated, fields 6 and 7"""
+    fields = line.split(b",", 8)
+    if len(fields) < 8:
+        return None
+    try:
+        stamp = datetime.strptime((fields[6] + b" " + fields[7]).decode(), "%Y/%m/%d %H:%M:%S.%f")
+    except ValueError:
+        return None
+    return stamp.timestamp()
+
+
+def sbs_frames(data: bytes) -> list:
+    """(time or None, line) for every line of a recording"""
+    return [(sbs_time(line), line + b"\n") for line in data.splitlines() if line.strip()]
+
+
+def beast_frames(data: bytes) -> list:
+    """(time or None, raw frame) for every frame of a recording, escapes left in place"""
+    frames = []
+    buf = bytearray(data)
+    pos = 0
+    while True:
+        start = buf.find(adsb_feed.BEAST_ESCAPE, pos)
+        if start < 0 or start + 1 >= len(buf):
+            break
+        length = adsb_feed.BEAST_LENGTHS.get(buf[start + 1])
+        if length is None:
+            pos = start + 1
+            continue
+        frame, end = adsb_feed.unescape(buf, start + 2, adsb_feed.BEAST_HEADER + length)
+        if frame is None:
+            if end < 0:
+                pos = start + 1
+                continue
+            break
+        frames.append((int.from_bytes(frame[:6], "big") / BEAST_CLOCK, bytes(buf[start:end])))
+        pos = end
+    return frames
+
+
+async def play(frames: list, writer: asyncio.StreamWriter, speed: float, loop: bool) -> None:
+    """Write frames at their recorded pace, ones without a time go out straight away"""
+    while True:
+        started = time.monotonic()
+        first = next((stamp for stamp, _ in frames if stamp is not None), None)
+        for stamp, frame in frames:
+            if stamp is not None and first is not None:
+                delay = (stamp - first) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await writer.drain()
+                    await asyncio.sleep(delay)
+            writer.write(frame)
+        await writer.drain()
+        if not loop:
+            return
+
+
+def sbs_line(ac: dict, transmission: int, now: float) -> bytes:
+    """BaseStation line for a simulated ac entry"""
+    stamp = datetime.fromtimestamp(now)
+    date, clock = stamp.strftime("%Y/%m/%d"), stamp.strftime("%H:%M:%S.%f")[:-3]
+    ground = ac.get("alt_baro") == "ground"
+    fields = ["MSG", str(transmission), "1", "1", ac["hex"].upper(), "1", date, clock, date, clock]
+    callsign = alt = gs = track = lat = lon = vert_rate = ""
+    if transmission == 1:
+        callsign = ac.get("flight", "").strip()
+    elif transmission in (2, 3):
+        alt = "" if ground else str(ac.get("alt_baro", ""))
+        lat, lon = f"{ac['lat']:.5f}", f"{ac['lon']:.5f}"
+    elif transmission == 4:
+        gs, track = f"{ac.get('gs', 0):.0f}", f"{ac.get('track', 0):.0f}"
+        vert_rate = str(ac.get("baro_rate", 0))
+    fields += [callsign, alt, gs, track, lat, lon, vert_rate, "", "0", "0", "0", "-1" if ground else "0"]
+    return (",".join(fields) + "\r\n").encode()
+
+
+async def simulate(fleet: list, writer: asyncio.StreamWriter) -> None:
+    """Live SBS for the simulated fleet, a position and a velocity message per aircraft per second"""
+    while True:
+        now = time.time()
+        for plane in fleet:
+            ac = plane.ac(now)
+            if ac is None:
+                continue
+            transmission = 2 if ac.get("alt_baro") == "ground" else 3
+            writer.write(sbs_line(ac, transmission, now) + sbs_line(ac, 4, now))
+        await writer.drain()
+        await asyncio.sleep(max(0.0, 1 - (time.time() - now)))
+
+
+async def run(args: argparse.Namespace) -> None:
+    frames = []
+    fleet = []
+    if args.simulate:
+        fleet = adsb_sim.build_fleet(args.simulate, time.time(), args.sim_speed, args.seed)
+    else:
+        with open(args.file, "rb") as recording:
+            data = recording.read()
+        frames = beast_frames(data) if args.format == "beast" else sbs_frames(data)
+        rpLog.info(f"Loaded {len(frames)} frames from {args.file}")
+
+    async def client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        rpLog.info(f"Client connected from {writer.get_extra_info('peername')}")
+        try:
+            if fleet:
+                await simulate(fleet, writer)
+            else:
+                await play(frames, writer, args.speed, args.loop)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(client, args.host, args.port)
+    rpLog.info(f"Replaying on {args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", help="recorded feed")
+    source.add_argument("--simulate", type=int, help="make up SBS for this many simulated aircraft")
+    parser.add_argument("--format", choices=("sbs", "beast"), default="sbs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=30003)
+    parser.add_argument("--speed", type=float, default=1, help="playback speed of a recording")
+    parser.add_argument("--loop", action="store_true")
+    parser.add_argument("--sim-speed", type=float, default=60, help="adsb_sim.py speed factor")
+    parser.add_argument("--seed", type=int, default=1)
+    try:
+        asyncio.run(run(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
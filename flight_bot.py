@@ -4,26 +4,102 @@
 Pulls and sends flight information through Telegram when selected flights are in the air
 """
 
+from __future__ import annotations
+
 import asyncio
+import json
 import logging as log
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
-from tzlocal import get_localzone
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+import time
+from typing import TYPE_CHECKING
 
+import adsb_feed
+import adsb_info
 from adsb_info import FlightData
+import aero_info
+import backoff
+import classifier
+import eta
+import http_client
+import metrics
 import multi_key_dict
+import outbox
+import poller
+import quota
+import registry
+import scheduler
+import shards
+import state_store
+import subscriptions
+import track_history
+
+# Telegram and tzlocal are only imported once they're needed, so tools that reuse the
+# sweeps (shard workers, the benchmarks) start quickly and run without them
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
 
 fLog = log.getLogger("flight_bot")
-# ID of where you're sending the telegram message from
-TEST_GROUP_ID = 0
 has_started = False
+# Longest /start waits for the startup lookups before it starts polling anyway
+WARMUP_DEADLINE = float(os.environ.get("FT_WARMUP_DEADLINE", 30))
 
 # Flight data storage, can access data with both hex and registration
 flight_dict = multi_key_dict.MultiKeyDict()
 # List of flights actively being monitored: {id : [idType, isRecurring]}
+# isRecurring is true while any chat following the flight wants it recurring
 active_flight_list = {"a1013f": ["hex", True], "N621MM": ["reg", True]}
+# Which chats follow which IDs in active_flight_list
+subscribers = subscriptions.SubscriptionIndex()
+# Decides when each flight is polled next
+poll_scheduler = scheduler.PollScheduler()
+# Loop polling flights as they come due, started by /start or at boot if state was restored
+poll_task: asyncio.Task | None = None
+# Set once polling is running, here or in the shards
+polling = False
+# Flights restore_state loaded at boot, their landing checks shouldn't wait for /start
+restored_flights = 0
+# Set once every ID from the startup list has been looked up, see wait_until_warm
+warmed_up = asyncio.Event()
+# IDs the startup lookups couldn't resolve: {id: why}
+warm_up_failures = {}
+# Recent position samples per airframe
+track_store = track_history.TrackStore()
+# Durable copy of the two above, opened in main
+state: state_store.StateStore | None = None
+# Prometheus endpoint, started once the bot is up if FT_METRICS_PORT is set
+metrics_server = None
+# Local receiver feed, read in the background if FT_FEED_HOST is set
+feed = adsb_feed.FeedIngest()
+feed_task: asyncio.Task | None = None
+# Worker processes doing the polling if FT_SHARDS is set
+coordinator: shards.Coordinator | None = None
+# Set inside a shard worker, takeoffs and landings go to the bot process through it
+event_sink = None
+# Takeoff and landing messages are merged and paced through here, made on first use
+sender: outbox.Outbox | None = None
+
+# Sampled whenever the metrics are scraped
+metrics.Gauge("ft_tracked_aircraft", "IDs in the active flight list", fn=lambda: len(active_flight_list))
+metrics.Gauge("ft_subscribed_chats", "Chats following at least one aircraft", fn=subscribers.chat_count)
+metrics.Gauge(
+    "ft_telegram_queued", "Messages waiting to go to Telegram", fn=lambda: sender.queued() if sender else 0
+)
+metrics.Gauge(
+    "ft_adsb_cache_hit_ratio", "ADSB response cache hit rate", fn=lambda: adsb_info.response_cache.stats()["hit_rate"]
+)
+metrics.Gauge("ft_backed_off_ids", "IDs polled less often because they keep missing", fn=lambda: len(poll_scheduler.misses))
+metrics.Gauge(
+    "ft_breaker_open", "Whether a provider's circuit breaker is open, 0.5 while half-open", ("provider",),
+    fn=lambda: {(provider,): cb.state / 2 for provider, cb in backoff.breakers.items()},
+)
+metrics.Gauge("ft_polls_per_hour", "ADSB polls over the last hour", fn=poll_scheduler.request_rate)
+metrics.Gauge("ft_track_history_bytes", "Memory held by the track history", fn=track_store.nbytes)
+metrics.Gauge(
+    "ft_budget_remaining_ratio", "Share of the monthly API budget left", ("provider",),
+    fn=lambda: {(provider,): quota.manager().remaining(provider) for provider in quota.LIMITS},
+)
 
 def configureLogging(): 
     fLog.setLevel(log.INFO)
@@ -35,37 +111,208 @@ def configureLogging():
     # Add the console handler to the logger
     fLog.addHandler(handler)
 
+def restore_state(store: state_store.StateStore) -> int:
+    """
+    Loads tracked flights from the state store, returns how many aircraft were
+    restored. An empty store is seeded with the default active_flight_list
+    """
+    rows = store.load()
+    if not rows:
+        for fl_id, (id_type, recurring) in active_flight_list.items():
+            store.save_tracked(fl_id, id_type, recurring)
+        return 0
+    active_flight_list.clear()
+    restored = 0
+    for row in rows:
+        fl_id = row["id"]
+        active_flight_list[fl_id] = [row["id_type"], bool(row["recurring"])]
+        flight = state_store.restore_flight(row)
+        if flight is None:
+            continue
+        keys = [key for key in (fl_id, flight.hex_id, flight.registration) if key]
+        # Rows are newest first, so an alias we've already seen has the fresher state
+        known = [key for key in keys if key in flight_dict]
+        if known:
+            flight = flight_dict[known[0]]
+        flight_dict.add_mapping(flight, *keys)
+        restored += 1
+        # No need to poll until the approach if we already know when it lands
+        if flight.plane_in_air and flight.eta():
+            poll_scheduler.record(fl_id, flight, polled=False)
+        else:
+            poll_scheduler.schedule(fl_id)
+    for chat_id, fl_id, recurring in store.load_subscriptions():
+        if fl_id in active_flight_list:
+            subscribers.subscribe(chat_id, fl_id, recurring)
+    return restored
+
+
+def save_flight_state(fl_id: str, flight: FlightData) -> None:
+    if state is not None:
+        state.save_flight(fl_id, flight)
+
+
+def tracked_id(fl_id: str) -> str | None:
+    """The ID an aircraft is tracked under, whichever of its aliases we're given"""
+    if fl_id in active_flight_list:
+        return fl_id
+    if fl_id in flight_dict:
+        for alias in flight_dict.aliases(fl_id):
+            if alias in active_flight_list:
+                return alias
+    return None
+
+
+def tracked_aliases(fl_id: str) -> list:
+    """Every ID in active_flight_list that's the same aircraft as fl_id"""
+    if fl_id not in flight_dict:
+        return [fl_id] if fl_id in active_flight_list else []
+    return [alias for alias in flight_dict.aliases(fl_id) if alias in active_flight_list]
+
+
+def subscribe(chat_id: int, fl_id: str, recurring: bool) -> None:
+    """Follow a tracked ID from a chat, the ID's recurring flag follows its subscribers"""
+    subscribers.subscribe(chat_id, fl_id, recurring)
+    active_flight_list[fl_id][1] = subscribers.recurring(fl_id)
+    if state is not None:
+        state.save_subscription(chat_id, fl_id, recurring)
+        state.save_tracked(fl_id, active_flight_list[fl_id][0], active_flight_list[fl_id][1])
+
+
+def watch_feed() -> None:
+    """Point the feed filter at the hex IDs we're tracking"""
+    feed.watch(flight_dict[fl_id].hex_id for fl_id in active_flight_list if fl_id in flight_dict)
+
+
+async def warm_up() -> dict:
+    """
+    Looks up every ID in active_flight_list we don't know yet, all in one concurrent
+    pass that uses multi-ID queries when they're on. Returns {id: why} for the ones
+    that couldn't be resolved, they're still tracked under the ID they were given
+    """
+    pending = {
+        fl_id: FlightData(fl_id if id_type == "reg" else fl_id.lower(), id_type == "reg")
+        for fl_id, (id_type, _) in active_flight_list.items() if fl_id not in flight_dict
+    }
+    failures = {}
+    try:
+        if not pending:
+            return failures
+        started = time.perf_counter()
+        responses = await adsb_info.get_batch_adsb_data_async(pending, poller.SWEEP_CONCURRENCY)
+        for fl_id, flight in pending.items():
+            # Removed while we were looking it up
+            if fl_id not in active_flight_list:
+                continue
+            j_resp = responses.get(fl_id, {})
+            if "message" in j_resp:
+                failures[fl_id] = j_resp["message"]
+            elif not j_resp.get("ac"):
+                failures[fl_id] = "not publishing right now"
+            else:
+                flight.process_adsb(j_resp["ac"][0])
+            # Whatever ADSB couldn't tell us, the offline registry might
+            registry.resolve(flight)
+            flight_dict.add_mapping(flight, *[key for key in (fl_id, flight.hex_id, flight.registration) if key])
+            save_flight_state(fl_id, flight)
+            hold_off(fl_id, flight, j_resp)
+        watch_feed()
+        fLog.info(
+            f"Looked up {len(pending)} IDs in {time.perf_counter() - started:.1f}s, "
+            f"{len(failures)} couldn't be resolved"
+        )
+        for fl_id, reason in failures.items():
+            fLog.warning(f"Couldn't resolve {fl_id}: {reason}")
+        return failures
+    finally:
+        warm_up_failures.update(failures)
+        warmed_up.set()
+
+
+def hold_off(fl_id: str, flight: FlightData, j_resp: json) -> None:
+    """Push the first poll of an ID that just came back empty out to its backoff"""
+    wait = poll_scheduler.note_response(fl_id, flight, j_resp)
+    if wait:
+        poll_scheduler.schedule(fl_id, time.time() + wait)
+
+
+async def wait_until_warm(deadline: float = WARMUP_DEADLINE) -> bool:
+    """Waits for the startup lookups, at most deadline seconds. False if we gave up waiting"""
+    try:
+        await asyncio.wait_for(warmed_up.wait(), deadline)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def hand_to_shards() -> None:
+    """Gives the shards every tracked ID they don't have yet"""
+    for fl_id in active_flight_list:
+        snap = latest_snapshot(fl_id)
+        if snap is not None and fl_id not in coordinator.owner:
+            coordinator.add(snap)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Starts the flight tracker, adds flights from active_flight_list"""
     global has_started
     if has_started:
         return
     has_started = True
-    # TODO, This shouldn't need to be a global var
-    global TEST_GROUP_ID
-    TEST_GROUP_ID = update.effective_message.chat_id
-    # Kicks off checker starting with adding all flights that are initially in active_flight_list
-    for flight in active_flight_list:
-        id_type = active_flight_list[flight][0]
-        recurring = active_flight_list[flight][1]
-        context.job_queue.run_once(
-            callback=add_flight_job_callback,
-            when=timedelta(seconds=1),
-            name=str(TEST_GROUP_ID),
-            data=[flight, id_type, recurring],
+    chat_id = update.effective_message.chat_id
+    for flight in list(active_flight_list):
+        # The defaults, and anything saved before there were subscriptions, go to whoever started us
+        if flight not in subscribers:
+            subscribe(chat_id, flight, active_flight_list[flight][1])
+        if flight not in poll_scheduler.next_due:
+            poll_scheduler.schedule(flight)
+    # Runs on its own so other commands aren't held up while we look everything up
+    context.application.create_task(begin_tracking(context, chat_id), update=update)
+
+
+async def begin_tracking(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    """Looks up the startup list, then starts polling as soon as that's done"""
+    warm = asyncio.create_task(warm_up())
+    if await wait_until_warm():
+        text = f"Tracking {len(active_flight_list)} IDs"
+        if warm_up_failures:
+            failed = sorted(warm_up_failures)
+            text += f", couldn't look up {len(failed)} yet: {', '.join(failed[:10])}"
+            if len(failed) > 10:
+                text += ", ..."
+    else:
+        # Whatever's still resolving gets polled once it's done, the rest shouldn't wait for it
+        fLog.warning(f"Lookups still running after {WARMUP_DEADLINE:.0f}s, starting without them")
+        text = f"Tracking {len(active_flight_list)} IDs, still looking some of them up"
+    await context.bot.send_message(chat_id, text)
+    start_polling(context.application)
+    if coordinator is not None:
+        # Polling may have resumed at boot, before the startup list was looked up
+        hand_to_shards()
+        if not warm.done():
+            warm.add_done_callback(lambda _: hand_to_shards())
+
+
+def start_polling(app: Application) -> None:
+    """Starts the poll loop, or hands everything to the shards. Only the first call does anything"""
+    global poll_task, polling
+    if polling:
+        return
+    polling = True
+    if coordinator is not None:
+        # The shards do the polling
+        hand_to_shards()
+        return
+    # Each flight has its own poll interval, the loop sleeps until the next one is due.
+    # The application works as the context, all the sweeps need from it is the bot
+    poll_task = app.create_task(poll_scheduler.run(lambda due: poll_due(app, due), active_flight_list))
+    if adsb_feed.enabled():
+        app.job_queue.run_repeating(
+            callback=flush_feed,
+            first=timedelta(seconds=adsb_feed.FLUSH_INTERVAL),
+            interval=timedelta(seconds=adsb_feed.FLUSH_INTERVAL),
+            name="feed",
         )
-    # Wait for flight list to populate the dictionary before moving forward
-    while len(flight_dict) != len(active_flight_list):
-        fLog.info(f"Waiting for active flight list to populate \
-                 Progress: [{len(flight_dict)} / {len(active_flight_list)}]")
-        await asyncio.sleep(1)
-    monitoring_interval = timedelta(minutes=5)
-    context.job_queue.run_repeating(
-        callback=check_in_air,
-        first=timedelta(seconds=1),
-        interval=monitoring_interval,
-        name=str(TEST_GROUP_ID),
-    )
 
 
 async def list_commands(update: Update, _) -> None:
@@ -76,148 +323,316 @@ async def list_commands(update: Update, _) -> None:
                                     \n /add <id> <idType(reg, hex)> <recurring>- \
                                     Add a flight to the flight tracker, isRecurring \
                                     defaults to False \
-                                    \n /remove - Remove a flight from the flight tracker \
-                                    \n /list - List all flights being tracked"
+                                    \n /remove - Stop following a flight in this chat \
+                                    \n /list - List the flights this chat follows \
+                                    \n /stats - Latency, error and sweep stats, \
+                                    /stats profile profiles the next poll"
     )
 
 
-def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Remove job with given name. Returns whether job was removed."""
-    current_jobs = context.job_queue.get_jobs_by_name(name)
-    if not current_jobs:
-        return False
-    for job in current_jobs:
-        job.schedule_removal()
-    return True
-
-
-async def check_in_air(context: ContextTypes.DEFAULT_TYPE):
+def tracked_flights(airborne: bool, due: set | None = None) -> dict:
     """
-    Check if a flight is in the air, if it is, we let the user know
-    and kick of a flight_has_landed check to let the user know when
-    the plane has reached it's destination
+    Flights from active_flight_list that are in the given state, keyed by their ID
+    in the list. Aliases of the same FlightData are only included once, and if due
+    is given only those IDs are included
     """
-    current_flight = None
-    # Not user facing so this data should already be valid
-    for hex_id in active_flight_list:
+    flights = {}
+    seen = set()
+    for fl_id in active_flight_list:
+        if due is not None and fl_id not in due:
+            continue
         # Find flight, it should already be in system
-        fLog.info(f"Checking {hex_id} if it's airborn.")
-        if hex_id in flight_dict.key_map.keys():
-            current_flight = flight_dict[hex_id]
-        if current_flight == None:
-            fLog.error(f"Can't find {hex_id} in flight list. Skipping check...")
+        if fl_id not in flight_dict:
+            fLog.error(f"Can't find {fl_id} in flight list. Skipping check...")
+            continue
+        current_flight = flight_dict[fl_id]
+        if id(current_flight) in seen or current_flight.plane_in_air != airborne:
             continue
-        # If we're already in the air, we don't want to check this...although this might break if
+        seen.add(id(current_flight))
+        flights[fl_id] = current_flight
+    return flights
+
+
+async def fetch_adsb(flight: FlightData) -> json:
+    """Fetch stage of a sweep"""
+    return await flight.get_raw_adsb_data_async()
+
+
+async def sweep(name: str, flights: dict, evaluate, polled: bool = True) -> poller.SweepResult:
+    """
+    Runs a sweep, going through the batched ADSB queries when they're configured.
+    Every response is classified in one pass before evaluate(id, flight, response, state).
+    polled=False when the responses are already cached (the receiver feed), so they
+    don't count as polls
+    """
+    if not flights:
+        return poller.SweepResult(name)
+    batch_fetch = adsb_info.get_batch_adsb_data_async if adsb_info.batch_enabled() else None
+    states = {}
+
+    def classify_sweep(responses: dict):
+        ids = list(responses)
+        keys = [flights[fl_id].cache_key() for fl_id in ids]
+        # Classify against the history from before this poll, then add this poll to it
+        verdicts = classifier.classify_responses(
+            keys, [flights[fl_id].plane_in_air for fl_id in ids], list(responses.values()), track_store
+        )
+        states.update(zip(ids, verdicts))
+        for key, j_resp in zip(keys, responses.values()):
+            track_store.record_response(key, j_resp)
+        # IDs that never show up get backed off, record() below plans their next poll around it
+        for fl_id, j_resp in responses.items():
+            poll_scheduler.note_response(fl_id, flights[fl_id], j_resp)
+
+    async def evaluate_state(fl_id: str, flight: FlightData, j_resp: json):
+        await evaluate(fl_id, flight, j_resp, states.get(fl_id))
+
+    result = await poller.run_sweep(
+        name, flights, fetch_adsb, evaluate_state, batch_fetch=batch_fetch, after_fetch=classify_sweep
+    )
+    # State is up to date now, so the next poll can be planned from it
+    for fl_id, flight in flights.items():
+        # Unless it landed and nobody wants it any more
+        if fl_id in active_flight_list:
+            poll_scheduler.record(fl_id, flight, polled=polled)
+    fLog.debug(f"ADSB response cache: {adsb_info.response_cache.stats()}")
+    return result
+
+
+async def poll_due(context: ContextTypes.DEFAULT_TYPE, due: dict):
+    """Sweeps the flights the scheduler says are due, {id: when it was due}"""
+    now = time.time()
+    for when in due.values():
+        metrics.poll_lag_seconds.observe(now - when)
+    with metrics.maybe_profile("poll"):
+        await check_flights(context, due)
+    fLog.debug(f"Poll scheduler: {poll_scheduler.stats()}")
+
+
+async def flush_feed(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Checks whichever aircraft the receiver feed heard from since the last flush. Their
+    responses go through the ADSB cache, so the sweeps don't make any requests for them
+    """
+    updates = feed.flush()
+    if not updates:
+        return
+    for hex_id, j_resp in updates.items():
+        adsb_info.response_cache.put(hex_id, j_resp)
+    due = {
+        fl_id for fl_id in active_flight_list
+        if fl_id in flight_dict and flight_dict[fl_id].hex_id.lower() in updates
+    }
+    if due:
+        # Served from the cache, no requests went out
+        await check_flights(context, due, polled=False)
+
+
+async def check_flights(context: ContextTypes.DEFAULT_TYPE, due: set, polled: bool = True):
+    """Runs the takeoff and landing sweeps over the given IDs"""
+    # Split before either sweep runs so a flight that changes state isn't checked twice
+    await asyncio.gather(
+        check_in_air(context, tracked_flights(airborne=False, due=due), polled),
+        plane_has_landed(context, tracked_flights(airborne=True, due=due), polled),
+    )
+
+
+async def check_in_air(
+    context: ContextTypes.DEFAULT_TYPE, flights: dict | None = None, polled: bool = True
+) -> poller.SweepResult:
+    """
+    Check if any tracked flight is in the air, if it is, we let the user know.
+    Flights that are already in the air are left to the plane_has_landed sweep.
+    Checks every flight on the ground unless given {id: FlightData}
+    """
+    if flights is None:
+        flights = tracked_flights(airborne=False)
+    if not adsb_info.is_awake():
+        fLog.debug("Outside of monitoring hours")
+        # Nothing to do until morning
+        for fl_id, flight in flights.items():
+            poll_scheduler.record(fl_id, flight, polled=False)
+        return poller.SweepResult("Takeoff")
+    # Routine polls, these wait behind landing checks and are the first to be skipped
+    quota.priority.set(quota.GROUND)
+
+    async def evaluate(fl_id: str, current_flight: FlightData, j_resp: json, state: int):
+        fLog.info(f"Checking {fl_id} if it's airborn.")
+        # Another alias may have caught it first
         if current_flight.plane_in_air:
             return
         # Checks if the flight is in the air
-        if current_flight.in_the_air():
-            plane_emoji = "\U00002708"
-            message = f"{plane_emoji} Flight {current_flight.hex_id} is in air"
-            current_flight.plane_in_air = True
-            # First time we check if plane has landed
-            first_check = datetime.now()
-            # Once we let the user know the flight is flying, we want to check for more metadata
-            if current_flight.has_aero_data():
-                # If we are able to process the AeroData then we can send it in the message
-                if current_flight.process_aero_data():
-                    if current_flight.flight_origin:
-                        message += f" \n Origin: {current_flight.flight_origin}"
-                    if current_flight.flight_destination:
-                        message += f" \n Destination: {current_flight.flight_destination}"
-                    # We either start checking immediately or when the flight is supposed to land,
-                    # depending if the data was provided
-                    if current_flight.landing_time > datetime.now():
-                        local_time = current_flight.landing_time
-                        # Convert UTC time to local time zone, this conversion is only being done
-                        # for readability of the telegram message
-                        local_time = local_time.astimezone(get_localzone())
-                        message += f"\n Estimated Landing time: {str(local_time)}"
-                        # Stop the job that checks if the flight is in the air, we only needed
-                        # to do it as long as there was a flight we were waiting on.
-                else:
-                    fLog.warning(f"Failed to process all Aero Data for {current_flight.hex_id}")
+        if not current_flight.process_in_the_air(j_resp, state):
+            return
+        plane_emoji = "\U00002708"
+        message = f"{plane_emoji} Flight {current_flight.hex_id} is in air"
+        aircraft = registry.describe(registry.find(current_flight.hex_id, current_flight.registration))
+        if aircraft:
+            message += f" \n Aircraft: {aircraft}"
+        current_flight.plane_in_air = True
+        # A new leg, whatever we had is from the last one
+        current_flight.clear_leg()
+        # Once we let the user know the flight is flying, we want to check for more metadata.
+        # The landing time decides the landing check schedule, so it's not a routine poll
+        quota.priority.set(quota.NORMAL)
+        local = eta.estimate_response(j_resp)
+        if local is not None and local.clear:
+            # One airport stands out ahead of it. Unless it's already on its way down that's only a
+            # guess, but it's enough to schedule the landing checks by and the descent pins it down
+            fLog.info(f"Heading for {local.ident} ({local.confidence:.0%} sure), skipping FlightAware")
+            eta.apply(current_flight, local)
+            estimated = "" if local.confident else " (estimated)"
+            message += f" \n Destination: {current_flight.flight_destination}{estimated}"
+            message += f"\n Estimated Landing time: {landing_text(current_flight)}"
+        elif await current_flight.has_aero_data_async():
+            # If we are able to process the AeroData then we can send it in the message
+            if current_flight.process_aero_data():
+                if current_flight.flight_origin:
+                    message += f" \n Origin: {current_flight.flight_origin}"
+                if current_flight.flight_destination:
+                    message += f" \n Destination: {current_flight.flight_destination}"
+                landing = current_flight.landing_time
+                if landing and landing.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc):
+                    message += f"\n Estimated Landing time: {landing_text(current_flight)}"
             else:
-                fLog.warning(f"Failed to get Aero Data for {current_flight.hex_id}")
-
-            fLog.info(f"Starting landing check for {current_flight.hex_id}")
-            context.job_queue.run_repeating(
-                plane_has_landed,
-                interval=timedelta(seconds=300),
-                first=first_check + timedelta(seconds=2),
-                name=str(TEST_GROUP_ID)
-                + "_Landing_"
-                + str(current_flight.hex_id),
-                data=current_flight.hex_id,
-            )
-            await context.bot.send_message(TEST_GROUP_ID, message)
+                fLog.warning(f"Failed to process all Aero Data for {current_flight.hex_id}")
+        else:
+            fLog.warning(f"Failed to get Aero Data for {current_flight.hex_id}")
 
+        save_flight_state(fl_id, current_flight)
+        # The plane_has_landed sweep picks it up from here
+        fLog.info(f"Starting landing check for {current_flight.hex_id}")
+        await announce(context, fl_id, current_flight, "takeoff", message)
 
-async def plane_has_landed(context: ContextTypes.DEFAULT_TYPE):
-    """Lets the user know when the plane has landed"""
-    current_flight = None
-    fLog.info(f"Landing Check for: {context.job.data}.")
-    if context.job.data in flight_dict.key_map.keys():
-        current_flight = flight_dict[context.job.data]
-    if current_flight == None:
-        fLog.error(f"Can't find {context.job.data} in flight list. Skipping check...")
-        return
-    flight_data = flight_dict[context.job.data]
-    if not flight_data.plane_in_air:
-        return
-    if flight_data.is_plane_on_ground():
+    return await sweep("Takeoff", flights, evaluate, polled)
+
+
+def landing_text(flight: FlightData) -> str:
+    """Estimated landing in the local time zone, only done for readability of the telegram message"""
+    from tzlocal import get_localzone
+
+    # landing_time is naive UTC, astimezone on its own would read it as local time
+    return str(flight.landing_time.replace(tzinfo=timezone.utc).astimezone(get_localzone()))
+
+
+async def plane_has_landed(
+    context: ContextTypes.DEFAULT_TYPE, flights: dict | None = None, polled: bool = True
+) -> poller.SweepResult:
+    """
+    Lets the user know when any of the airborne planes have landed, checks every
+    airborne flight unless given {id: FlightData}
+    """
+    if flights is None:
+        flights = tracked_flights(airborne=True)
+    quota.priority.set(quota.LANDING)
+
+    async def evaluate(fl_id: str, flight_data: FlightData, j_resp: json, state: int):
+        fLog.info(f"Landing Check for: {fl_id}.")
+        if not flight_data.plane_in_air:
+            return
+        if not flight_data.process_on_ground(j_resp, state):
+            # Still flying, a descent towards an airport pins the landing time down
+            if eta.refresh(flight_data, j_resp):
+                save_flight_state(fl_id, flight_data)
+            return
         flight_data.plane_in_air = False
+        aero_info.finish_leg(flight_data.registration)
+        save_flight_state(fl_id, flight_data)
         text = f"Plane {flight_data.hex_id} has landed!"
-        if not active_flight_list[flight_data.hex_id][1]:
-            fLog.info(f"Removing {context.job.name}")
-            remove_job_if_exists(context.job.name, context)
-            context.job_queue.run_once(
-                remove_flight_job_callback,
-                when=timedelta(seconds=1),
-                name=str(TEST_GROUP_ID),
-                data=[flight_data.hex_id],
-                )
-        await context.bot.send_message(TEST_GROUP_ID, text)
-        # To keep things clean, we want to remove the landing check
-        remove_job_if_exists(f"{str(TEST_GROUP_ID)} _Landing_ {str(flight_data.hex_id)}", context)
-
-async def add_flight_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Add a flight to list of flights to be checked."""
-    fl_id = ""
-    try:
-        fl_id = context.job.data[0]
-        # (TODO) Add flight number as an argument, ideally this could be in the form of
-        # a second prompt asking what we just provided
-        id_type = context.job.data[1]
-        is_reg = False
-        # Make sure to reject incorrect spelling if it's not exactly "reg" or "hex"
-        match id_type.casefold():
-            case "reg":
-                is_reg = True
-            case "hex":
-                is_reg = False
-            case _:
-                fLog.error(f"{id_type}??")
-                await context.bot.send_message(
-                    TEST_GROUP_ID, "Usage: /add <id> <idType(reg, hex)> <recurring>"
-                )
-                return
-        # Make sure to convert to lower if this is a hex id
-        fl_id = fl_id if is_reg else fl_id.lower()
-        repeat = context.job.data[2] if len(context.job.data) > 2 else False
-    except (IndexError, ValueError):
-        await context.bot.send_message(
-            TEST_GROUP_ID, "Usage: /add <id> <idType(reg, hex)> <recurring>"
-        )
+        await announce(context, fl_id, flight_data, "landing", text)
+
+    return await sweep("Landing", flights, evaluate, polled)
+
+
+async def announce(context: ContextTypes.DEFAULT_TYPE, fl_id: str, flight: FlightData, kind: str, text: str):
+    """Lets the user know about a takeoff or landing, via the bot process if we're a shard"""
+    if event_sink is not None:
+        id_type, recurring = active_flight_list.get(fl_id, ["hex", True])
+        event_sink({"op": "event", "kind": kind, "text": text, **shards.snapshot(fl_id, id_type, recurring, flight)})
+        return
+    await deliver(context, fl_id, kind, text)
+
+
+async def deliver(context, fl_id: str, kind: str, text: str):
+    """
+    Sends a takeoff or landing to every chat following the aircraft, under any of
+    its IDs. context is anything with a bot
+    """
+    aliases = tracked_aliases(fl_id)
+    chats = {}
+    for alias in aliases:
+        chats.update(subscribers.chats(alias))
+    metrics.notifications.inc(kind=kind)
+    # Queued rather than sent, so the sweep doesn't wait on Telegram
+    global sender
+    if sender is None:
+        sender = outbox.Outbox(context.bot)
+    for chat_id in chats:
+        sender.post(chat_id, text)
+    if kind == "landing":
+        # Chats that only wanted this flight stop following it
+        for alias in aliases:
+            for chat_id in subscribers.one_shot(alias):
+                fLog.info(f"Removing {alias} for chat {chat_id}")
+                sender.post(chat_id, remove_flight(alias, chat_id))
+
+
+def latest_snapshot(fl_id: str) -> dict | None:
+    """What the bot process knows about an aircraft, for handing it to a shard"""
+    if fl_id not in active_flight_list or fl_id not in flight_dict:
+        return None
+    id_type, recurring = active_flight_list[fl_id]
+    return shards.snapshot(fl_id, id_type, recurring, flight_dict[fl_id])
+
+
+async def apply_event(app: Application, message: dict) -> None:
+    """A shard saw a takeoff or landing, keep our copy of the flight in step and send it"""
+    fl_id = message["fl_id"]
+    if fl_id not in active_flight_list:
+        # Removed while the shard was sweeping it
+        return
+    flight = state_store.restore_flight(message["flight"])
+    if flight is not None:
+        if fl_id in flight_dict:
+            flight_dict.replace(fl_id, flight)
+        flight_dict.add_mapping(flight, *[key for key in (fl_id, flight.hex_id, flight.registration) if key])
+        save_flight_state(fl_id, flight)
+    await deliver(app, fl_id, message["kind"], message["text"])
+
+async def add_flight(context, fl_id: str, id_type: str, repeat: bool, chat_id: int) -> None:
+    """
+    Add a flight to list of flights to be checked, and follow it from the chat that
+    asked. context is anything with a bot
+    """
+    # (TODO) Add flight number as an argument, ideally this could be in the form of
+    # a second prompt asking what we just provided
+    is_reg = False
+    # Make sure to reject incorrect spelling if it's not exactly "reg" or "hex"
+    match id_type.casefold():
+        case "reg":
+            is_reg = True
+        case "hex":
+            is_reg = False
+        case _:
+            fLog.error(f"{id_type}??")
+            await context.bot.send_message(
+                chat_id, "Usage: /add <id> <idType(reg, hex)> <recurring>"
+            )
+            return
+    # Make sure to convert to lower if this is a hex id
+    fl_id = fl_id if is_reg else fl_id.lower()
+    tracked = tracked_id(fl_id)
+    if tracked is not None:
+        await follow_tracked(context, chat_id, tracked, repeat)
         return
     # Look for flight, we're starting from scratch whenever we call notify flight,
     # so replace the current flight_data, mainly because this ensures we're working
     # off of current data
     new_flight = FlightData(fl_id, is_reg)
-    raw_json = new_flight.get_raw_adsb_data()
+    raw_json = await new_flight.get_raw_adsb_data_async()
     if "message" in raw_json:
         fLog.warning(f"There's an issue with ID {fl_id}: {raw_json["message"]}")
-    if raw_json["msg"] == "No error" and raw_json["ac"]:
+    if raw_json.get("msg") == "No error" and raw_json.get("ac"):
         if new_flight.process_adsb(raw_json["ac"][0]):
             fLog.info("Processed all fields successfully")
         else:
@@ -225,15 +640,39 @@ async def add_flight_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
     else:
         fLog.warning(f"Either {fl_id} is an invalid ID, or the flight is not airborn yet \
               so we can't get data")
+    # Fills in the hex or registration ADSB didn't give us, so it's known under both
+    aircraft = registry.describe(registry.resolve(new_flight))
+    # Added under its other ID, e.g. the registration of a hex someone already follows
+    for key in (new_flight.hex_id, new_flight.registration):
+        tracked = tracked_id(key) if key else None
+        if tracked is not None:
+            await follow_tracked(context, chat_id, tracked, repeat)
+            return
     # Add flight to multi-key dict, technically if a flight is not in the air we don't
     # add the registration or anything.
     # TODO, should I be updating the dict if a registration doesn't
     # exist when in in_the_air ?
     text = None
-    if fl_id in flight_dict.key_map.keys():
+    if fl_id in flight_dict:
         fLog.info(f"Adding updated flight_data to id: {fl_id}")
-        flight_dict[fl_id] = new_flight
+        # Every alias of the old data should see the new data
+        flight_dict.replace(fl_id, new_flight)
+        flight_dict.add_mapping(
+            new_flight, *[key for key in (new_flight.hex_id, new_flight.registration) if key]
+        )
+        # Known from before but nobody follows it any more, so there's no state worth keeping
+        tracked = fl_id
+        active_flight_list[tracked] = ["reg" if is_reg else "hex", repeat]
+        poll_scheduler.schedule(tracked)
+        hold_off(tracked, new_flight, raw_json)
+        subscribe(chat_id, tracked, repeat)
+        save_flight_state(tracked, new_flight)
+        watch_feed()
+        if coordinator is not None:
+            coordinator.add(latest_snapshot(tracked))
         text = f"Flight checker has updated ID: {fl_id} in the list!"
+        if aircraft:
+            text += f"\n{aircraft}"
     else:
         i_text = ""
         key_list = []
@@ -250,37 +689,49 @@ async def add_flight_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
             # Add a new mapping if there is no registration, otherwise just add to the key
             key_list.append(new_flight.registration)
 
-        flight_dict.add_mapping(new_flight, *key_list)
+        # Not publishing right now, it can still be polled under the ID we were given
+        flight_dict.add_mapping(new_flight, *(key_list or [fl_id]))
+        watch_feed()
         fLog.info(i_text)
         text = f"Flight checker has added ID: {assigned_id} to the list!"
+        if aircraft:
+            text += f"\n{aircraft}"
         try:
-            active_flight_list[assigned_id] = [is_reg, repeat]
+            id_type = "hex" if assigned_id == new_flight.hex_id else "reg"
+            active_flight_list.setdefault(assigned_id, [id_type, repeat])
+            if assigned_id not in poll_scheduler.next_due:
+                poll_scheduler.schedule(assigned_id)
+            hold_off(assigned_id, new_flight, raw_json)
+            subscribe(chat_id, assigned_id, repeat)
+            save_flight_state(assigned_id, new_flight)
+            # Only once polling has started, that hands the whole list over itself
+            if coordinator is not None and polling:
+                coordinator.add(latest_snapshot(assigned_id))
         except(KeyError, IndexError, ValueError):
             text = f"Failed to add {assigned_id} to active flight list"
             fLog.warning(text)
-    await context.bot.send_message(TEST_GROUP_ID, text)
-
+    await context.bot.send_message(chat_id, text)
 
-async def add_flight_job_callback(context: ContextTypes.DEFAULT_TYPE):
-    """Handles when attempting to call add_flight as a job"""
-    # Extracting data passed to the job
-    flight_id, id_type, is_recurring = context.job.data
 
-    # Call the shared callback function
-    context.job_queue.run_once(
-        add_flight_callback,
-        when=timedelta(seconds=1),
-        name=str(TEST_GROUP_ID),
-        data=[flight_id, id_type, is_recurring],
-    )
+async def follow_tracked(context, chat_id: int, tracked: str, repeat: bool) -> None:
+    """
+    Follow an aircraft that's already tracked from another chat. Its state is shared,
+    replacing it would lose the landing time and announce a takeoff again to everyone
+    """
+    subscribe(chat_id, tracked, repeat)
+    text = f"Flight checker is already tracking ID: {tracked}, following it here too!"
+    if tracked in flight_dict:
+        flight = flight_dict[tracked]
+        aircraft = registry.describe(registry.find(flight.hex_id, flight.registration))
+        if aircraft:
+            text += f"\n{aircraft}"
+    await context.bot.send_message(chat_id, text)
 
 
 # Command handler for /add command
 async def add_flight_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles when attempting to call add_flight as a telegram command"""
-    
-    global TEST_GROUP_ID
-    TEST_GROUP_ID = update.message.chat_id
+    chat_id = update.message.chat_id
     # Extracting parameters from the command
     args = context.args
     if len(args) < 2:
@@ -294,12 +745,9 @@ async def add_flight_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     is_recurring = args[2] if len(args) > 2 and args[2] == "recurring" else False
     if len(args) > 2 and args[2] != "recurring":
         fLog.warn("Spelling is incorrect, this will be considered recurring")
-    # Call the shared callback function
-    context.job_queue.run_once(
-        add_flight_callback,
-        when=timedelta(seconds=1),
-        name=str(TEST_GROUP_ID),
-        data=[flight_id, id_type, is_recurring],
+    # The lookup can take a while, don't hold up other commands
+    context.application.create_task(
+        add_flight(context, flight_id, id_type, is_recurring, chat_id), update=update
     )
 
 
@@ -307,9 +755,7 @@ async def remove_flight_command(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Handles when attempting to call remove_flight as a telegram command"""
-
-    global TEST_GROUP_ID
-    TEST_GROUP_ID = update.message.chat_id
+    chat_id = update.message.chat_id
     args = context.args
     if len(args) < 1:
         await update.message.reply_text(
@@ -317,60 +763,135 @@ async def remove_flight_command(
         )
         return
 
-    # Call the shared callback function
-    context.job_queue.run_once(
-        remove_flight_callback,
-        when=timedelta(seconds=1),
-        name=str(TEST_GROUP_ID),
-        data=args[0],
-    )
-
-
-async def remove_flight_job_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles when attempting to call remove_flight as a job"""
-
-    # Call the shared callback function
-    context.job_queue.run_once(
-        remove_flight_callback,
-        when=timedelta(seconds=1),
-        name=str(TEST_GROUP_ID),
-        data=context.job.data[0],
-    )
+    await context.bot.send_message(chat_id, remove_flight(args[0], chat_id))
 
 
-async def remove_flight_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Remove a flight from the flight list."""
-    text = ""
-    r_id = context.job.data
-    if r_id is None:
-        text = "Usage: /remove <id>"
-    # Make the check non case sensitive
-    elif r_id.casefold() in active_flight_list.keys():
+def remove_flight(r_id: str, chat_id: int) -> str:
+    """
+    Stop following a flight from a chat, it's removed from the flight list once no
+    chat follows it. Returns the message for the chat
+    """
+    # Whichever alias this chat follows it under, hex IDs are lower case
+    followed = [
+        alias for alias in tracked_aliases(r_id) + tracked_aliases(r_id.casefold())
+        if subscribers.subscribed(chat_id, alias)
+    ]
+    if followed:
         text = f"Removing ID: [{r_id}] from list"
+        r_id = followed[0]
+        if state is not None:
+            state.remove_subscription(chat_id, r_id)
+        if not subscribers.unsubscribe(chat_id, r_id):
+            # Other chats still follow it, keep polling it for them
+            active_flight_list[r_id][1] = subscribers.recurring(r_id)
+            if state is not None:
+                state.save_tracked(r_id, *active_flight_list[r_id])
+            return text
         try:
             del active_flight_list[r_id]
+            poll_scheduler.remove(r_id)
+            # Keep the history if the same aircraft is still tracked under another ID
+            if r_id in flight_dict and not any(
+                alias in active_flight_list for alias in flight_dict.aliases(r_id)
+            ):
+                track_store.remove(flight_dict[r_id].cache_key())
+            if state is not None:
+                state.remove(r_id)
+            if coordinator is not None:
+                coordinator.remove(r_id)
+            watch_feed()
         except KeyError:
             text = f"Failed to remove ID {r_id}"
     else:
         text = f"ID: [{r_id}] not found in list"
-    await context.bot.send_message(TEST_GROUP_ID, text)
+    return text
 
 
 async def list_ids(update: Update, _) -> None:
-    """Provide a list of IDs currently being tracked by the program"""
+    """Provide a list of IDs this chat is following"""
     text = "Current list of ids being tracked:"
-    for key in active_flight_list:
+    for key in subscribers.aircraft(update.message.chat_id):
         text += f"\n {key}"
     await update.message.reply_text(text)
     return
 
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends a summary of the metrics, /stats profile profiles the next poll"""
+    if context.args and context.args[0] == "profile":
+        path = metrics.PROFILE_PATH or "poll_profile.txt"
+        metrics.profile_next_sweep(path)
+        await update.message.reply_text(f"Profiling the next poll to {path}")
+        return
+    cache = adsb_info.response_cache.stats()
+    text = (
+        f"{metrics.summary()}"
+        f"\nTracking {len(active_flight_list)} IDs for {subscribers.chat_count()} chats, "
+        f"{poll_scheduler.request_rate():.0f} polls/hour"
+        f"\nADSB cache hit rate {cache['hit_rate']:.0%} ({cache['size']} cached)"
+        f"\n{quota.manager().summary()}"
+    )
+    if poll_scheduler.misses:
+        text += f"\n{len(poll_scheduler.misses)} IDs keep missing and are polled less often"
+    if backoff.summary():
+        text += f"\n{backoff.summary()}"
+    if warm_up_failures:
+        text += f"\n{len(warm_up_failures)} IDs couldn't be looked up at startup"
+    if adsb_feed.enabled():
+        text += f"\nReceiver feed: {feed.stats()}"
+    if coordinator is not None:
+        text += f"\nPolling in {len(coordinator.workers)} shard workers, sweep stats above are this process only"
+    await update.message.reply_text(text)
+
+
+async def startup(app: Application) -> None:
+    """Starts the metrics endpoint, the receiver feed and the shard workers on the bot's loop"""
+    global metrics_server, feed_task, coordinator
+    metrics_server = await metrics.serve()
+    if shards.SHARDS:
+        coordinator = shards.Coordinator(
+            shards.SHARDS, lambda message: app.create_task(apply_event(app, message)), latest_snapshot
+        )
+        coordinator.start()
+    elif adsb_feed.enabled():
+        # The feed needs the polling in this process, it isn't used with shards
+        watch_feed()
+        feed_task = asyncio.create_task(feed.run())
+    if restored_flights:
+        # A restart mid flight carries on with its landing checks without waiting for /start
+        fLog.info(f"Resuming polling for {restored_flights} restored flights")
+        start_polling(app)
+
+
+async def shutdown(_: Application) -> None:
+    """Release pooled connections when the bot stops"""
+    if sender is not None:
+        await sender.close()
+    if poll_task is not None:
+        poll_task.cancel()
+    await http_client.aclose()
+    if coordinator is not None:
+        coordinator.stop()
+    if feed_task is not None:
+        feed_task.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+    quota.close()
+    if state is not None:
+        state.close()
+
+
 def main() -> None:
     """Run bot."""
+    from telegram import Update
+    from telegram.ext import Application, CommandHandler
+
     # Create the Application and pass it your bot's token.
     application = (
         Application.builder()
         .token(str(os.environ.get("TELEGRAM_FLIGHT_BOT_KEY")))
+        .post_init(startup)
+        .post_shutdown(shutdown)
         .build()
     )
 
@@ -380,9 +901,15 @@ def main() -> None:
     application.add_handler(CommandHandler("add", add_flight_command))
     application.add_handler(CommandHandler("remove", remove_flight_command))
     application.add_handler(CommandHandler("list", list_ids))
+    application.add_handler(CommandHandler("stats", stats_command))
 
     configureLogging()
 
+    global state, restored_flights
+    state = state_store.StateStore()
+    restored_flights = restore_state(state)
+    fLog.info(f"Restored {restored_flights} flights from {state.path}")
+
     fLog.info("Ready to start!")
 
     # Run the bot until the user presses Ctrl-C
@@ -0,0 +1,225 @@
+# flighttracker/http_client.py
+
+"""
+Shared HTTP layer for the ADSB and FlightAware APIs. Keeps pooled keep-alive
+connections so a poll doesn't pay for a new TLS handshake every time, and caps
+how many requests can be open against a single host at once.
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+import logging as log
+import os
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+import metrics
+
+# Re-exported so callers can catch transport errors without importing httpx
+HTTPError = httpx.HTTPError
+
+htLog = log.getLogger("http_client")
+
+# Enable logging
+htLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+htLog.propagate = False
+
+# Add the console handler to the logger
+htLog.addHandler(handler)
+
+
+@dataclass
+class ClientConfig:
+    """Pool and timeout settings, defaults can be overridden through the environment"""
+
+    # Total seconds allowed for a request, connect has its own shorter budget
+    timeout: float = field(default_factory=lambda: float(os.environ.get("FT_HTTP_TIMEOUT", 10)))
+    connect_timeout: float = field(
+        default_factory=lambda: float(os.environ.get("FT_HTTP_CONNECT_TIMEOUT", 5))
+    )
+    # Pool wide cap on open connections and on idle connections kept around
+    max_connections: int = field(
+        default_factory=lambda: int(os.environ.get("FT_HTTP_MAX_CONNECTIONS", 50))
+    )
+    max_keepalive: int = field(
+        default_factory=lambda: int(os.environ.get("FT_HTTP_MAX_KEEPALIVE", 20))
+    )
+    keepalive_expiry: float = field(
+        default_factory=lambda: float(os.environ.get("FT_HTTP_KEEPALIVE_EXPIRY", 60))
+    )
+    # Cap on in flight requests against one host, keeps us polite to the upstream APIs
+    max_per_host: int = field(
+        default_factory=lambda: int(os.environ.get("FT_HTTP_MAX_PER_HOST", 10))
+    )
+
+
+config = ClientConfig()
+
+_async_client: httpx.AsyncClient | None = None
+_sync_client: httpx.Client | None = None
+# host -> semaphore, only used by the async client
+_host_limits: dict[str, asyncio.Semaphore] = {}
+# Async pools replaced by configure(), requests may still be using them so they're closed in aclose()
+_retired: list[httpx.AsyncClient] = []
+
+
+def configure(**kwargs) -> None:
+    """
+    Update the client settings, any open pools are dropped so the next request
+    picks up the new values
+    """
+    global _async_client, _sync_client
+    for key, value in kwargs.items():
+        if not hasattr(config, key):
+            raise AttributeError(f"Unknown http client setting: {key}")
+        setattr(config, key, value)
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+    # The async pool has to be closed from inside a loop, aclose() takes care of it
+    if _async_client is not None:
+        _retired.append(_async_client)
+        _async_client = None
+    _host_limits.clear()
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(config.timeout, connect=config.connect_timeout)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=config.max_connections,
+        max_keepalive_connections=config.max_keepalive,
+        keepalive_expiry=config.keepalive_expiry,
+    )
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Shared async client, created on first use"""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        htLog.info("Opening async connection pool")
+        _async_client = httpx.AsyncClient(timeout=_timeout(), limits=_limits())
+    return _async_client
+
+
+def get_sync_client() -> httpx.Client:
+    """Shared blocking client, used by the sync wrappers"""
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        htLog.info("Opening sync connection pool")
+        _sync_client = httpx.Client(timeout=_timeout(), limits=_limits())
+    return _sync_client
+
+
+def _clean_headers(headers: dict | None) -> dict | None:
+    """Drop unset values (e.g. a missing API key), requests used to do this for us"""
+    if headers is None:
+        return None
+    return {key: value for key, value in headers.items() if value is not None}
+
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    host = urlsplit(url).netloc
+    if host not in _host_limits:
+        _host_limits[host] = asyncio.Semaphore(config.max_per_host)
+    return _host_limits[host]
+
+
+def _record(endpoint: str | None, start: float, response: httpx.Response | None) -> None:
+    """Latency and outcome of one upstream request, only for callers that name the endpoint"""
+    if endpoint is None:
+        return
+    metrics.upstream_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+    status = str(response.status_code) if response is not None else "error"
+    metrics.upstream_requests.inc(endpoint=endpoint, status=status)
+
+
+async def get(
+    url: str, headers: dict | None = None, timeout: float | None = None, endpoint: str | None = None
+) -> httpx.Response:
+    """
+    Non-blocking GET through the shared pool, waits for a per-host slot first.
+    Raises HTTPError on transport failures, status codes are left to the caller.
+    Requests with an endpoint name are recorded in the upstream metrics
+    """
+    client = get_async_client()
+    headers = _clean_headers(headers)
+    req_timeout = httpx.Timeout(timeout, connect=config.connect_timeout) if timeout else None
+    async with _host_semaphore(url):
+        # Timed once we have a slot, so the metric is the upstream and not our own queue
+        start = time.perf_counter()
+        response = None
+        try:
+            if req_timeout is None:
+                response = await client.get(url, headers=headers)
+            else:
+                response = await client.get(url, headers=headers, timeout=req_timeout)
+            return response
+        finally:
+            _record(endpoint, start, response)
+
+
+def get_sync(
+    url: str, headers: dict | None = None, timeout: float | None = None, endpoint: str | None = None
+) -> httpx.Response:
+    """Blocking GET through the shared pool, for callers outside the event loop"""
+    client = get_sync_client()
+    headers = _clean_headers(headers)
+    start = time.perf_counter()
+    response = None
+    try:
+        if timeout is None:
+            response = client.get(url, headers=headers)
+        else:
+            response = client.get(
+                url, headers=headers, timeout=httpx.Timeout(timeout, connect=config.connect_timeout)
+            )
+        return response
+    finally:
+        _record(endpoint, start, response)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent requests for the same key, later callers wait on the request
+    that's already in flight instead of starting their own
+    """
+
+    def __init__(self):
+        self.in_flight: dict[str, asyncio.Task] = {}
+        # Number of callers that piggybacked on someone else's request
+        self.coalesced = 0
+
+    async def run(self, key: str, factory):
+        """Await factory() for key, unless a call for key is already running"""
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(factory())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # Shielded so one caller being cancelled doesn't cancel it for everyone else
+        return await asyncio.shield(task)
+
+
+async def aclose() -> None:
+    """Close both pools, and any replaced by configure(), call this on shutdown"""
+    global _async_client, _sync_client
+    if _async_client is not None:
+        _retired.append(_async_client)
+        _async_client = None
+    while _retired:
+        await _retired.pop().aclose()
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+    _host_limits.clear()
+    htLog.info("Closed connection pools")
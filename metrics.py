@@ -0,0 +1,352 @@
+# flighttracker/metrics.py
+
+"""
+Counters and latency histograms for the hot paths, exposed in Prometheus text
+format on a local port and summarised by the /stats command. Updating a metric
+is a dict lookup and an add, cheap enough to do on every request
+"""
+
+import asyncio
+from bisect import bisect_left
+import cProfile
+from contextlib import contextmanager
+import io
+import logging as log
+import os
+import pstats
+import time
+
+mtLog = log.getLogger("metrics")
+
+# Enable logging
+mtLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+mtLog.propagate = False
+
+# Add the console handler to the logger
+mtLog.addHandler(handler)
+
+# Where /metrics is served, 0 turns the endpoint off
+PORT = int(os.environ.get("FT_METRICS_PORT", 0))
+HOST = os.environ.get("FT_METRICS_HOST", "127.0.0.1")
+# If set, the first poll after startup is profiled and the report written here
+PROFILE_PATH = os.environ.get("FT_PROFILE_SWEEP", "")
+
+# Seconds, covers everything from a cache hit to a request that hits the timeout
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Every metric that's been created, in creation order
+registry = []
+started_at = time.time()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic count per label combination"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        """Sum over every label combination"""
+        return sum(self.values.values())
+
+    def render(self) -> list:
+        return [f"{self.name}{_label_text(self.labels, key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, fn is called on every scrape if given"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), fn=None):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+    def render(self) -> list:
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception as err:  # pylint: disable=broad-except
+                mtLog.warning(f"Couldn't read {self.name}: {err}")
+                return []
+            # Either one number, or {label values: number}
+            self.values = value if isinstance(value, dict) else {(): value}
+        return super().render()
+
+
+class Histogram:
+    """Observations counted into fixed buckets per label combination"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per bucket counts (last one is +Inf), sum, count]
+        self.series = {}
+        registry.append(self)
+
+    def _series(self, labels: dict) -> list:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        return series
+
+    def observe(self, value: float, **labels) -> None:
+        series = self._series(labels)
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with block took"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def merged(self, **labels) -> list:
+        """Counts summed over every series matching the given labels"""
+        merged = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        for key, (counts, total, count) in self.series.items():
+            if any(key[self.labels.index(name)] != value for name, value in labels.items()):
+                continue
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+        return merged
+
+    def count(self, **labels) -> int:
+        return self.merged(**labels)[2]
+
+    def mean(self, **labels) -> float:
+        _, total, count = self.merged(**labels)
+        return total / count if count else 0.0
+
+    def quantile(self, q: float, **labels) -> float:
+        """Estimate from the buckets, interpolating inside the one the quantile lands in"""
+        counts, _, count = self.merged(**labels)
+        if not count:
+            return 0.0
+        target = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= target and bucket_count:
+                lower = self.buckets[i - 1] if i else 0.0
+                # Nothing to interpolate towards past the last bucket
+                upper = self.buckets[i] if i < len(self.buckets) else lower
+                return lower + (upper - lower) * (target - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = []
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = _label_text(self.labels, key, 'le="' + str(bound) + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+
+# Upstream API calls, endpoint is adsb_icao/adsb_registration/adsb_area/aero
+upstream_seconds = Histogram(
+    "ft_upstream_request_seconds", "Upstream API request latency", ("endpoint",)
+)
+upstream_requests = Counter(
+    "ft_upstream_requests_total", "Upstream API requests by HTTP status, error for transport failures",
+    ("endpoint", "status"),
+)
+adsb_error_responses = Counter(
+    "ft_adsb_error_responses_total", "ADSB responses carrying a message field", ("endpoint",)
+)
+# Sweeps and scheduling
+sweep_seconds = Histogram("ft_sweep_seconds", "Time to fetch and evaluate a sweep", ("sweep",))
+sweep_aircraft = Counter("ft_sweep_aircraft_total", "Aircraft checked by sweeps", ("sweep",))
+sweep_failures = Counter("ft_sweep_failures_total", "Aircraft whose check failed", ("sweep",))
+poll_lag_seconds = Histogram(
+    "ft_poll_lag_seconds", "How late an aircraft was polled compared to when it was due"
+)
+eta_estimates = Counter(
+    "ft_eta_estimates_total", "Local landing time estimates by outcome, confident/guess/unsure/none", ("outcome",)
+)
+notifications = Counter("ft_notifications_total", "State changes sent to Telegram", ("kind",))
+telegram_messages = Counter(
+    "ft_telegram_messages_total", "Telegram messages by outcome, sent/retry/error", ("status",)
+)
+telegram_delay_seconds = Histogram(
+    "ft_telegram_delay_seconds", "Time from an event being queued to its message being sent"
+)
+# Quotas
+quota_wait_seconds = Histogram(
+    "ft_quota_wait_seconds", "Time spent waiting on a provider's rate limit", ("provider",)
+)
+quota_rejected = Counter(
+    "ft_quota_rejected_total", "Requests skipped to stay inside the monthly budget", ("provider", "priority")
+)
+breaker_trips = Counter("ft_breaker_trips_total", "Times a provider's circuit breaker opened", ("provider",))
+breaker_rejected = Counter(
+    "ft_breaker_rejected_total", "Requests skipped because the provider's circuit breaker was open", ("provider",)
+)
+
+
+def render() -> str:
+    """Every metric in Prometheus text format"""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    """Short human readable version for /stats"""
+    uptime = time.time() - started_at
+    lines = [f"Up {uptime / 3600:.1f}h"]
+    for sweep in sorted({key[0] for key in sweep_seconds.series}):
+        lines.append(
+            f"{sweep} sweeps: {sweep_seconds.count(sweep=sweep)}, "
+            f"p50 {sweep_seconds.quantile(0.5, sweep=sweep):.2f}s "
+            f"p95 {sweep_seconds.quantile(0.95, sweep=sweep):.2f}s, "
+            f"{sweep_failures.value(sweep=sweep):.0f}/{sweep_aircraft.value(sweep=sweep):.0f} checks failed"
+        )
+    for endpoint in sorted({key[0] for key in upstream_seconds.series}):
+        requests = sum(
+            value for key, value in upstream_requests.values.items() if key[0] == endpoint
+        )
+        ok = upstream_requests.value(endpoint=endpoint, status="200")
+        lines.append(
+            f"{endpoint}: {requests:.0f} requests, {requests - ok:.0f} failed, "
+            f"p50 {upstream_seconds.quantile(0.5, endpoint=endpoint) * 1000:.0f}ms "
+            f"p95 {upstream_seconds.quantile(0.95, endpoint=endpoint) * 1000:.0f}ms"
+        )
+    if adsb_error_responses.total():
+        lines.append(f"ADSB error responses: {adsb_error_responses.total():.0f}")
+    if poll_lag_seconds.count():
+        lines.append(
+            f"Poll lag p50 {poll_lag_seconds.quantile(0.5):.1f}s p95 {poll_lag_seconds.quantile(0.95):.1f}s"
+        )
+    lines.append(
+        f"Notifications: {notifications.value(kind='takeoff'):.0f} takeoffs, "
+        f"{notifications.value(kind='landing'):.0f} landings"
+    )
+    if telegram_delay_seconds.count():
+        lines.append(
+            f"Telegram: {telegram_messages.value(status='sent'):.0f} messages sent, "
+            f"{telegram_messages.value(status='retry'):.0f} flood waits, "
+            f"{telegram_messages.value(status='error'):.0f} failed, "
+            f"delay p50 {telegram_delay_seconds.quantile(0.5):.1f}s p95 {telegram_delay_seconds.quantile(0.95):.1f}s"
+        )
+    return "\n".join(lines)
+
+
+async def handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answers one HTTP request with the metrics, anything but /metrics is a 404"""
+    try:
+        request_line = await reader.readline()
+        # Skip the headers, we don't need any of them
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split(" ")
+        path = parts[1] if len(parts) > 1 else ""
+        if path.split("?")[0] in ("/metrics", "/"):
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ValueError, asyncio.LimitOverrunError):
+        # A line over the stream limit, not a scrape we can answer
+        writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+    except (ConnectionError, UnicodeDecodeError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port: int = PORT, host: str = HOST) -> asyncio.Server | None:
+    """Start the /metrics endpoint on the running loop, does nothing if port is 0"""
+    if not port:
+        return None
+    server = await asyncio.start_server(handle_scrape, host, port)
+    mtLog.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+# Report path for the next profiled poll, armed from FT_PROFILE_SWEEP or /stats profile
+_profile_next = PROFILE_PATH
+
+
+def profile_next_sweep(path: str) -> None:
+    """Profile the next poll and write the per function timings to path"""
+    global _profile_next
+    _profile_next = path
+
+
+@contextmanager
+def maybe_profile(name: str):
+    """Profiles the with block if a profile was asked for, only ever once per request"""
+    global _profile_next
+    path = _profile_next
+    if not path:
+        yield
+        return
+    _profile_next = ""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        report = io.StringIO()
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(50)
+        with open(path, "w", encoding="utf-8") as out:
+            out.write(f"Profile of {name}\n")
+            out.write(report.getvalue())
+        mtLog.info(f"Wrote {name} profile to {path}")
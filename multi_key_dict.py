@@ -4,27 +4,143 @@
 For use with datasets that have multiple important ID's
 """
 
+# Marks a free slot, values themselves can be anything
+_EMPTY = object()
+
+
 class MultiKeyDict:
-    """Class def"""
+    """
+    Each value is stored once in a slot, every alias points at that slot and each
+    slot keeps the tuple of its aliases so lookups, alias removal and the unique
+    count are all O(1). Freed slots are reused to keep the lists compact
+    """
+
+    __slots__ = ("_slot_of_key", "_slot_of_value", "_values", "_keys", "_free", "_count")
+
     def __init__(self):
-        self.key_map = {}
+        # alias -> slot
+        self._slot_of_key = {}
+        # id(value) -> slot, lets us find a value we already hold
+        self._slot_of_value = {}
+        # slot -> value / tuple of aliases
+        self._values = []
+        self._keys = []
+        self._free = []
+        self._count = 0
+
+    def _new_slot(self, value) -> int:
+        if self._free:
+            slot = self._free.pop()
+            self._values[slot] = value
+            self._keys[slot] = ()
+        else:
+            slot = len(self._values)
+            self._values.append(value)
+            self._keys.append(())
+        self._slot_of_value[id(value)] = slot
+        self._count += 1
+        return slot
+
+    def _free_slot(self, slot: int) -> None:
+        del self._slot_of_value[id(self._values[slot])]
+        self._values[slot] = _EMPTY
+        self._keys[slot] = ()
+        self._free.append(slot)
+        self._count -= 1
+
+    def _unlink(self, key) -> None:
+        """Drop an alias, and its value too if that was the last alias"""
+        slot = self._slot_of_key.pop(key)
+        self._keys[slot] = tuple(k for k in self._keys[slot] if k != key)
+        if not self._keys[slot]:
+            self._free_slot(slot)
 
     def add_mapping(self, value, *keys):
+        """Point every key at value, keys that pointed somewhere else are moved over"""
+        slot = self._slot_of_value.get(id(value))
+        if slot is None:
+            if not keys:
+                return
+            slot = self._new_slot(value)
         for key in keys:
-            self.key_map[key] = value
+            current = self._slot_of_key.get(key)
+            if current == slot:
+                continue
+            if current is not None:
+                self._unlink(key)
+            self._slot_of_key[key] = slot
+            self._keys[slot] += (key,)
 
     def add_key(self, value, key):
-        if key not in self.key_map:
-            self.key_map[key] = value
+        """Add an alias for value, unless the key is already taken"""
+        if key not in self._slot_of_key:
+            self.add_mapping(value, key)
+
+    def update(self, mappings):
+        """Bulk insert from an iterable of (value, keys)"""
+        for value, keys in mappings:
+            self.add_mapping(value, *keys)
+
+    def replace(self, key, value):
+        """Swap the value behind key for every one of its aliases"""
+        slot = self._slot_of_key[key]
+        if self._values[slot] is value:
+            return
+        existing = self._slot_of_value.get(id(value))
+        if existing is not None:
+            # Already stored under other keys, merge the aliases into that slot
+            self.add_mapping(value, *self._keys[slot])
+            return
+        del self._slot_of_value[id(self._values[slot])]
+        self._values[slot] = value
+        self._slot_of_value[id(value)] = slot
+
+    def remove(self, key):
+        """Remove the value behind key along with all of its aliases"""
+        slot = self._slot_of_key[key]
+        for alias in self._keys[slot]:
+            del self._slot_of_key[alias]
+        self._free_slot(slot)
+
+    def aliases(self, key) -> tuple:
+        """Every key that points at the same value as key"""
+        return self._keys[self._slot_of_key[key]]
+
+    def get(self, key, default=None):
+        slot = self._slot_of_key.get(key)
+        return default if slot is None else self._values[slot]
+
+    def keys(self):
+        return self._slot_of_key.keys()
+
+    def values(self):
+        """Each distinct value once"""
+        return (value for value in self._values if value is not _EMPTY)
+
+    def items(self):
+        """(aliases, value) for each distinct value"""
+        return (
+            (keys, value) for keys, value in zip(self._keys, self._values) if value is not _EMPTY
+        )
+
+    def key_count(self) -> int:
+        """Number of aliases, as opposed to len() which counts distinct values"""
+        return len(self._slot_of_key)
 
     def __getitem__(self, key):
-        return self.key_map[key]
+        return self._values[self._slot_of_key[key]]
 
     def __setitem__(self, key, value):
-        self.key_map[key] = value
+        self.add_mapping(value, key)
 
     def __delitem__(self, key):
-        del self.key_map[key]
+        self._unlink(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._slot_of_key
+
+    def __iter__(self):
+        return iter(self._slot_of_key)
 
     def __len__(self) -> int:
-        return len(self.key_map.values())
\ No newline at end of file
+        return self._count
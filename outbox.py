@@ -0,0 +1,144 @@
+# flighttracker/outbox.py
+
+"""
+Queue for outgoing Telegram messages. Events for the same chat that arrive close
+together go out as one digest, and sends are paced under Telegram's per chat and
+global limits. Posting never waits, each chat is drained by its own task so its
+messages keep their order
+"""
+
+import asyncio
+import logging as log
+import os
+import time
+
+import metrics
+import quota
+
+obLog = log.getLogger("outbox")
+
+# Enable logging
+obLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+obLog.propagate = False
+
+# Add the console handler to the logger
+obLog.addHandler(handler)
+
+# Seconds to wait for more events before sending a chat its digest
+WINDOW = float(os.environ.get("FT_OUTBOX_WINDOW", 2))
+# Telegram allows about 30 messages a second overall, one a second to a chat and 20 a minute to a group
+GLOBAL_RATE = float(os.environ.get("FT_TELEGRAM_RATE", 25))
+CHAT_INTERVAL = float(os.environ.get("FT_TELEGRAM_CHAT_INTERVAL", 1))
+GROUP_INTERVAL = float(os.environ.get("FT_TELEGRAM_GROUP_INTERVAL", 3))
+# Longest text Telegram accepts in one message
+MAX_LENGTH = 4096
+SEPARATOR = "\n\n"
+
+
+def interval(chat_id: int) -> float:
+    """Seconds between messages to a chat, groups and channels have negative IDs"""
+    return GROUP_INTERVAL if chat_id < 0 else CHAT_INTERVAL
+
+
+def pack(texts: list) -> list:
+    """Join texts into as few messages as fit, keeping their order"""
+    messages = []
+    current = ""
+    for text in texts:
+        text = text[:MAX_LENGTH]
+        if current and len(current) + len(SEPARATOR) + len(text) > MAX_LENGTH:
+            messages.append(current)
+            current = ""
+        current = current + SEPARATOR + text if current else text
+    if current:
+        messages.append(current)
+    return messages
+
+
+def retry_delay(err: Exception) -> float | None:
+    """Seconds Telegram asked us to back off for, None if it wasn't a flood limit"""
+    delay = getattr(err, "retry_after", None)
+    if delay is None:
+        return None
+    # Newer python-telegram-bot versions hand back a timedelta
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+class Outbox:
+    """Per chat queues in front of bot.send_message"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        # chat -> [(queued at, text)]
+        self.pending = {}
+        # chat -> task draining it
+        self.drainers = {}
+        # chat -> earliest time the next message can go
+        self.next_send = {}
+        # Flood limits from Telegram hold every chat
+        self.hold_until = 0.0
+        self.bucket = quota.TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+
+    def post(self, chat_id: int, text: str) -> None:
+        """Queue a message, it goes out within WINDOW seconds if the limits allow"""
+        self.pending.setdefault(chat_id, []).append((time.monotonic(), text))
+        if chat_id not in self.drainers:
+            self.drainers[chat_id] = asyncio.get_running_loop().create_task(self._drain(chat_id))
+
+    def queued(self) -> int:
+        return sum(len(texts) for texts in self.pending.values())
+
+    async def _drain(self, chat_id: int) -> None:
+        try:
+            while self.pending.get(chat_id):
+                first = self.pending[chat_id][0][0]
+                wait = max(first + WINDOW, self.next_send.get(chat_id, 0.0), self.hold_until) - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                batch = self.pending.pop(chat_id)
+                await self._send(chat_id, batch)
+                # Hang on until the chat can take another message, anything posted meanwhile goes next
+                await asyncio.sleep(max(0.0, self.next_send.get(chat_id, 0.0) - time.monotonic()))
+        finally:
+            del self.drainers[chat_id]
+            self.next_send.pop(chat_id, None)
+
+    async def _send(self, chat_id: int, batch: list) -> None:
+        messages = pack([text for _, text in batch])
+        for i, message in enumerate(messages):
+            if i:
+                await asyncio.sleep(max(0.0, self.next_send.get(chat_id, 0.0) - time.monotonic()))
+            await self.bucket.take()
+            try:
+                await self.bot.send_message(chat_id, message)
+            except Exception as err:  # pylint: disable=broad-except
+                delay = retry_delay(err)
+                if delay is None:
+                    obLog.error(f"Couldn't send to {chat_id}, dropping {len(message)} characters: {err}")
+                    metrics.telegram_messages.inc(status="error")
+                    continue
+                obLog.warning(f"Telegram flood limit, holding sends for {delay:.0f}s")
+                metrics.telegram_messages.inc(status="retry")
+                self.hold_until = max(self.hold_until, time.monotonic() + delay)
+                # Back to the front of the queue so nothing overtakes it, later events join the digest
+                unsent = [(batch[0][0], text) for text in messages[i:]]
+                self.pending[chat_id] = unsent + self.pending.get(chat_id, [])
+                return
+            now = time.monotonic()
+            self.next_send[chat_id] = now + interval(chat_id)
+            metrics.telegram_messages.inc(status="sent")
+            metrics.telegram_delay_seconds.observe(now - batch[0][0])
+
+    async def close(self, timeout: float = 10) -> None:
+        """Send whatever's queued, waiting at most timeout seconds"""
+        drainers = list(self.drainers.values())
+        if not drainers:
+            return
+        _, late = await asyncio.wait(drainers, timeout=timeout)
+        for task in late:
+            task.cancel()
+        if late:
+            obLog.warning(f"Gave up on {self.queued()} queued messages")
@@ -0,0 +1,126 @@
+# flighttracker/poller.py
+
+"""
+Sweeps over many aircraft at once. Every aircraft is fetched concurrently (up to
+a cap), then the responses are handed off to be evaluated
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+import json
+import logging as log
+import os
+import time
+
+import metrics
+
+pLog = log.getLogger("poller")
+
+# Enable logging
+pLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+pLog.propagate = False
+
+# Add the console handler to the logger
+pLog.addHandler(handler)
+
+# Max number of aircraft being fetched or evaluated at the same time
+SWEEP_CONCURRENCY = int(os.environ.get("FT_SWEEP_CONCURRENCY", 20))
+
+
+@dataclass
+class SweepResult:
+    """Summary of a single sweep"""
+
+    name: str
+    duration: float = 0.0
+    checked: int = 0
+    failed: list = field(default_factory=list)
+
+    @property
+    def failed_count(self) -> int:
+        return len(self.failed)
+
+    def summary(self) -> str:
+        return (
+            f"{self.name} sweep checked {self.checked} aircraft in {self.duration:.2f}s, "
+            f"{self.failed_count} failed"
+        )
+
+
+def is_failed_response(j_resp: json) -> bool:
+    """ADSB only includes the message field when something went wrong"""
+    return not isinstance(j_resp, dict) or "message" in j_resp
+
+
+async def run_sweep(
+    name: str,
+    flights: dict,
+    fetch,
+    evaluate,
+    concurrency: int | None = None,
+    batch_fetch=None,
+    after_fetch=None,
+) -> SweepResult:
+    """
+    Fetch every flight in {id: FlightData} with fetch(flight), then call
+    evaluate(id, flight, response) for each one. Both stages run concurrently under
+    the same cap, a failing aircraft is recorded and doesn't stop the others.
+    If batch_fetch is given, the whole fetch stage is handed to
+    batch_fetch(flights, concurrency) which returns {id: response} instead.
+    after_fetch({id: response}) runs once between the two stages, for work that
+    wants the whole sweep at once
+    """
+    result = SweepResult(name, checked=len(flights))
+    start = time.perf_counter()
+    limit = asyncio.Semaphore(concurrency or SWEEP_CONCURRENCY)
+
+    async def fetch_one(fid: str):
+        async with limit:
+            try:
+                return await fetch(flights[fid])
+            except Exception as err:  # pylint: disable=broad-except
+                pLog.error(f"Fetching {fid} failed: {err}")
+                return None
+
+    async def evaluate_one(fid: str, j_resp: json):
+        async with limit:
+            try:
+                await evaluate(fid, flights[fid], j_resp)
+            except Exception:  # pylint: disable=broad-except
+                pLog.exception(f"Evaluating {fid} failed")
+                if fid not in result.failed:
+                    result.failed.append(fid)
+
+    ids = list(flights)
+    if batch_fetch is not None:
+        try:
+            batch = await batch_fetch(flights, concurrency or SWEEP_CONCURRENCY)
+        except Exception as err:  # pylint: disable=broad-except
+            pLog.error(f"Batch fetch failed: {err}")
+            batch = {}
+        responses = [batch.get(fid) for fid in ids]
+    else:
+        responses = await asyncio.gather(*(fetch_one(fid) for fid in ids))
+
+    fetched = {fid: j_resp for fid, j_resp in zip(ids, responses) if j_resp is not None}
+    if after_fetch is not None:
+        after_fetch(fetched)
+
+    evaluations = []
+    for fid, j_resp in zip(ids, responses):
+        if j_resp is None or is_failed_response(j_resp):
+            result.failed.append(fid)
+        # Error responses are still evaluated so the usual logging happens
+        if j_resp is not None:
+            evaluations.append(evaluate_one(fid, j_resp))
+    await asyncio.gather(*evaluations)
+
+    result.duration = time.perf_counter() - start
+    metrics.sweep_seconds.observe(result.duration, sweep=name)
+    metrics.sweep_aircraft.inc(result.checked, sweep=name)
+    metrics.sweep_failures.inc(result.failed_count, sweep=name)
+    pLog.info(result.summary())
+    return result
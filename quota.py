@@ -0,0 +1,309 @@
+# flighttracker/quota.py
+
+"""
+Keeps us inside the ADSB Exchange and FlightAware quotas. Every request takes a
+token from its provider's bucket, landing checks get served before routine ground
+polls when there's a queue, and a monthly budget that survives restarts stretches
+or skips the low priority polls once it starts running out
+"""
+
+import asyncio
+import calendar
+import contextvars
+from dataclasses import dataclass, field
+import heapq
+import itertools
+import logging as log
+import os
+import sqlite3
+import time
+
+import metrics
+
+qtLog = log.getLogger("quota")
+
+# Enable logging
+qtLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+qtLog.propagate = False
+
+# Add the console handler to the logger
+qtLog.addHandler(handler)
+
+DB_PATH = os.environ.get("FT_QUOTA_DB", "api_budget.sqlite3")
+# Below this share of the monthly budget only landing checks are allowed through
+RESERVE = float(os.environ.get("FT_BUDGET_RESERVE", 0.05))
+# Most a ground poll interval gets stretched by when we're spending too fast
+MAX_STRETCH = float(os.environ.get("FT_BUDGET_MAX_STRETCH", 8))
+
+# Lower is served first
+LANDING, NORMAL, GROUND = range(3)
+PRIORITY_NAMES = ("landing", "normal", "ground")
+# Priority of whatever request the current task makes, the sweeps set it
+priority = contextvars.ContextVar("priority", default=NORMAL)
+
+
+@dataclass
+class Limits:
+    """Per second rate, burst and monthly budget for a provider, 0 means no limit"""
+
+    rate: float
+    burst: float
+    monthly: int
+
+
+LIMITS = {
+    "adsb": Limits(
+        rate=float(os.environ.get("FT_ADSB_RATE", 5)),
+        burst=float(os.environ.get("FT_ADSB_BURST", 10)),
+        monthly=int(os.environ.get("FT_ADSB_MONTHLY_BUDGET", 10000)),
+    ),
+    "aero": Limits(
+        rate=float(os.environ.get("FT_AERO_RATE", 10 / 60)),
+        burst=float(os.environ.get("FT_AERO_BURST", 5)),
+        monthly=int(os.environ.get("FT_AERO_MONTHLY_BUDGET", 1000)),
+    ),
+}
+
+
+class TokenBucket:
+    """
+    Classic token bucket, callers that have to wait are queued by priority and
+    then arrival, so a landing check never waits behind a queue of ground polls
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        # (priority, arrival, future)
+        self.waiters = []
+        self.arrivals = itertools.count()
+        self.timer: asyncio.TimerHandle | None = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        """Take a token if one's free and nobody is queued ahead of us"""
+        if not self.rate:
+            return True
+        self._refill()
+        if self.waiters or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self) -> float:
+        """Seconds until the next token"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def take(self, prio: int = NORMAL) -> None:
+        if self.try_take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (prio, next(self.arrivals), future))
+        self._arm()
+        await future
+
+    def take_sync(self) -> None:
+        """Blocking version for the sync wrappers, these don't get to jump the queue"""
+        while not self.try_take():
+            time.sleep(self.delay() or 0.01)
+
+    def _arm(self) -> None:
+        if self.timer is None and self.waiters:
+            self.timer = asyncio.get_running_loop().call_later(self.delay(), self._release)
+
+    def _release(self) -> None:
+        self.timer = None
+        self._refill()
+        while self.waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self.waiters)
+            # Cancelled while queued, it doesn't need a token any more
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+        self._arm()
+
+
+class MonthlyBudget:
+    """Requests used per provider this calendar month (UTC), stored in SQLite"""
+
+    def __init__(self, path: str | None = None):
+        self.path = path or DB_PATH
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS usage (
+                provider TEXT NOT NULL,
+                month TEXT NOT NULL,
+                used INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (provider, month)
+            )"""
+        )
+        self.month = current_month()
+        self.reload()
+
+    def reload(self) -> None:
+        """Re-read the counts, for when more than one process spends from the same budget"""
+        self.used = dict(
+            self.conn.execute("SELECT provider, used FROM usage WHERE month = ?", (self.month,)).fetchall()
+        )
+
+    def _roll_over(self) -> None:
+        month = current_month()
+        if month != self.month:
+            qtLog.info(f"New month {month}, budgets reset")
+            self.month = month
+            self.used = {}
+
+    def spend(self, provider: str, count: int = 1) -> None:
+        self._roll_over()
+        self.used[provider] = self.used.get(provider, 0) + count
+        self.conn.execute(
+            """INSERT INTO usage (provider, month, used) VALUES (?, ?, ?)
+               ON CONFLICT(provider, month) DO UPDATE SET used = used + excluded.used""",
+            (provider, self.month, count),
+        )
+
+    def spent(self, provider: str) -> int:
+        self._roll_over()
+        return self.used.get(provider, 0)
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def current_month() -> str:
+    return time.strftime("%Y-%m", time.gmtime())
+
+
+def month_elapsed(now: float | None = None) -> float:
+    """Share of the current UTC month that's gone by, 0 to 1"""
+    now = time.time() if now is None else now
+    current = time.gmtime(now)
+    days = calendar.monthrange(current.tm_year, current.tm_mon)[1]
+    start = calendar.timegm((current.tm_year, current.tm_mon, 1, 0, 0, 0))
+    return (now - start) / (days * 24 * 60 * 60)
+
+
+@dataclass
+class QuotaManager:
+    """Buckets and budget for every provider in LIMITS"""
+
+    budget: MonthlyBudget
+    buckets: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        for provider, limits in LIMITS.items():
+            self.buckets[provider] = TokenBucket(limits.rate, limits.burst)
+
+    def remaining(self, provider: str) -> float:
+        """Share of this month's budget left, 1 when there's no budget"""
+        monthly = LIMITS[provider].monthly
+        if not monthly:
+            return 1.0
+        return max(0.0, 1 - self.budget.spent(provider) / monthly)
+
+    def allowed(self, provider: str, prio: int) -> bool:
+        """Landing checks can use the reserve, everything else stops short of it"""
+        remaining = self.remaining(provider)
+        if prio == LANDING:
+            return remaining > 0
+        return remaining > RESERVE
+
+    def stretch(self, provider: str, now: float | None = None) -> float:
+        """
+        How much to slow routine polling down, 1 while we're on pace for the month.
+        If the current rate would overshoot the budget we slow down by the overshoot
+        """
+        monthly = LIMITS[provider].monthly
+        if not monthly:
+            return 1.0
+        # Don't read much into the first day of the month
+        elapsed = max(month_elapsed(now), 1 / 30)
+        projected = self.budget.spent(provider) / elapsed
+        return min(MAX_STRETCH, max(1.0, projected / monthly))
+
+    async def acquire(self, provider: str) -> bool:
+        """
+        Wait for a token, returns False without waiting if the budget can't cover
+        a request at the current priority
+        """
+        prio = priority.get()
+        if not self.allowed(provider, prio):
+            metrics.quota_rejected.inc(provider=provider, priority=PRIORITY_NAMES[prio])
+            return False
+        with metrics.quota_wait_seconds.time(provider=provider):
+            await self.buckets[provider].take(prio)
+        self.budget.spend(provider)
+        return True
+
+    def acquire_sync(self, provider: str) -> bool:
+        prio = priority.get()
+        if not self.allowed(provider, prio):
+            metrics.quota_rejected.inc(provider=provider, priority=PRIORITY_NAMES[prio])
+            return False
+        self.buckets[provider].take_sync()
+        self.budget.spend(provider)
+        return True
+
+    def summary(self) -> str:
+        lines = []
+        for provider, limits in LIMITS.items():
+            if limits.monthly:
+                lines.append(
+                    f"{provider} budget: {self.budget.spent(provider)}/{limits.monthly} used this month, "
+                    f"polling x{self.stretch(provider):.1f} slower"
+                )
+            else:
+                lines.append(f"{provider}: {self.budget.spent(provider)} requests this month, no budget set")
+        return "\n".join(lines)
+
+
+# Opened on first use so importing this module doesn't touch the disk
+_manager: QuotaManager | None = None
+
+
+def manager() -> QuotaManager:
+    global _manager
+    if _manager is None:
+        _manager = QuotaManager(MonthlyBudget())
+        qtLog.info(f"Loaded API budget from {_manager.budget.path}")
+    return _manager
+
+
+def share(parts: int) -> None:
+    """
+    Cut the per second limits down to one of parts equal shares, for processes that
+    send requests side by side. Buckets that already exist pick the new limits up too
+    """
+    parts = max(parts, 1)
+    for provider, limits in LIMITS.items():
+        limits.rate /= parts
+        limits.burst = max(limits.burst / parts, 1)
+        if _manager is not None:
+            bucket = _manager.buckets[provider]
+            bucket.rate = limits.rate
+            bucket.burst = max(limits.burst, 1.0)
+            bucket.tokens = min(bucket.tokens, bucket.burst)
+
+
+def budget_exhausted(provider: str) -> dict:
+    """Same shape as a failed ADSB request, so callers treat it as a failed poll"""
+    return {"message": f"Skipped, not enough {provider} budget left for this poll", "transient": True}
+
+
+def close() -> None:
+    global _manager
+    if _manager is not None:
+        _manager.budget.close()
+        _manager = None
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# flighttracker/registry.py
+
+"""
+Offline registration <-> hex index, so an aircraft can be resolved (and its type
+and owner looked up) without spending an API request on it. A bulk registry file,
+the FAA master file or any CSV with registration and hex columns, is compiled once
+into a sorted binary file that's memory mapped, so opening it costs next to nothing
+and each lookup is a binary search that only touches a few pages.
+
+Usage: ./registry.py compile MASTER.txt [--aircraft-ref ACFTREF.txt] [-o aircraft_registry.bin]
+       ./registry.py lookup N621MM a1013f
+"""
+
+import argparse
+import csv
+from dataclasses import dataclass
+import logging as log
+import mmap
+import os
+import struct
+
+import numpy as np
+
+rgLog = log.getLogger("registry")
+
+# Enable logging
+rgLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+rgLog.propagate = False
+
+# Add the console handler to the logger
+rgLog.addHandler(handler)
+
+PATH = os.environ.get("FT_REGISTRY", "aircraft_registry.bin")
+
+MAGIC = b"FTREG001"
+# Magic, then the number of aircraft
+HEADER = struct.Struct("<8sQ")
+# Registrations are stored in a fixed 8 bytes, longer ones are left out
+REG_WIDTH = 8
+# Splits type from owner in the details blob
+FIELD_SEPARATOR = "\x1f"
+
+
+@dataclass
+class Aircraft:
+    """One registry entry"""
+
+    hex_id: str
+    registration: str
+    aircraft_type: str
+    owner: str
+
+
+def normalise_reg(reg: str) -> str:
+    return reg.strip().upper()
+
+
+def normalise_hex(hex_id: str) -> int | None:
+    """Hex ID as a number, None if it isn't a 24 bit hex code"""
+    try:
+        value = int(hex_id.strip(), 16)
+    except ValueError:
+        return None
+    return value if 0 < value < 1 << 24 else None
+
+
+def layout(count: int) -> dict:
+    """
+    Byte offset of each section for a file holding count aircraft. The 4 byte
+    columns go first so every section stays aligned
+    """
+    offsets = {}
+    position = HEADER.size
+    for name, size in (
+        ("hex", 4 * count),
+        ("reg_row", 4 * count),
+        ("details_end", 4 * (count + 1)),
+        ("reg_by_hex", REG_WIDTH * count),
+        ("reg_sorted", REG_WIDTH * count),
+    ):
+        offsets[name] = position
+        position += size
+    offsets["details"] = position
+    return offsets
+
+
+def faa_rows(path: str, aircraft_ref: str | None = None):
+    """
+    (registration, hex, type, owner) from the FAA's MASTER.txt. The type is the
+    manufacturer and model from ACFTREF.txt if there's one next to it, otherwise its code
+    """
+    models = {}
+    if aircraft_ref is None:
+        guess = os.path.join(os.path.dirname(path), "ACFTREF.txt")
+        aircraft_ref = guess if os.path.exists(guess) else None
+    if aircraft_ref:
+        with open(aircraft_ref, encoding="utf-8-sig", errors="replace", newline="") as ref:
+            for row in csv.DictReader(ref):
+                row = {key.strip(): (value or "").strip() for key, value in row.items() if key}
+                models[row.get("CODE", "")] = f"{row.get('MFR', '')} {row.get('MODEL', '')}".strip()
+    with open(path, encoding="utf-8-sig", errors="replace", newline="") as master:
+        for row in csv.DictReader(master):
+            row = {key.strip(): (value or "").strip() for key, value in row.items() if key}
+            code = row.get("MFR MDL CODE", "")
+            # N-numbers are stored without their N
+            yield "N" + row.get("N-NUMBER", ""), row.get("MODE S CODE HEX", ""), models.get(code, code), row.get("NAME", "")
+
+
+def csv_rows(path: str):
+    """(registration, hex, type, owner) from a CSV with a header, e.g. the OpenSky aircraft database"""
+    columns = {
+        "registration": ("registration", "reg", "r"),
+        "hex": ("hex", "icao24", "icao", "mode_s"),
+        "type": ("type", "typecode", "model", "aircraft_type"),
+        "owner": ("owner", "operator", "registrant"),
+    }
+    with open(path, encoding="utf-8-sig", errors="replace", newline="") as source:
+        reader = csv.DictReader(source)
+        header = {name.strip().lower(): name for name in reader.fieldnames or ()}
+        picked = {
+            field: next((header[name] for name in names if name in header), None)
+            for field, names in columns.items()
+        }
+        if picked["registration"] is None or picked["hex"] is None:
+            raise ValueError(f"{path} needs registration and hex columns, found {list(header)}")
+        for row in reader:
+            yield tuple((row.get(picked[field]) or "").strip() if picked[field] else "" for field in columns)
+
+
+def compile_registry(rows, out_path: str = PATH) -> int:
+    """Write (registration, hex, type, owner) rows out as an index, returns how many made it in"""
+    entries = {}
+    seen_regs = set()
+    skipped = 0
+    for reg, hex_id, aircraft_type, owner in rows:
+        reg = normalise_reg(reg)
+        value = normalise_hex(hex_id)
+        encoded = reg.encode("ascii", "replace")
+        # Deregistered aircraft keep their row with no hex, and we can't index what doesn't fit
+        if value is None or not reg or len(encoded) > REG_WIDTH:
+            skipped += 1
+            continue
+        # First one wins if a hex or registration shows up twice
+        if value in entries or reg in seen_regs:
+            skipped += 1
+            continue
+        seen_regs.add(reg)
+        entries[value] = (encoded, f"{aircraft_type}{FIELD_SEPARATOR}{owner}".encode())
+
+    count = len(entries)
+    hexes = np.array(sorted(entries), dtype="<u4")
+    regs = np.array([entries[value][0] for value in hexes.tolist()], dtype=f"S{REG_WIDTH}")
+    reg_order = np.argsort(regs, kind="stable").astype("<u4")
+    details = [entries[value][1] for value in hexes.tolist()]
+    details_end = np.zeros(count + 1, dtype="<u4")
+    np.cumsum([len(detail) for detail in details], out=details_end[1:])
+
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(HEADER.pack(MAGIC, count))
+        for column in (hexes, reg_order, details_end, regs, regs[reg_order]):
+            out.write(column.tobytes())
+        out.write(b"".join(details))
+    # Swapped in whole so a running bot never maps a half written file
+    os.replace(tmp_path, out_path)
+    rgLog.info(f"Compiled {count} aircraft into {out_path}, skipped {skipped} rows")
+    return count
+
+
+class Registry:
+    """Memory mapped index written by compile_registry, all lookups are binary searches"""
+
+    def __init__(self, path: str = PATH):
+        self.path = path
+        with open(path, "rb") as index:
+            self.map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} isn't an aircraft registry index")
+        self.count = count
+        offsets = layout(count)
+        # Views straight onto the mapping, nothing is read until it's looked at
+        self.hexes = np.frombuffer(self.map, dtype="<u4", count=count, offset=offsets["hex"])
+        self.reg_row = np.frombuffer(self.map, dtype="<u4", count=count, offset=offsets["reg_row"])
+        self.details_end = np.frombuffer(self.map, dtype="<u4", count=count + 1, offset=offsets["details_end"])
+        self.reg_by_hex = np.frombuffer(self.map, dtype=f"S{REG_WIDTH}", count=count, offset=offsets["reg_by_hex"])
+        self.reg_sorted = np.frombuffer(self.map, dtype=f"S{REG_WIDTH}", count=count, offset=offsets["reg_sorted"])
+        self.details_start = offsets["details"]
+
+    def _row_for_hex(self, hex_id: str) -> int | None:
+        value = normalise_hex(hex_id)
+        if value is None or not self.count:
+            return None
+        row = int(np.searchsorted(self.hexes, value))
+        return row if row < self.count and self.hexes[row] == value else None
+
+    def _row_for_reg(self, reg: str) -> int | None:
+        encoded = normalise_reg(reg).encode("ascii", "replace")
+        if not encoded or len(encoded) > REG_WIDTH or not self.count:
+            return None
+        position = int(np.searchsorted(self.reg_sorted, encoded))
+        if position < self.count and self.reg_sorted[position] == encoded:
+            return int(self.reg_row[position])
+        return None
+
+    def _entry(self, row: int) -> Aircraft:
+        start = self.details_start + int(self.details_end[row])
+        end = self.details_start + int(self.details_end[row + 1])
+        aircraft_type, _, owner = self.map[start:end].decode(errors="replace").partition(FIELD_SEPARATOR)
+        return Aircraft(f"{int(self.hexes[row]):06x}", self.reg_by_hex[row].decode(), aircraft_type, owner)
+
+    def by_hex(self, hex_id: str) -> Aircraft | None:
+        row = self._row_for_hex(hex_id)
+        return None if row is None else self._entry(row)
+
+    def by_registration(self, reg: str) -> Aircraft | None:
+        row = self._row_for_reg(reg)
+        return None if row is None else self._entry(row)
+
+    def lookup(self, hex_id: str = "", reg: str = "") -> Aircraft | None:
+        """Entry for whichever of the two we have, hex first"""
+        entry = self.by_hex(hex_id) if hex_id else None
+        if entry is None and reg:
+            entry = self.by_registration(reg)
+        return entry
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        # The numpy views hold the mapping open, they have to go first
+        self.hexes = self.reg_row = self.details_end = self.reg_by_hex = self.reg_sorted = None
+        self.map.close()
+
+
+# Opened on first use, False once we know there's no index to open
+_registry: Registry | None | bool = None
+
+
+def registry() -> Registry | None:
+    """The shared index, None if there isn't one"""
+    global _registry
+    if _registry is None:
+        try:
+            _registry = Registry(PATH)
+            rgLog.info(f"Loaded {len(_registry)} aircraft from {PATH}")
+        except FileNotFoundError:
+            _registry = False
+        except ValueError as err:
+            rgLog.error(err)
+            _registry = False
+    return _registry or None
+
+
+def find(hex_id: str = "", reg: str = "") -> Aircraft | None:
+    """Registry.lookup on the shared index, None without one"""
+    index = registry()
+    return None if index is None else index.lookup(hex_id, reg)
+
+
+def resolve(flight) -> Aircraft | None:
+    """
+    Fill in whichever of a FlightData's hex ID and registration is missing from the
+    index, returns the entry so callers can show the type and owner
+    """
+    entry = find(flight.hex_id, flight.registration)
+    if entry is None:
+        return None
+    if not flight.hex_id:
+        flight.set_hex(entry.hex_id)
+    if not flight.registration:
+        flight.set_registration(entry.registration)
+    return entry
+
+
+def describe(entry: Aircraft | None) -> str:
+    """Type and owner for a message, empty if we don't know either"""
+    if entry is None:
+        return ""
+    return ", ".join(part for part in (entry.aircraft_type, entry.owner) if part)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("compile", help="build the index from a bulk registry file")
+    build.add_argument("source", help="FAA MASTER.txt, or a CSV with registration and hex columns")
+    build.add_argument("--aircraft-ref", help="FAA ACFTREF.txt for type names, found next to MASTER.txt by default")
+    build.add_argument("-o", "--output", default=PATH)
+    find = commands.add_parser("lookup", help="look IDs up in the index")
+    find.add_argument("ids", nargs="+")
+    find.add_argument("--index", default=PATH)
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        with open(args.source, encoding="utf-8-sig", errors="replace") as source:
+            faa = "N-NUMBER" in source.readline().upper()
+        rows = faa_rows(args.source, args.aircraft_ref) if faa else csv_rows(args.source)
+        compile_registry(rows, args.output)
+        return
+    index = Registry(args.index)
+    for fl_id in args.ids:
+        entry = index.lookup(fl_id if normalise_hex(fl_id) is not None and len(fl_id) == 6 else "", fl_id)
+        print(f"{fl_id}: {entry if entry is not None else 'not found'}")
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# flighttracker/scheduler.py
+
+"""
+Works out when each aircraft should be polled next, based on what we already know
+about it instead of polling everything on the same fixed interval, and runs the one
+loop that polls them when they're due
+"""
+
+import asyncio
+from collections import deque
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import logging as log
+import os
+import time
+
+import adsb_info
+import backoff
+import quota
+
+scLog = log.getLogger("scheduler")
+
+# Enable logging
+scLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+scLog.propagate = False
+
+# Add the console handler to the logger
+scLog.addHandler(handler)
+
+# Longest the poll loop sleeps for, it normally wakes up when the next aircraft is due
+TICK = float(os.environ.get("FT_POLL_TICK", 30))
+# Starting interval while on the ground, doubles every poll up to GROUND_MAX. That's the
+# tradeoff, a plane that's sat parked for a while has its takeoff noticed up to GROUND_MAX
+# late (a hop shorter than that can be missed) in exchange for a quarter of the ground polls
+BASE_INTERVAL = float(os.environ.get("FT_POLL_BASE", 300))
+GROUND_MAX = max(float(os.environ.get("FT_POLL_GROUND_MAX", 4 * BASE_INTERVAL)), BASE_INTERVAL)
+# While in cruise, and once the estimated landing is within APPROACH_WINDOW
+CRUISE_INTERVAL = float(os.environ.get("FT_POLL_CRUISE", 900))
+APPROACH_WINDOW = float(os.environ.get("FT_POLL_APPROACH_WINDOW", 1200))
+APPROACH_INTERVAL = float(os.environ.get("FT_POLL_APPROACH", 60))
+
+
+class PollScheduler:
+    """
+    Keeps a next due time per aircraft and tracks how many polls we're actually making.
+    Due times sit in a heap, rescheduling pushes a new entry and leaves the old one
+    to be skipped when it comes up, so scheduling, rescheduling and cancelling are
+    all O(log n) at worst
+    """
+
+    def __init__(self):
+        # id -> epoch seconds the aircraft is next due, the heap entry matching it is the live one
+        self.next_due = {}
+        # (due, arrival, id), may hold stale entries for rescheduled or removed IDs
+        self.heap = []
+        self.arrivals = itertools.count()
+        # id -> polls in a row that found it on the ground
+        self.ground_polls = {}
+        # IDs that keep coming back empty or with an error, polled less and less often
+        self.misses = backoff.NegativeCache()
+        # Times of recent polls, used for the request rate
+        self.polls = deque()
+        # Set when something is scheduled sooner than the poll loop is sleeping for
+        self.wakeup = asyncio.Event()
+        self.sleeping_until = float("inf")
+
+    def schedule(self, fl_id: str, when: float | None = None) -> None:
+        """Poll fl_id at when, right away if not given, replacing any earlier schedule"""
+        when = time.time() if when is None else when
+        self.next_due[fl_id] = when
+        heapq.heappush(self.heap, (when, next(self.arrivals), fl_id))
+        # Stale entries pile up when aircraft are rescheduled earlier, clear them out now and then
+        if len(self.heap) > 2 * len(self.next_due) + 64:
+            self.heap = [(due, n, key) for due, n, key in self.heap if self.next_due.get(key) == due]
+            heapq.heapify(self.heap)
+        if when < self.sleeping_until:
+            self.wakeup.set()
+
+    def due(self, now: float | None = None, tracked=None) -> dict:
+        """
+        {id: when it was due} for everything due by now. They're booked in again for
+        BASE_INTERVAL in case the poll never reschedules them. IDs not in tracked are dropped
+        """
+        now = time.time() if now is None else now
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            when, _, fl_id = heapq.heappop(self.heap)
+            if self.next_due.get(fl_id) != when:
+                continue
+            if tracked is not None and fl_id not in tracked:
+                self.remove(fl_id)
+                continue
+            due[fl_id] = when
+        for fl_id in due:
+            self.schedule(fl_id, now + BASE_INTERVAL)
+        return due
+
+    def next_wake(self) -> float | None:
+        """When the next aircraft is due, None if nothing's scheduled"""
+        while self.heap and self.next_due.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    async def run(self, poll, tracked) -> None:
+        """
+        Polls aircraft as they come due, forever. poll(due) is awaited with the
+        {id: due time} of each batch, tracked is what's still being tracked
+        """
+        while True:
+            self.wakeup.clear()
+            due = self.due(tracked=tracked)
+            if due:
+                try:
+                    await poll(due)
+                except Exception as err:  # pylint: disable=broad-except
+                    scLog.exception(f"Poll of {len(due)} aircraft failed: {err}")
+            wake = self.next_wake()
+            self.sleeping_until = min(wake, time.time() + TICK) if wake is not None else time.time() + TICK
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(self.sleeping_until - time.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self.sleeping_until = float("inf")
+
+    def interval(self, fl_id: str, flight, now: float) -> float:
+        """Seconds until the next poll for a flight in its current state"""
+        if not flight.plane_in_air:
+            if not adsb_info.is_awake():
+                return max(seconds_until_awake(now), APPROACH_INTERVAL)
+            polls = self.ground_polls.get(fl_id, 0)
+            # Routine polls are the first thing to give when the ADSB budget runs low
+            interval = min(BASE_INTERVAL * 2 ** max(polls - 1, 0), GROUND_MAX) * quota.manager().stretch("adsb")
+            return max(interval, self.misses.delay(fl_id, now))
+        eta = flight.eta()
+        if eta is None:
+            return BASE_INTERVAL
+        remaining = eta - now
+        if remaining > APPROACH_WINDOW:
+            # Sleep through cruise, but wake up in time for the approach
+            return max(min(CRUISE_INTERVAL, remaining - APPROACH_WINDOW), APPROACH_INTERVAL)
+        return APPROACH_INTERVAL
+
+    def record(self, fl_id: str, flight, now: float | None = None, polled: bool = True) -> float:
+        """
+        Schedule the next poll for fl_id from its current state, returns the interval.
+        polled=False reschedules without counting a request or a step of the ground
+        backoff, e.g. outside awake time or for a check on feed data
+        """
+        now = time.time() if now is None else now
+        if polled:
+            self.polls.append(now)
+        if flight.plane_in_air or not adsb_info.is_awake():
+            # Backoff starts over after a flight, and with every awake window
+            self.ground_polls.pop(fl_id, None)
+        elif polled:
+            self.ground_polls[fl_id] = self.ground_polls.get(fl_id, 0) + 1
+        interval = self.interval(fl_id, flight, now)
+        self.schedule(fl_id, now + interval)
+        scLog.debug(f"Next poll for {fl_id} in {interval:.0f}s")
+        return interval
+
+    def note_response(self, fl_id: str, flight, j_resp, now: float | None = None) -> float:
+        """
+        Count a response towards fl_id's miss backoff, returns how long it's backed
+        off for, 0 if it isn't. Flights in the air are never backed off, a landing check can't wait
+        """
+        if backoff.is_hit(j_resp):
+            self.misses.hit(fl_id)
+            return 0.0
+        if flight.plane_in_air or not backoff.is_miss(j_resp, flight):
+            return 0.0
+        # Not found might be parked, it can't wait longer than a parked plane would
+        return self.misses.miss(fl_id, now, None if backoff.is_bad_id(j_resp) else GROUND_MAX)
+
+    def restore_misses(self, fl_id: str, misses: int, delay: float | None = None) -> None:
+        """
+        Pick up fl_id's miss backoff from a snapshot. Without the wait it had left we can't
+        tell a bad ID from a parked plane, so it's capped like an empty answer would be
+        """
+        self.misses.restore(fl_id, misses, delay, max_wait=GROUND_MAX)
+
+    def remove(self, fl_id: str) -> None:
+        """Cancel an aircraft's polls, its heap entry is skipped when it comes up"""
+        self.next_due.pop(fl_id, None)
+        self.ground_polls.pop(fl_id, None)
+        self.misses.remove(fl_id)
+
+    def request_rate(self, window: float = 3600, now: float | None = None) -> float:
+        """Polls per hour over the last window seconds"""
+        now = time.time() if now is None else now
+        while self.polls and self.polls[0] < now - window:
+            self.polls.popleft()
+        return len(self.polls) * 3600 / window
+
+    def stats(self) -> dict:
+        """Effective request rate next to what polling everything every BASE_INTERVAL would cost"""
+        return {
+            "tracked": len(self.next_due),
+            "backed_off": len(self.misses),
+            "requests_per_hour": self.request_rate(),
+            "fixed_requests_per_hour": len(self.next_due) * 3600 / BASE_INTERVAL,
+        }
+
+
+def seconds_until_awake(now: float) -> float:
+    """Seconds from now until the start of the next awake window"""
+    current = datetime.fromtimestamp(now)
+    wake = current.replace(hour=adsb_info.awakeTime[0], minute=0, second=0, microsecond=0)
+    if wake <= current:
+        wake += timedelta(days=1)
+    return (wake - current).total_seconds()
@@ -0,0 +1,293 @@
+# flighttracker/shards.py
+
+"""
+Sharded mode, spreads polling over worker processes so one core isn't the limit.
+The coordinator lives in the bot process and hands each aircraft to a worker by
+hashing its hex ID. Workers poll and classify their shard with the same code the
+single process bot uses, and only send back state changes
+"""
+
+import asyncio
+import logging as log
+import multiprocessing
+import os
+import threading
+import zlib
+
+import quota
+import state_store
+
+shLog = log.getLogger("shards")
+
+# Enable logging
+shLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+shLog.propagate = False
+
+# Add the console handler to the logger
+shLog.addHandler(handler)
+
+# Number of worker processes, 0 keeps everything in the bot process
+SHARDS = int(os.environ.get("FT_SHARDS", 0))
+
+
+def shard_key(fl_id: str, flight) -> str:
+    """What an aircraft is hashed on, the hex ID once we know it"""
+    return (flight.hex_id or fl_id).lower() if flight is not None else fl_id.lower()
+
+
+def pick_worker(key: str, workers) -> int:
+    """
+    Rendezvous hashing, every worker gets a score for the key and the highest wins.
+    Adding or losing a worker only moves the aircraft that scored highest on it
+    """
+    return max(workers, key=lambda worker: zlib.crc32(f"{key}:{worker}".encode()))
+
+
+def snapshot(fl_id: str, id_type: str, recurring: bool, flight, poll_scheduler=None, track_store=None) -> dict:
+    """Everything a worker needs to carry on with an aircraft, landing checks included"""
+    snap = {"fl_id": fl_id, "id_type": id_type, "recurring": recurring, "flight": state_store.flight_row(flight)}
+    if poll_scheduler is not None:
+        snap["next_due"] = poll_scheduler.next_due.get(fl_id)
+        snap["ground_polls"] = poll_scheduler.ground_polls.get(fl_id, 0)
+        snap["misses"] = poll_scheduler.misses.misses.get(fl_id, 0)
+        snap["miss_delay"] = poll_scheduler.misses.delay(fl_id)
+    if track_store is not None:
+        # Without the history a plane that's dropped off ADSB would be called landed straight away
+        samples = track_store.last(flight.cache_key())
+        snap["track"] = {name: column.tolist() for name, column in samples.items()}
+    return snap
+
+
+class Worker:
+    """One worker process and the pipe to it"""
+
+    def __init__(self, index: int, on_message):
+        self.index = index
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=worker_main, args=(index, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+        loop = asyncio.get_running_loop()
+
+        def read():
+            while True:
+                try:
+                    message = self.conn.recv()
+                except (EOFError, OSError):
+                    message = {"op": "exited"}
+                try:
+                    loop.call_soon_threadsafe(on_message, index, message)
+                except RuntimeError:
+                    # The bot's loop has already shut down
+                    return
+                if message["op"] == "exited":
+                    return
+
+        threading.Thread(target=read, name=f"shard-{index}-reader", daemon=True).start()
+
+    def send(self, message: dict) -> None:
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, OSError) as err:
+            shLog.error(f"Shard {self.index} is gone: {err}")
+
+    def stop(self) -> None:
+        self.send({"op": "stop"})
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class Coordinator:
+    """
+    Keeps track of which worker owns which aircraft. on_event(message) is called on
+    the bot's loop for every takeoff/landing a worker reports. latest(fl_id) returns
+    the newest snapshot the bot has of an aircraft, used to rebuild a worker that died
+    """
+
+    def __init__(self, count: int, on_event, latest):
+        self.count = count
+        self.on_event = on_event
+        self.latest = latest
+        self.workers = {}
+        # fl_id -> worker index
+        self.owner = {}
+        # fl_id -> worker index it's moving to, waiting for the old one to let go
+        self.moving = {}
+        self.stopping = False
+
+    def start(self) -> None:
+        # The bot process still looks aircraft up for /add and /start, it gets a share
+        # of the rate limits like each worker does
+        quota.share(self.count + 1)
+        for index in range(self.count):
+            self.workers[index] = Worker(index, self.on_message)
+        shLog.info(f"Started {self.count} shard workers")
+
+    def add(self, snap: dict) -> None:
+        """Hand an aircraft to its worker, replacing whatever that worker had for it"""
+        fl_id = snap["fl_id"]
+        key = shard_key(fl_id, state_store.restore_flight(snap["flight"]))
+        index = pick_worker(key, self.workers)
+        previous = self.owner.get(fl_id)
+        if previous is not None and previous != index:
+            # The hex ID changed its hash, let the old worker finish with it first
+            self.move(fl_id, index)
+            return
+        self.owner[fl_id] = index
+        self.workers[index].send({"op": "add", **snap})
+
+    def remove(self, fl_id: str) -> None:
+        index = self.owner.pop(fl_id, None)
+        self.moving.pop(fl_id, None)
+        if index is not None and index in self.workers:
+            self.workers[index].send({"op": "remove", "fl_id": fl_id})
+
+    def move(self, fl_id: str, index: int) -> None:
+        """
+        Move an aircraft between workers. The old worker only lets go between sweeps
+        and sends its full state along, so a landing check carries on where it was
+        """
+        old = self.owner.get(fl_id)
+        self.moving[fl_id] = index
+        if old is None or old not in self.workers:
+            snap = self.latest(fl_id)
+            if snap is not None:
+                self.released({"op": "released", **snap})
+            return
+        self.workers[old].send({"op": "release", "fl_id": fl_id})
+
+    def released(self, message: dict) -> None:
+        fl_id = message["fl_id"]
+        index = self.moving.pop(fl_id, None)
+        if index is None or index not in self.workers:
+            # Removed while it was moving
+            return
+        self.owner[fl_id] = index
+        self.workers[index].send({**message, "op": "add"})
+
+    def on_message(self, index: int, message: dict) -> None:
+        op = message.get("op")
+        if op == "event":
+            self.on_event(message)
+        elif op == "released":
+            self.released(message)
+        elif op == "exited" and not self.stopping and index in self.workers:
+            shLog.error(f"Shard {index} exited, restarting it")
+            self.workers[index] = Worker(index, self.on_message)
+            for fl_id, owner in self.owner.items():
+                snap = self.latest(fl_id) if owner == index else None
+                if snap is not None:
+                    self.workers[index].send({"op": "add", **snap})
+
+    def stop(self) -> None:
+        self.stopping = True
+        for worker in self.workers.values():
+            worker.stop()
+        self.workers.clear()
+
+
+def worker_main(index: int, conn) -> None:
+    """Entry point of a worker process"""
+    asyncio.run(worker_loop(index, conn))
+
+
+async def worker_loop(index: int, conn) -> None:
+    # Imported here, the bot process imports this module and not the other way round
+    import flight_bot
+    import http_client
+
+    flight_bot.configureLogging()
+    flight_bot.active_flight_list.clear()
+    # The rate limits are for the whole bot, split between the workers and the bot process
+    quota.share(SHARDS + 1)
+    # Takeoffs and landings go back to the bot process instead of to Telegram
+    flight_bot.event_sink = conn.send
+    loop = asyncio.get_running_loop()
+    commands = asyncio.Queue()
+    # Held for a whole sweep, an aircraft is only handed over between sweeps
+    sweeping = asyncio.Lock()
+
+    def read():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = {"op": "stop"}
+            loop.call_soon_threadsafe(commands.put_nowait, message)
+            if message["op"] == "stop":
+                return
+
+    async def poll(due: dict):
+        # Other workers spend from the same monthly budget
+        quota.manager().budget.reload()
+        async with sweeping:
+            # Released while we waited for the lock
+            due = {fl_id: when for fl_id, when in due.items() if fl_id in flight_bot.active_flight_list}
+            await flight_bot.poll_due(None, due)
+
+    threading.Thread(target=read, name="coordinator-reader", daemon=True).start()
+    ticker = asyncio.create_task(flight_bot.poll_scheduler.run(poll, flight_bot.active_flight_list))
+    shLog.info(f"Shard {index} ready")
+    while True:
+        message = await commands.get()
+        op = message["op"]
+        if op == "add":
+            install(flight_bot, message)
+        elif op == "remove":
+            uninstall(flight_bot, message["fl_id"])
+        elif op == "release":
+            async with sweeping:
+                snap = release(flight_bot, message["fl_id"])
+            if snap is not None:
+                conn.send({"op": "released", **snap})
+        elif op == "stop":
+            break
+    ticker.cancel()
+    await http_client.aclose()
+
+
+def install(bot, snap: dict) -> None:
+    """Start tracking an aircraft in this worker, picking up from a snapshot"""
+    fl_id = snap["fl_id"]
+    flight = state_store.restore_flight(snap["flight"])
+    if flight is None:
+        return
+    keys = [key for key in (fl_id, flight.hex_id, flight.registration) if key]
+    if fl_id in bot.flight_dict:
+        bot.flight_dict.replace(fl_id, flight)
+    bot.flight_dict.add_mapping(flight, *keys)
+    bot.active_flight_list[fl_id] = [snap["id_type"], snap["recurring"]]
+    # Carries on with the old worker's schedule, or polls it straight away if it's new
+    bot.poll_scheduler.schedule(fl_id, snap.get("next_due"))
+    bot.poll_scheduler.ground_polls[fl_id] = snap.get("ground_polls", 0)
+    bot.poll_scheduler.restore_misses(fl_id, snap.get("misses", 0), snap.get("miss_delay"))
+    track = snap.get("track")
+    if track:
+        key = flight.cache_key()
+        bot.track_store.remove(key)
+        for sample in zip(*(track[name] for name in bot.track_history.FIELDS)):
+            bot.track_store.append(key, sample)
+
+
+def uninstall(bot, fl_id: str) -> None:
+    bot.active_flight_list.pop(fl_id, None)
+    bot.poll_scheduler.remove(fl_id)
+    if fl_id in bot.flight_dict:
+        bot.track_store.remove(bot.flight_dict[fl_id].cache_key())
+        bot.flight_dict.remove(fl_id)
+
+
+def release(bot, fl_id: str) -> dict | None:
+    """Stop tracking an aircraft and return its full state for the next worker"""
+    if fl_id not in bot.active_flight_list or fl_id not in bot.flight_dict:
+        return None
+    id_type, recurring = bot.active_flight_list[fl_id]
+    snap = snapshot(fl_id, id_type, recurring, bot.flight_dict[fl_id], bot.poll_scheduler, bot.track_store)
+    uninstall(bot, fl_id)
+    return snap
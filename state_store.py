@@ -0,0 +1,167 @@
+# flighttracker/state_store.py
+
+"""
+Durable copy of the tracked flights, so a restart picks up where we left off
+without going back to the network for every aircraft
+"""
+
+import logging as log
+import os
+import sqlite3
+import time
+
+from adsb_info import FlightData
+
+stLog = log.getLogger("state_store")
+
+# Enable logging
+stLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+stLog.propagate = False
+
+# Add the console handler to the logger
+stLog.addHandler(handler)
+
+DB_PATH = os.environ.get("FT_STATE_DB", "flight_state.sqlite3")
+
+
+class StateStore:
+    """
+    One row per tracked ID with what we know about the aircraft behind it. Every
+    change is committed as it happens, WAL keeps that cheap and crash safe
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path or DB_PATH
+        # Autocommit, each write is its own transaction
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS tracked (
+                id TEXT PRIMARY KEY,
+                id_type TEXT NOT NULL,
+                recurring INTEGER NOT NULL DEFAULT 0,
+                hex_id TEXT,
+                registration TEXT,
+                flight_num TEXT,
+                plane_in_air INTEGER NOT NULL DEFAULT 0,
+                origin TEXT,
+                destination TEXT,
+                estimated_on TEXT,
+                landing_source TEXT,
+                updated_at REAL
+            )"""
+        )
+        # Added after the table was, older files don't have it yet
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(tracked)")}
+        if "landing_source" not in columns:
+            self.conn.execute("ALTER TABLE tracked ADD COLUMN landing_source TEXT")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS subscriptions (
+                chat_id INTEGER NOT NULL,
+                id TEXT NOT NULL,
+                recurring INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, id)
+            )"""
+        )
+
+    def save_tracked(self, fl_id: str, id_type: str, recurring: bool) -> None:
+        """Add or update a tracked ID, leaves any aircraft data alone"""
+        self.conn.execute(
+            """INSERT INTO tracked (id, id_type, recurring, updated_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+                   id_type = excluded.id_type, recurring = excluded.recurring,
+                   updated_at = excluded.updated_at""",
+            (fl_id, id_type, int(bool(recurring)), time.time()),
+        )
+
+    def save_flight(self, fl_id: str, flight: FlightData) -> None:
+        """Record the aircraft state behind a tracked ID"""
+        self.conn.execute(
+            """UPDATE tracked SET hex_id = ?, registration = ?, flight_num = ?, plane_in_air = ?,
+                   origin = ?, destination = ?, estimated_on = ?, landing_source = ?, updated_at = ?
+               WHERE id = ?""",
+            (
+                flight.hex_id,
+                flight.registration,
+                flight.flight_num,
+                int(flight.plane_in_air),
+                flight.flight_origin,
+                flight.flight_destination,
+                flight.estimated_on(),
+                flight.landing_source,
+                time.time(),
+                fl_id,
+            ),
+        )
+
+    def remove(self, fl_id: str) -> None:
+        self.conn.execute("DELETE FROM tracked WHERE id = ?", (fl_id,))
+        self.conn.execute("DELETE FROM subscriptions WHERE id = ?", (fl_id,))
+
+    def save_subscription(self, chat_id: int, fl_id: str, recurring: bool) -> None:
+        self.conn.execute(
+            """INSERT INTO subscriptions (chat_id, id, recurring) VALUES (?, ?, ?)
+               ON CONFLICT(chat_id, id) DO UPDATE SET recurring = excluded.recurring""",
+            (chat_id, fl_id, int(bool(recurring))),
+        )
+
+    def remove_subscription(self, chat_id: int, fl_id: str) -> None:
+        self.conn.execute("DELETE FROM subscriptions WHERE chat_id = ? AND id = ?", (chat_id, fl_id))
+
+    def load_subscriptions(self) -> list:
+        """(chat, tracked ID, recurring) for every subscription"""
+        return [
+            (row["chat_id"], row["id"], bool(row["recurring"]))
+            for row in self.conn.execute("SELECT chat_id, id, recurring FROM subscriptions")
+        ]
+
+    def load(self) -> list:
+        """Every tracked row, most recently updated first"""
+        return [dict(row) for row in self.conn.execute(
+            "SELECT * FROM tracked ORDER BY updated_at DESC"
+        )]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def flight_row(flight: FlightData) -> dict:
+    """The aircraft columns of a row, what restore_flight needs to rebuild it"""
+    return {
+        "hex_id": flight.hex_id,
+        "registration": flight.registration,
+        "flight_num": flight.flight_num,
+        "plane_in_air": int(flight.plane_in_air),
+        "origin": flight.flight_origin,
+        "destination": flight.flight_destination,
+        "estimated_on": flight.estimated_on(),
+        "landing_source": flight.landing_source,
+    }
+
+
+def restore_flight(row: dict) -> FlightData | None:
+    """Rebuild a FlightData from a saved row, None if it was never resolved"""
+    if not row["hex_id"] and not row["registration"]:
+        return None
+    flight = FlightData(row["hex_id"] or row["registration"], is_reg=not row["hex_id"])
+    flight.set_hex(row["hex_id"] or "")
+    flight.set_registration(row["registration"] or "")
+    flight.flight_num = row["flight_num"] or ""
+    flight.plane_in_air = bool(row["plane_in_air"])
+    if row["origin"] or row["destination"] or row["estimated_on"]:
+        # Same shape as a cached FlightAware leg
+        flight.raw_aero_data = {
+            "origin": {"name": row["origin"] or ""},
+            "destination": {"name": row["destination"] or ""},
+        }
+        if row["estimated_on"]:
+            flight.raw_aero_data["estimated_on"] = row["estimated_on"]
+        flight.process_aero_data()
+        # Rows from before landing_source was saved only ever had FlightAware times
+        flight.landing_source = row.get("landing_source") or flight.landing_source
+    return flight
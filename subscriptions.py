@@ -0,0 +1,101 @@
+# flighttracker/subscriptions.py
+
+"""
+Which chats follow which aircraft. Each aircraft is polled once however many chats
+follow it, and every state change goes out to all of them
+"""
+
+import logging as log
+
+sbLog = log.getLogger("subscriptions")
+
+# Enable logging
+sbLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+sbLog.propagate = False
+
+# Add the console handler to the logger
+sbLog.addHandler(handler)
+
+
+class SubscriptionIndex:
+    """
+    Two dicts pointing at each other, aircraft -> {chat: recurring} and
+    chat -> {aircraft: None}, so lookups and changes are O(1) from either side.
+    Aircraft are keyed by their ID in active_flight_list
+    """
+
+    __slots__ = ("_chats", "_aircraft")
+
+    def __init__(self):
+        self._chats = {}
+        # Dicts rather than sets so /list comes out in the order things were added
+        self._aircraft = {}
+
+    def subscribe(self, chat_id: int, fl_id: str, recurring: bool) -> bool:
+        """Follow an aircraft from a chat, returns True if nobody was following it before"""
+        chats = self._chats.get(fl_id)
+        new = chats is None
+        if new:
+            chats = self._chats[fl_id] = {}
+        chats[chat_id] = bool(recurring)
+        self._aircraft.setdefault(chat_id, {})[fl_id] = None
+        sbLog.info(f"Chat {chat_id} follows {fl_id} ({'recurring' if recurring else 'one flight'}), {len(chats)} chats in all")
+        return new
+
+    def unsubscribe(self, chat_id: int, fl_id: str) -> bool:
+        """Stop following an aircraft from a chat, returns True if that was its last follower"""
+        chats = self._chats.get(fl_id)
+        if chats is None or chats.pop(chat_id, None) is None:
+            return False
+        sbLog.info(f"Chat {chat_id} stopped following {fl_id}, {len(chats)} chats left")
+        aircraft = self._aircraft[chat_id]
+        del aircraft[fl_id]
+        if not aircraft:
+            del self._aircraft[chat_id]
+        if chats:
+            return False
+        del self._chats[fl_id]
+        return True
+
+    def remove_aircraft(self, fl_id: str) -> dict:
+        """Drop every subscription to an aircraft, returns {chat: recurring} of what was dropped"""
+        chats = self._chats.pop(fl_id, {})
+        if chats:
+            sbLog.info(f"Dropped {fl_id} for {len(chats)} chats")
+        for chat_id in chats:
+            aircraft = self._aircraft[chat_id]
+            del aircraft[fl_id]
+            if not aircraft:
+                del self._aircraft[chat_id]
+        return chats
+
+    def subscribed(self, chat_id: int, fl_id: str) -> bool:
+        return chat_id in self._chats.get(fl_id, ())
+
+    def chats(self, fl_id: str) -> dict:
+        """{chat: recurring} for everyone following an aircraft"""
+        return self._chats.get(fl_id, {})
+
+    def aircraft(self, chat_id: int) -> list:
+        """Aircraft a chat follows"""
+        return list(self._aircraft.get(chat_id, ()))
+
+    def recurring(self, fl_id: str) -> bool:
+        """Whether the aircraft stays tracked after it lands, true while any chat wants it"""
+        return any(self._chats.get(fl_id, {}).values())
+
+    def one_shot(self, fl_id: str) -> list:
+        """Chats that stop following an aircraft once it lands"""
+        return [chat_id for chat_id, recurring in self._chats.get(fl_id, {}).items() if not recurring]
+
+    def chat_count(self) -> int:
+        return len(self._aircraft)
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def __contains__(self, fl_id: str) -> bool:
+        return fl_id in self._chats
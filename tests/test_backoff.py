@@ -0,0 +1,113 @@
+# flighttracker/tests/test_backoff.py
+
+"""Miss backoff for IDs that never show up, and the circuit breaker's states"""
+
+from adsb_info import FlightData
+import backoff
+from backoff import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, NegativeCache
+
+
+def test_misses_double_up_to_the_cap():
+    cache = NegativeCache(base=600, max_wait=3600)
+    waits = [cache.miss("a1013f", now=0) for _ in range(5)]
+    assert waits == [600, 1200, 2400, 3600, 3600]
+    assert cache.delay("a1013f", now=1000) == 2600
+
+
+def test_a_smaller_cap_per_miss():
+    cache = NegativeCache(base=600, max_wait=3600)
+    for _ in range(5):
+        wait = cache.miss("a1013f", now=0, max_wait=1200)
+    assert wait == 1200
+
+
+def test_a_hit_clears_it():
+    cache = NegativeCache(base=600)
+    cache.miss("a1013f", now=0)
+    cache.hit("a1013f")
+    assert "a1013f" not in cache
+    assert cache.delay("a1013f", now=0) == 0
+
+
+def test_restore_picks_up_the_count():
+    cache = NegativeCache(base=600, max_wait=3600)
+    cache.restore("a1013f", 3, now=0)
+    assert cache.misses["a1013f"] == 3
+    assert cache.delay("a1013f", now=0) == 2400
+    cache.restore("a1013f", 6, now=0, max_wait=1200)
+    assert cache.delay("a1013f", now=0) == 1200
+    cache.restore("a1013f", 6, delay=30, now=0)
+    assert cache.delay("a1013f", now=0) == 30
+    cache.restore("a1013f", 0)
+    assert "a1013f" not in cache
+
+
+def test_what_counts_as_a_miss():
+    unknown = FlightData("a1013f")
+    known = FlightData("a1013f")
+    known.registration = "N621MM"
+    assert backoff.is_miss({"message": "Invalid ID"}, known)
+    assert not backoff.is_miss({"message": "Timed out", "transient": True}, unknown)
+    assert backoff.is_miss({"ac": []}, unknown)
+    # A parked plane we know, left to the ground backoff
+    assert not backoff.is_miss({"ac": []}, known)
+    assert not backoff.is_miss({"ac": [{"hex": "a1013f"}]}, unknown)
+    assert backoff.is_bad_id({"message": "Invalid ID"})
+    assert not backoff.is_bad_id({"ac": []})
+
+
+def tripped(breaker: CircuitBreaker, now: float = 0) -> CircuitBreaker:
+    for _ in range(breaker.max_failures):
+        breaker.failure(now)
+    return breaker
+
+
+def test_opens_after_enough_failures_in_a_row():
+    breaker = CircuitBreaker("test", failures=3, cooldown=30)
+    breaker.failure(0)
+    breaker.failure(0)
+    breaker.success()
+    breaker.failure(0)
+    breaker.failure(0)
+    assert breaker.state == CLOSED
+    breaker.failure(0)
+    assert breaker.state == OPEN
+    assert not breaker.allow(10)
+
+
+def test_probe_after_the_cooldown_closes_it():
+    breaker = tripped(CircuitBreaker("test", failures=3, cooldown=30))
+    assert breaker.allow(30)
+    assert breaker.state == HALF_OPEN
+    # Only the one probe goes out
+    assert not breaker.allow(31)
+    breaker.success()
+    assert breaker.state == CLOSED
+    assert breaker.allow(31)
+
+
+def test_failed_probe_opens_it_for_longer():
+    breaker = tripped(CircuitBreaker("test", failures=3, cooldown=30))
+    breaker.allow(30)
+    breaker.failure(30)
+    assert breaker.state == OPEN
+    assert breaker.cooldown == 60
+    assert not breaker.allow(80)
+    assert breaker.allow(90)
+    breaker.success()
+    assert breaker.cooldown == 30
+
+
+def test_late_failures_while_open_dont_extend_it():
+    breaker = tripped(CircuitBreaker("test", failures=3, cooldown=30))
+    breaker.failure(20)
+    assert breaker.since == 0
+    assert breaker.allow(30)
+
+
+def test_only_rate_limits_and_server_errors_count():
+    breaker = CircuitBreaker("test", failures=1, cooldown=30)
+    breaker.record(404)
+    assert breaker.state == CLOSED
+    breaker.record(429)
+    assert breaker.state == OPEN
@@ -0,0 +1,94 @@
+# flighttracker/tests/test_classifier.py
+
+"""Takeoff and landing hysteresis, and when a plane that goes quiet is called landed"""
+
+import classifier
+from classifier import AIRBORNE, DESCENDING, LANDED, ON_GROUND, SIGNAL_LOST, TAKING_OFF
+import track_history
+
+NOW = 1_000_000.0
+
+
+def response(alt, gs=150, rate=None) -> dict:
+    ac = {"alt_baro": alt, "gs": gs}
+    if rate is not None:
+        ac["baro_rate"] = rate
+    return {"ac": [ac]}
+
+
+def test_takeoff_needs_to_clear_the_air_altitude():
+    assert classifier.classify_one(False, response("ground", gs=10)) == ON_GROUND
+    assert classifier.classify_one(False, response(classifier.AIR_ALT - 1)) == ON_GROUND
+    assert classifier.classify_one(False, response(classifier.AIR_ALT)) == TAKING_OFF
+
+
+def test_landing_needs_the_ground_altitude():
+    # Between the two altitudes at speed, it's still flying whichever way we saw it last
+    assert classifier.classify_one(True, response(100)) == AIRBORNE
+    assert classifier.classify_one(True, response(classifier.GROUND_ALT - 1)) == LANDED
+    assert classifier.classify_one(True, response("ground")) == LANDED
+    # Taxiing speed under the air altitude counts as down
+    assert classifier.classify_one(True, response(100, gs=20)) == LANDED
+
+
+def test_descending():
+    assert classifier.classify_one(True, response(8000, rate=-1500)) == DESCENDING
+    assert classifier.classify_one(True, response(8000, rate=-100)) == AIRBORNE
+
+
+def test_failed_requests_change_nothing():
+    error = {"message": "Too many requests"}
+    assert classifier.classify_one(True, error) == AIRBORNE
+    assert classifier.classify_one(False, error) == ON_GROUND
+
+
+def test_quiet_without_history_waits_unless_its_due_to_land():
+    assert classifier.classify_one(True, {"ac": []}, now=NOW) == SIGNAL_LOST
+    assert classifier.classify_one(True, {"ac": []}, landing_eta=NOW + 3 * 3600, now=NOW) == SIGNAL_LOST
+    assert classifier.classify_one(True, {"ac": []}, landing_eta=NOW + 600, now=NOW) == LANDED
+
+
+def tracked(*samples) -> track_history.TrackStore:
+    tracks = track_history.TrackStore()
+    for when, alt, rate in samples:
+        ac = {"alt_baro": alt, "gs": 150}
+        if rate is not None:
+            ac["baro_rate"] = rate
+        tracks.append("k", track_history.sample_from_ac(ac, when))
+    return tracks
+
+
+def lost_after(tracks, seconds) -> int:
+    return classifier.classify_responses(["k"], [True], [{"ac": []}], tracks, now=NOW + seconds)[0]
+
+
+def test_low_descent_is_called_landed_once_it_had_time_to_get_down():
+    # 2000ft at 1000ft/min is two minutes down, plus the minimum wait
+    tracks = tracked((NOW, 2000, -1000))
+    assert lost_after(tracks, 200) == SIGNAL_LOST
+    assert lost_after(tracks, 250) == LANDED
+
+
+def test_descent_rate_comes_from_the_altitudes_without_a_reported_one():
+    tracks = tracked((NOW - 60, 3000, None), (NOW - 30, 2500, None), (NOW, 2000, None))
+    assert lost_after(tracks, 200) == SIGNAL_LOST
+    assert lost_after(tracks, 250) == LANDED
+
+
+def test_climbing_waits_the_full_time():
+    tracks = tracked((NOW, 2000, 1500))
+    assert lost_after(tracks, classifier.LOST_LANDED_AFTER - 1) == SIGNAL_LOST
+    assert lost_after(tracks, classifier.LOST_LANDED_AFTER) == LANDED
+
+
+def test_high_and_level_waits_until_giving_up():
+    tracks = tracked((NOW, 35000, 0))
+    assert lost_after(tracks, classifier.LOST_LANDED_AFTER) == SIGNAL_LOST
+    assert lost_after(tracks, classifier.LOST_GIVE_UP) == LANDED
+
+
+def test_whole_sweep_in_one_pass():
+    states = classifier.classify_responses(
+        [None, None, None], [False, True, True], [response(5000), response("ground"), response(30000)]
+    )
+    assert states == [TAKING_OFF, LANDED, AIRBORNE]
@@ -0,0 +1,81 @@
+# flighttracker/tests/test_eta.py
+
+"""Local landing estimates, and that a plain climb-out is scheduled without FlightAware"""
+
+import asyncio
+
+import pytest
+
+import adsb_info
+from adsb_info import FlightData
+import eta
+import flight_bot
+
+# Heading due north out of 40N 100W, one airport ~60nm ahead and one ~300nm ahead
+TABLE = eta.AirportTable(["NEAR", "FAR"], ["Near Field", "Far Intl"], [41.0, 45.0], [-100.0, -100.0])
+CLIMB_OUT = {"hex": "abc123", "r": "N1", "alt_baro": 4000, "gs": 180, "baro_rate": 2500, "lat": 40.0, "lon": -100.0, "track": 0}
+
+
+def test_climb_out_guesses_the_nearer_airport():
+    result = eta.estimate(CLIMB_OUT, now=0, table=TABLE)
+    assert result.ident == "NEAR"
+    assert not result.confident
+    assert result.clear
+    assert result.remaining == pytest.approx(result.distance_nm / 180 * 3600)
+
+
+def test_airports_side_by_side_are_ambiguous():
+    table = eta.AirportTable(["WEST", "EAST"], ["West Field", "East Field"], [41.0, 41.0], [-100.1, -99.9])
+    result = eta.estimate(CLIMB_OUT, now=0, table=table)
+    assert not result.clear
+
+
+def test_descent_is_confident():
+    # 3000ft down at 1000ft/min and 180kt is about 9nm out
+    ac = {**CLIMB_OUT, "alt_baro": 3000, "baro_rate": -1000, "lat": 40.85}
+    result = eta.estimate(ac, now=0, table=TABLE)
+    assert result.ident == "NEAR"
+    assert result.confident
+
+
+def test_refresh_keeps_a_guess_up_to_date_but_never_overrides_flightaware(monkeypatch):
+    monkeypatch.setattr(eta, "_airports", TABLE)
+    flight = FlightData("abc123")
+    # Nothing of ours to update, a guess alone doesn't start one
+    assert not eta.refresh(flight, {"ac": [CLIMB_OUT]}, now=0)
+    flight.landing_source = "local"
+    assert eta.refresh(flight, {"ac": [CLIMB_OUT]}, now=0)
+    assert flight.flight_destination == "Near Field"
+    flight.landing_source = "aero"
+    flight.flight_destination = "Somewhere Else"
+    flight.landing_time = None
+    assert not eta.refresh(flight, {"ac": [CLIMB_OUT]}, now=0)
+    assert flight.landing_time is None
+
+
+def test_climb_out_skips_flightaware(monkeypatch):
+    flight = FlightData("abc123")
+    announced = []
+
+    async def fetch(_flight):
+        return {"ac": [CLIMB_OUT]}
+
+    async def no_aero(_self):
+        raise AssertionError("FlightAware asked for a plain climb-out")
+
+    async def announce(_context, fl_id, _flight, kind, text):
+        announced.append((fl_id, kind, text))
+
+    monkeypatch.setattr(eta, "_airports", TABLE)
+    monkeypatch.setattr(adsb_info, "is_awake", lambda: True)
+    monkeypatch.setattr(adsb_info, "batch_enabled", lambda: False)
+    monkeypatch.setattr(FlightData, "has_aero_data_async", no_aero)
+    monkeypatch.setattr(flight_bot, "fetch_adsb", fetch)
+    monkeypatch.setattr(flight_bot, "announce", announce)
+
+    asyncio.run(flight_bot.check_in_air(None, {"abc123": flight}))
+
+    assert flight.plane_in_air
+    assert flight.landing_source == "local"
+    assert flight.flight_destination == "Near Field"
+    assert announced and "Near Field (estimated)" in announced[0][2]
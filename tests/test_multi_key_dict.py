@@ -0,0 +1,86 @@
+# flighttracker/tests/test_multi_key_dict.py
+
+"""Aliases, replacing and removing values, and counting each value once"""
+
+import pytest
+
+from multi_key_dict import MultiKeyDict
+
+
+class Flight:
+    def __init__(self, name: str):
+        self.name = name
+
+
+def test_aliases_share_one_value():
+    d = MultiKeyDict()
+    flight = Flight("a")
+    d.add_mapping(flight, "a1013f", "N621MM")
+    assert d["a1013f"] is d["N621MM"] is flight
+    assert d.aliases("N621MM") == ("a1013f", "N621MM")
+    assert len(d) == 1
+    assert d.key_count() == 2
+    assert list(d.values()) == [flight]
+
+
+def test_add_key_never_steals_an_alias():
+    d = MultiKeyDict()
+    first, second = Flight("a"), Flight("b")
+    d.add_mapping(first, "a1013f")
+    d.add_mapping(second, "b2")
+    d.add_key(second, "a1013f")
+    assert d["a1013f"] is first
+
+
+def test_add_mapping_moves_an_alias_and_frees_the_empty_value():
+    d = MultiKeyDict()
+    first, second = Flight("a"), Flight("b")
+    d.add_mapping(first, "a1013f")
+    d.add_mapping(second, "a1013f", "N621MM")
+    assert d["a1013f"] is second
+    assert len(d) == 1
+    assert list(d.values()) == [second]
+
+
+def test_replace_swaps_the_value_for_every_alias():
+    d = MultiKeyDict()
+    d.add_mapping(Flight("a"), "a1013f", "N621MM")
+    newer = Flight("b")
+    d.replace("a1013f", newer)
+    assert d["N621MM"] is newer
+    assert len(d) == 1
+
+
+def test_replace_with_a_stored_value_merges_them():
+    d = MultiKeyDict()
+    first, second = Flight("a"), Flight("b")
+    d.add_mapping(first, "a1013f")
+    d.add_mapping(second, "N621MM")
+    d.replace("a1013f", second)
+    assert d["a1013f"] is second
+    assert set(d.aliases("a1013f")) == {"a1013f", "N621MM"}
+    assert len(d) == 1
+
+
+def test_remove_drops_every_alias_and_reuses_the_slot():
+    d = MultiKeyDict()
+    d.add_mapping(Flight("a"), "a1013f", "N621MM")
+    d.remove("N621MM")
+    assert "a1013f" not in d
+    assert len(d) == 0
+    assert d.key_count() == 0
+    d.add_mapping(Flight("b"), "b2")
+    assert len(d._values) == 1
+
+
+def test_deleting_one_alias_keeps_the_rest():
+    d = MultiKeyDict()
+    flight = Flight("a")
+    d.add_mapping(flight, "a1013f", "N621MM")
+    del d["a1013f"]
+    assert d.get("a1013f") is None
+    assert d["N621MM"] is flight
+    del d["N621MM"]
+    assert len(d) == 0
+    with pytest.raises(KeyError):
+        d.remove("N621MM")
@@ -0,0 +1,107 @@
+# flighttracker/tests/test_scheduler.py
+
+"""Poll intervals for each flight state, the ground backoff and the miss backoff"""
+
+import calendar
+from datetime import datetime, timedelta
+
+import pytest
+
+import adsb_info
+from adsb_info import FlightData
+import scheduler
+from scheduler import APPROACH_INTERVAL, APPROACH_WINDOW, BASE_INTERVAL, CRUISE_INTERVAL, GROUND_MAX
+
+NOW = calendar.timegm(datetime(2026, 1, 1, 12).timetuple())
+
+
+@pytest.fixture(autouse=True)
+def awake(monkeypatch):
+    monkeypatch.setattr(adsb_info, "is_awake", lambda: True)
+
+
+def flying(landing_in: float | None) -> FlightData:
+    flight = FlightData("abc123")
+    flight.plane_in_air = True
+    if landing_in is not None:
+        flight.landing_time = datetime(2026, 1, 1, 12) + timedelta(seconds=landing_in)
+    return flight
+
+
+def test_ground_backoff_doubles_up_to_the_cap():
+    polls = scheduler.PollScheduler()
+    flight = FlightData("abc123")
+    intervals = [polls.record("abc123", flight, now=NOW) for _ in range(6)]
+    assert intervals[0] == BASE_INTERVAL
+    assert intervals[1] == min(2 * BASE_INTERVAL, GROUND_MAX)
+    assert intervals[-1] == GROUND_MAX
+
+
+def test_unpolled_checks_dont_step_the_backoff():
+    polls = scheduler.PollScheduler()
+    flight = FlightData("abc123")
+    polls.record("abc123", flight, now=NOW)
+    assert polls.record("abc123", flight, now=NOW, polled=False) == BASE_INTERVAL
+    assert polls.request_rate(now=NOW) == 1
+
+
+def test_backoff_starts_over_after_a_flight():
+    polls = scheduler.PollScheduler()
+    flight = FlightData("abc123")
+    for _ in range(4):
+        polls.record("abc123", flight, now=NOW)
+    flight.plane_in_air = True
+    polls.record("abc123", flight, now=NOW)
+    flight.plane_in_air = False
+    assert polls.record("abc123", flight, now=NOW) == BASE_INTERVAL
+
+
+def test_airborne_intervals_follow_the_landing_time():
+    polls = scheduler.PollScheduler()
+    assert polls.interval("abc123", flying(None), NOW) == BASE_INTERVAL
+    assert polls.interval("abc123", flying(4 * 3600), NOW) == CRUISE_INTERVAL
+    # Wakes up in time for the approach instead of sleeping through it
+    assert polls.interval("abc123", flying(APPROACH_WINDOW + 120), NOW) == 120
+    assert polls.interval("abc123", flying(APPROACH_WINDOW - 1), NOW) == APPROACH_INTERVAL
+    assert polls.interval("abc123", flying(-600), NOW) == APPROACH_INTERVAL
+
+
+def test_record_schedules_the_next_poll():
+    polls = scheduler.PollScheduler()
+    polls.record("abc123", FlightData("abc123"), now=NOW)
+    assert polls.next_wake() == NOW + BASE_INTERVAL
+    assert polls.due(now=NOW) == {}
+    assert polls.due(now=NOW + BASE_INTERVAL) == {"abc123": NOW + BASE_INTERVAL}
+
+
+def test_empty_answers_back_off_no_longer_than_a_parked_plane():
+    polls = scheduler.PollScheduler()
+    flight = FlightData("abc123")
+    for _ in range(10):
+        wait = polls.note_response("abc123", flight, {"ac": []}, now=NOW)
+    assert wait == GROUND_MAX
+    assert polls.interval("abc123", flight, NOW) == GROUND_MAX
+
+
+def test_bad_ids_back_off_longer():
+    polls = scheduler.PollScheduler()
+    flight = FlightData("abc123")
+    for _ in range(10):
+        wait = polls.note_response("abc123", flight, {"message": "Invalid ID"}, now=NOW)
+    assert wait > GROUND_MAX
+    assert polls.interval("abc123", flight, NOW) == wait
+
+
+def test_flying_and_found_clear_the_backoff():
+    polls = scheduler.PollScheduler()
+    flight = FlightData("abc123")
+    polls.note_response("abc123", flight, {"message": "Invalid ID"}, now=NOW)
+    assert polls.note_response("abc123", flying(None), {"message": "Invalid ID"}, now=NOW) == 0
+    assert polls.note_response("abc123", flight, {"ac": [{"hex": "abc123"}]}, now=NOW) == 0
+    assert "abc123" not in polls.misses
+
+
+def test_restored_misses_are_capped():
+    polls = scheduler.PollScheduler()
+    polls.restore_misses("abc123", 12)
+    assert polls.misses.delay("abc123") <= GROUND_MAX
@@ -0,0 +1,55 @@
+# flighttracker/tests/test_subscriptions.py
+
+"""Several chats following the same aircraft only track it once"""
+
+from subscriptions import SubscriptionIndex
+
+
+def test_first_and_last_follower():
+    index = SubscriptionIndex()
+    assert index.subscribe(1, "a1013f", True)
+    assert not index.subscribe(2, "a1013f", False)
+    assert len(index) == 1
+    assert index.chat_count() == 2
+    assert not index.unsubscribe(1, "a1013f")
+    assert index.unsubscribe(2, "a1013f")
+    assert "a1013f" not in index
+    assert index.chat_count() == 0
+
+
+def test_unsubscribing_twice_does_nothing():
+    index = SubscriptionIndex()
+    index.subscribe(1, "a1013f", True)
+    index.subscribe(2, "a1013f", True)
+    assert not index.unsubscribe(1, "a1013f")
+    assert not index.unsubscribe(1, "a1013f")
+    assert index.chats("a1013f") == {2: True}
+
+
+def test_recurring_while_anyone_wants_it():
+    index = SubscriptionIndex()
+    index.subscribe(1, "a1013f", False)
+    assert not index.recurring("a1013f")
+    index.subscribe(2, "a1013f", True)
+    assert index.recurring("a1013f")
+    assert index.one_shot("a1013f") == [1]
+
+
+def test_resubscribing_changes_recurring():
+    index = SubscriptionIndex()
+    index.subscribe(1, "a1013f", False)
+    index.subscribe(1, "a1013f", True)
+    assert index.chats("a1013f") == {1: True}
+    assert index.aircraft(1) == ["a1013f"]
+
+
+def test_remove_aircraft_clears_both_sides():
+    index = SubscriptionIndex()
+    index.subscribe(1, "a1013f", True)
+    index.subscribe(1, "N621MM", True)
+    index.subscribe(2, "a1013f", False)
+    assert index.remove_aircraft("a1013f") == {1: True, 2: False}
+    assert index.aircraft(1) == ["N621MM"]
+    assert index.aircraft(2) == []
+    assert index.chat_count() == 1
+    assert not index.subscribed(2, "a1013f")
@@ -0,0 +1,194 @@
+# flighttracker/track_history.py
+
+"""
+Keeps the last few position samples for every aircraft, so we can tell a climb
+from a descent or a short dropout instead of looking at one sample at a time
+"""
+
+import json
+import logging as log
+import os
+import time
+
+import numpy as np
+
+thLog = log.getLogger("track_history")
+
+# Enable logging
+thLog.setLevel(log.INFO)
+formatter = log.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d - [%(levelname)s] - %(message)s')
+handler = log.StreamHandler()
+handler.setFormatter(formatter)
+thLog.propagate = False
+
+# Add the console handler to the logger
+thLog.addHandler(handler)
+
+# Samples kept per aircraft
+HISTORY_SIZE = int(os.environ.get("FT_TRACK_HISTORY", 32))
+
+# One column per field, in the order they're stored
+FIELDS = ("time", "lat", "lon", "alt", "gs", "vert_rate")
+
+
+def sample_from_ac(ac: dict, sample_time: float) -> tuple:
+    """Pull a sample out of an ADSB ac entry, anything missing is NaN"""
+
+    def number(value) -> float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    altitude = ac.get("alt_baro")
+    # ADSB reports "ground" instead of an altitude once it's down
+    alt = 0.0 if altitude == "ground" else number(altitude)
+    vert_rate = ac.get("baro_rate", ac.get("geom_rate"))
+    return (
+        sample_time,
+        number(ac.get("lat")),
+        number(ac.get("lon")),
+        alt,
+        number(ac.get("gs")),
+        number(vert_rate),
+    )
+
+
+class TrackStore:
+    """
+    Ring buffers for every aircraft, stored as one preallocated (aircraft, samples)
+    array per field. Memory only grows with the number of aircraft, never with how
+    long the bot has been running
+    """
+
+    def __init__(self, history: int = HISTORY_SIZE, initial_rows: int = 64):
+        self.history = history
+        self.columns = {name: np.full((initial_rows, history), np.nan) for name in FIELDS}
+        # Next write position and number of samples held, per row
+        self.head = np.zeros(initial_rows, dtype=np.int32)
+        self.count = np.zeros(initial_rows, dtype=np.int32)
+        # key -> row
+        self.rows = {}
+        self.free_rows = list(range(initial_rows - 1, -1, -1))
+        # key -> when it first came back empty, for aircraft we've no samples of yet
+        self.missing = {}
+
+    def _grow(self) -> None:
+        old = len(self.head)
+        for name in FIELDS:
+            extra = np.full((old, self.history), np.nan)
+            self.columns[name] = np.concatenate([self.columns[name], extra])
+        self.head = np.concatenate([self.head, np.zeros(old, dtype=np.int32)])
+        self.count = np.concatenate([self.count, np.zeros(old, dtype=np.int32)])
+        self.free_rows.extend(range(2 * old - 1, old - 1, -1))
+
+    def _row(self, key: str) -> int:
+        row = self.rows.get(key)
+        if row is None:
+            if not self.free_rows:
+                self._grow()
+            row = self.free_rows.pop()
+            self.rows[key] = row
+        return row
+
+    def append(self, key: str, sample: tuple) -> None:
+        """Add a sample (time, lat, lon, alt, gs, vert_rate), overwriting the oldest when full"""
+        row = self._row(key)
+        self.missing.pop(key, None)
+        pos = self.head[row]
+        for name, value in zip(FIELDS, sample):
+            self.columns[name][row, pos] = value
+        self.head[row] = (pos + 1) % self.history
+        self.count[row] = min(self.count[row] + 1, self.history)
+
+    def record_response(self, key: str, j_resp: json) -> bool:
+        """Record the aircraft in an ADSB response, returns False if there wasn't one"""
+        if not isinstance(j_resp, dict) or "message" in j_resp:
+            return False
+        if not j_resp.get("ac"):
+            if key not in self.rows:
+                self.missing.setdefault(key, time.time())
+            return False
+        ac = j_resp["ac"][0]
+        # now is in ms, seen is how many seconds old the data was at that point
+        now = j_resp.get("now")
+        sample_time = now / 1000 - float(ac.get("seen", 0)) if now else time.time()
+        # A cached response shared by several lookups is only one sample
+        if key in self.rows and self.last_seen(key) == sample_time:
+            return True
+        self.append(key, sample_from_ac(ac, sample_time))
+        return True
+
+    def remove(self, key: str) -> None:
+        self.missing.pop(key, None)
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        for name in FIELDS:
+            self.columns[name][row] = np.nan
+        self.head[row] = 0
+        self.count[row] = 0
+        self.free_rows.append(row)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _order(self, row: int, k: int) -> np.ndarray:
+        """Buffer positions of the last k samples of a row, oldest first"""
+        k = min(k, self.count[row])
+        return (self.head[row] - k + np.arange(k)) % self.history
+
+    def last(self, key: str, k: int | None = None) -> dict:
+        """Last k samples (all of them by default) as {field: array}, oldest first"""
+        row = self.rows.get(key)
+        if row is None:
+            return {name: np.empty(0) for name in FIELDS}
+        order = self._order(row, self.history if k is None else k)
+        return {name: self.columns[name][row, order] for name in FIELDS}
+
+    def latest(self, keys: list) -> dict:
+        """Most recent sample for each key as {field: array}, NaN for unknown keys"""
+        rows = np.array([self.rows.get(key, -1) for key in keys], dtype=np.int64)
+        # Unknown keys read row 0 and get masked out afterwards
+        safe = np.where(rows >= 0, rows, 0)
+        has_sample = (rows >= 0) & (self.count[safe] > 0)
+        pos = (self.head[safe] - 1) % self.history
+        return {
+            name: np.where(has_sample, self.columns[name][safe, pos], np.nan) for name in FIELDS
+        }
+
+    def missing_since(self, keys: list) -> np.ndarray:
+        """When each key first came back empty without us ever having a sample, NaN otherwise"""
+        return np.array([self.missing.get(key, np.nan) for key in keys], dtype=float)
+
+    def vertical_rate(self, key: str, window: float, now: float | None = None) -> float:
+        """
+        Average vertical rate in ft/min over the last window seconds. Uses the reported
+        rate when there is one, otherwise the altitude change across the window
+        """
+        samples = self.last(key)
+        now = time.time() if now is None else now
+        in_window = samples["time"] >= now - window
+        if not in_window.any():
+            return np.nan
+        rates = samples["vert_rate"][in_window]
+        if not np.isnan(rates).all():
+            return float(np.nanmean(rates))
+        times = samples["time"][in_window]
+        alts = samples["alt"][in_window]
+        valid = ~np.isnan(alts)
+        if valid.sum() < 2:
+            return np.nan
+        times, alts = times[valid], alts[valid]
+        return float((alts[-1] - alts[0]) / (times[-1] - times[0]) * 60) if times[-1] > times[0] else np.nan
+
+    def last_seen(self, key: str) -> float:
+        """Time of the newest sample, NaN if we have none"""
+        return float(self.latest([key])["time"][0])
+
+    def nbytes(self) -> int:
+        """Memory held by the buffers"""
+        return sum(col.nbytes for col in self.columns.values()) + self.head.nbytes + self.count.nbytes